@@ -4,8 +4,14 @@ import os
 import re
 import gzip
 import json
+import time
+import zlib
+import struct
+import marshal
+import calendar
 import argparse
 import logging
+from array import array
 from string import Template
 from collections import namedtuple
 
@@ -21,9 +27,18 @@ config = {
     "CONFIG_DEFAULT": "./log_analyzer.json",
     "SCRIPT_LOG": None,
     "SCRIPT_LOG_LEVEL": "INFO",
-    "ERRORS_THRESHOLD_%": 10
+    "ERRORS_THRESHOLD_%": 10,
+    "TIMESERIES": False,
+    "TIMESERIES_SIZE": 10,
+    "CHECKPOINT_DIR": None,
+    "CHECKPOINT_LINES": 1000000
 }
 
+CHECKPOINT_VERSION = 2
+
+MONTHS = {"Jan": 1, "Feb": 2, "Mar": 3, "Apr": 4, "May": 5, "Jun": 6,
+          "Jul": 7, "Aug": 8, "Sep": 9, "Oct": 10, "Nov": 11, "Dec": 12}
+
 
 def get_args():
 
@@ -93,14 +108,70 @@ def percentage(part, total):
     return (float(part)/total) * 100
 
 
-def parser(file_stream, logger, errors_limit):
-    result = {}
-    time_total = 0
-    records_num = 0
-    bad_url = 0
+def parse_minute(time_local, tz, cache):
+    # "[29/Jun/2017:03:50:22", "+0300]" -> minutes since epoch, UTC;
+    # every line of a minute has the same key, so it is parsed once
+    key = time_local[1:18] + tz[:5]
+    minute = cache.get(key)
+    if minute is None:
+        day, month, year = int(key[0:2]), MONTHS[key[3:6]], int(key[7:11])
+        hour, minutes = int(key[12:14]), int(key[15:17])
+        offset = int(key[18:20]) * 60 + int(key[20:22])
+        if key[17] == "-":
+            offset = -offset
+        minute = cache[key] = calendar.timegm(
+            (year, month, day, hour, minutes, 0)) // 60 - offset
+    return minute
+
+
+def add_to_series(series, url, minute, request_time):
+    # per url parallel arrays of minute, count, time sum and time max; lines
+    # come in time order, so almost always only the last bucket changes
+    buckets = series.get(url)
+    if buckets is None:
+        buckets = series[url] = (array("i"), array("I"), array("d"), array("d"))
+    minutes, counts, sums, maxes = buckets
+    if minutes and minutes[-1] == minute:
+        counts[-1] += 1
+        sums[-1] += request_time
+        if request_time > maxes[-1]:
+            maxes[-1] = request_time
+    else:
+        minutes.append(minute)
+        counts.append(1)
+        sums.append(request_time)
+        maxes.append(request_time)
+
+
+def new_state():
+    return {"result": {}, "time_total": 0, "records_num": 0, "bad_url": 0,
+            "offset": 0}
+
+
+def parser(file_stream, logger, errors_limit, series=None, state=None,
+           checkpoint=None, checkpoint_lines=1000000):
+    # with a `series` dict per url, per minute buckets are collected too.
+    # `state` holds the aggregates of lines parsed before and the byte
+    # offset they end at; checkpoint(state, series) is called every
+    # `checkpoint_lines` lines
+    state = state or new_state()
+    result = state["result"]
+    minutes_cache = {}
+    time_total = state["time_total"]
+    records_num = state["records_num"]
+    bad_url = state["bad_url"]
+    offset = state["offset"]
+    checkpointed = records_num
 
     for line in file_stream:
 
+        if checkpoint and records_num - checkpointed >= checkpoint_lines:
+            state.update(time_total=time_total, records_num=records_num,
+                         bad_url=bad_url, offset=offset)
+            checkpoint(state, series)
+            checkpointed = records_num
+
+        offset += len(line)
         line = line.decode('utf-8')
         line_sp = line.split()
 
@@ -122,9 +193,20 @@ def parser(file_stream, logger, errors_limit):
         url_data["timings"].append(float(request_time))
         time_total += float(request_time)
 
+        if series is not None:
+            try:
+                minute = parse_minute(line_sp[3], line_sp[4], minutes_cache)
+            except (KeyError, ValueError, IndexError):
+                minute = None
+            if minute is not None:
+                add_to_series(series, url, minute, float(request_time))
+
         result[url] = url_data
         records_num += 1
 
+    state.update(time_total=time_total, records_num=records_num,
+                 bad_url=bad_url, offset=offset)
+
     if percentage(bad_url, records_num) > errors_limit:
         logger.error("Parsing error threshold ({}%) reached".format(
             errors_limit))
@@ -166,11 +248,161 @@ def generate_report_data(data, records_num, time_total):
 
         result.append(url_summary)
 
-    result_sorted = sorted(result, key=lambda k: k["time_sum"], reverse=True)
+    # ties are ordered by url, so a resumed run gives the same report
+    result_sorted = sorted(result, key=lambda k: (-k["time_sum"], k["url"]))
 
     return result_sorted
 
 
+def generate_series_data(series, urls):
+    result = []
+
+    for url in urls:
+        points = {}
+        for minute, count, time_sum, time_max in zip(*series.get(url, ((),) * 4)):
+            # a line out of time order starts another bucket for its minute
+            point = points.setdefault(minute, [0, 0.0, 0.0])
+            point[0] += count
+            point[1] += time_sum
+            point[2] = max(point[2], time_max)
+
+        result.append({
+            "url": url,
+            "points": [{"minute": datetime_minute(minute),
+                        "count": count,
+                        "time_sum": round(time_sum, 3),
+                        "time_max": round(time_max, 3)}
+                       for minute, (count, time_sum, time_max) in sorted(points.items())]
+        })
+
+    return result
+
+
+def datetime_minute(minute):
+    return time.strftime("%Y-%m-%dT%H:%M:00Z", time.gmtime(minute * 60))
+
+
+def write_series(series_data, series_file, config):
+
+    if not os.path.exists(config["REPORT_DIR"]):
+        os.makedirs(config["REPORT_DIR"])
+
+    with open(series_file, 'w') as f:
+        json.dump(series_data, f)
+
+
+def save_checkpoint(checkpoint_file, log_name, state, series):
+    # only what changed since the last checkpoint is written: new timings
+    # and series buckets are appended to `checkpoint_file`.data as one
+    # segment, then a small header with the counters and the data size
+    # replaces `checkpoint_file`. state["checkpoint"] remembers what
+    # is saved already
+    saved = state.get("checkpoint")
+    if saved is None:
+        saved = {"size": 0, "timings": {}, "series": {}}
+
+    timings = {}
+    for url, url_data in state["result"].iteritems():
+        n = saved["timings"].get(url, 0)
+        if len(url_data["timings"]) > n:
+            timings[url] = array("d", url_data["timings"][n:]).tostring()
+            saved["timings"][url] = len(url_data["timings"])
+
+    buckets_data = {}
+    for url, buckets in (series or {}).iteritems():
+        minutes, counts = buckets[:2]
+        n, last_count = saved["series"].get(url, (0, 0))
+        if len(minutes) == n and counts[-1] == last_count:
+            continue
+        # the last saved bucket may have grown since
+        start = max(n - 1, 0)
+        buckets_data[url] = (start, tuple(a[start:].tostring() for a in buckets))
+        saved["series"][url] = (len(minutes), counts[-1])
+
+    checkpoint_dir = os.path.dirname(checkpoint_file)
+    if checkpoint_dir and not os.path.exists(checkpoint_dir):
+        os.makedirs(checkpoint_dir)
+
+    data_file = checkpoint_file + ".data"
+    with open(data_file, 'ab') as f:
+        # drop what a run killed while appending left past the header's size
+        f.truncate(saved["size"])
+        f.seek(saved["size"])
+        segment = zlib.compress(
+            marshal.dumps({"timings": timings, "series": buckets_data}, 2), 1)
+        f.write(struct.pack("<I", len(segment)) + segment)
+        saved["size"] = f.tell()
+
+    stat = os.stat(log_name)
+    header = {
+        "version": CHECKPOINT_VERSION,
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "data_size": saved["size"],
+        "series": series is not None,
+        "state": dict((k, state[k]) for k in
+                      ("time_total", "records_num", "bad_url", "offset")),
+    }
+
+    # a run killed while writing leaves the previous checkpoint intact
+    tmp_file = checkpoint_file + ".tmp"
+    with open(tmp_file, 'wb') as f:
+        f.write(marshal.dumps(header, 2))
+    os.rename(tmp_file, checkpoint_file)
+    state["checkpoint"] = saved
+
+
+def load_checkpoint(checkpoint_file, log_name, with_series):
+    # (state, series) saved for this very log file, or (None, None)
+    try:
+        with open(checkpoint_file, 'rb') as f:
+            header = marshal.load(f)
+        stat = os.stat(log_name)
+        if (header.get("version") != CHECKPOINT_VERSION or
+                header["size"] != stat.st_size or
+                header["mtime"] != stat.st_mtime or
+                header["series"] != with_series):
+            return None, None
+        segments = []
+        with open(checkpoint_file + ".data", 'rb') as f:
+            # segments are length prefixed
+            while f.tell() < header["data_size"]:
+                size, = struct.unpack("<I", f.read(4))
+                segments.append(marshal.loads(zlib.decompress(f.read(size))))
+            if f.tell() != header["data_size"]:
+                return None, None
+    except (IOError, OSError, ValueError, EOFError, TypeError, KeyError,
+            AttributeError, struct.error, zlib.error):
+        return None, None
+
+    state = new_state()
+    state.update(header["state"])
+    result = state["result"]
+    series = {} if with_series else None
+    for segment in segments:
+        for url, timings in segment["timings"].iteritems():
+            url_data = result.setdefault(url, {"count": 0, "timings": []})
+            url_data["timings"].extend(array("d", timings))
+            url_data["count"] = len(url_data["timings"])
+        if series is None:
+            continue
+        for url, (start, buckets_data) in segment["series"].iteritems():
+            buckets = series.get(url)
+            if buckets is None:
+                buckets = series[url] = (array("i"), array("I"), array("d"), array("d"))
+            for a, data in zip(buckets, buckets_data):
+                del a[start:]
+                a.fromstring(data)
+
+    state["checkpoint"] = {
+        "size": header["data_size"],
+        "timings": dict((url, url_data["count"]) for url, url_data in result.iteritems()),
+        "series": dict((url, (len(buckets[0]), buckets[1][-1]))
+                       for url, buckets in (series or {}).iteritems()),
+    }
+    return state, series
+
+
 def write_report(report_data, report_file, config):
 
     with open("report.html", "r") as f:
@@ -208,22 +440,57 @@ def main(config):
             log.log_name, report_file))
         exit(0)
 
-    opener = gzip.open if log.log_name.endswith(".gz") else open
-
-    with opener(log.log_name, "r") as log:
+    log_name = log.log_name
+    opener = gzip.open if log_name.endswith(".gz") else open
+    series = {} if config["TIMESERIES"] else None
+    state = None
+    checkpoint = None
+
+    if config["CHECKPOINT_DIR"]:
+        checkpoint_file = os.path.join(config["CHECKPOINT_DIR"],
+                                       os.path.basename(log_name) + '.checkpoint')
+        state, saved_series = load_checkpoint(checkpoint_file, log_name,
+                                              series is not None)
+        if state:
+            logger.info("Resuming {} from line {}".format(log_name,
+                                                          state["records_num"]))
+            series = saved_series
+
+        def checkpoint(state, series):
+            save_checkpoint(checkpoint_file, log_name, state, series)
+
+    with opener(log_name, "r") as log:
+        if state:
+            # gzip files get inflated up to the offset again, but not parsed
+            log.seek(state["offset"])
         raw_data, records_num, time_total = parser(
             log,
             logger,
-            config["ERRORS_THRESHOLD_%"])
+            config["ERRORS_THRESHOLD_%"],
+            series,
+            state,
+            checkpoint,
+            config["CHECKPOINT_LINES"])
 
     report_data = generate_report_data(raw_data,
                                        records_num,
                                        time_total)
 
+    if series is not None:
+        top_urls = [r["url"] for r in report_data[:config["TIMESERIES_SIZE"]]]
+        write_series(generate_series_data(series, top_urls),
+                     os.path.splitext(report_file)[0] + '-timeseries.json',
+                     config)
+
     write_report(report_data[:config["REPORT_SIZE"]],
                  report_file,
                  config)
 
+    if checkpoint:
+        for path in (checkpoint_file, checkpoint_file + ".data"):
+            if os.path.exists(path):
+                os.remove(path)
+
 
 if __name__ == "__main__":
     try:
@@ -6,6 +6,7 @@ import datetime
 import time
 import shutil
 import hashlib
+import logging
 
 
 class LogAnalyzerTest(unittest.TestCase):
@@ -92,6 +93,139 @@ class LogAnalyzerTest(unittest.TestCase):
         median = log_analyzer.median(t)
         self.assertAlmostEqual(median, 2.25, places=2)
 
+    def testParseMinute(self):
+        cache = {}
+        minute = log_analyzer.parse_minute("[29/Jun/2017:03:50:22", "+0300]", cache)
+        self.assertEqual(log_analyzer.datetime_minute(minute), "2017-06-29T00:50:00Z")
+        minute = log_analyzer.parse_minute("[29/Jun/2017:03:50:59", "-0130]", cache)
+        self.assertEqual(log_analyzer.datetime_minute(minute), "2017-06-29T05:20:00Z")
+        self.assertEqual(len(cache), 2)
+
+    def testParserSeries(self):
+        line = ('1.196.116.32 -  - [29/Jun/2017:03:{}:{} +0300] "GET {} HTTP/1.1" 200 927 '
+                '"-" "Lynx/2.8.8dev.9" "-" "1498697422-2190034393-4708-9752759" '
+                '"dc7161be3" {}\n')
+        lines = [line.format("50", "01", "/a", "0.5"),
+                 line.format("50", "40", "/a", "1.5"),
+                 line.format("50", "41", "/b", "0.1"),
+                 line.format("51", "00", "/a", "0.2"),
+                 line.format("50", "59", "/a", "0.3"),
+                 "broken line\n"]
+        series = {}
+        result, records_num, time_total = log_analyzer.parser(
+            lines, logging.getLogger(), 100, series)
+        self.assertEqual(records_num, 6)
+        self.assertEqual(result["/a"]["count"], 4)
+        data = log_analyzer.generate_series_data(series, ["/a", "/c"])
+        self.assertEqual(data[0]["url"], "/a")
+        self.assertEqual(data[0]["points"], [
+            {"minute": "2017-06-29T00:50:00Z", "count": 3, "time_sum": 2.3,
+             "time_max": 1.5},
+            {"minute": "2017-06-29T00:51:00Z", "count": 1, "time_sum": 0.2,
+             "time_max": 0.2}])
+        self.assertEqual(data[1], {"url": "/c", "points": []})
+
+    def testParserResume(self):
+        salt = int(time.mktime(datetime.datetime.now().timetuple()))
+        work_dir = '/tmp/some_work_dir' + str(salt)
+        os.makedirs(work_dir)
+        log_name = os.path.join(work_dir, 'nginx-access-ui.log-20170629')
+        checkpoint_file = os.path.join(work_dir, 'checkpoints', 'log.checkpoint')
+        line = ('1.196.116.32 -  - [29/Jun/2017:03:50:{:02d} +0300] "GET /{} HTTP/1.1" '
+                '200 927 "-" "Lynx/2.8.8dev.9" "-" "1498697422-2190034393-4708-9752759" '
+                '"dc7161be3" 0.{}\n')
+        with open(log_name, 'w') as f:
+            for i in range(50):
+                f.write(line.format(i, i % 7, i % 10) if i % 9 else "broken line\n")
+
+        logger = logging.getLogger()
+        full_series = {}
+        with open(log_name) as f:
+            full = log_analyzer.parser(f, logger, 100, full_series)
+
+        class Killed(Exception):
+            pass
+
+        def checkpoint(state, series):
+            log_analyzer.save_checkpoint(checkpoint_file, log_name, state, series)
+            if state["records_num"] == 40:
+                raise Killed()
+
+        with open(log_name) as f:
+            self.assertRaises(Killed, log_analyzer.parser, f, logger, 100, {}, None,
+                              checkpoint, 20)
+
+        state, series = log_analyzer.load_checkpoint(checkpoint_file, log_name, True)
+        self.assertEqual(state["records_num"], 40)
+        self.assertEqual(log_analyzer.load_checkpoint(checkpoint_file, log_name, False),
+                         (None, None))
+        with open(log_name) as f:
+            f.seek(state["offset"])
+            resumed = log_analyzer.parser(f, logger, 100, series, state)
+        self.assertEqual(resumed, full)
+        self.assertEqual(log_analyzer.generate_series_data(series, ["/1", "/6"]),
+                         log_analyzer.generate_series_data(full_series, ["/1", "/6"]))
+
+        # the log changed since the checkpoint was saved
+        with open(log_name, 'a') as f:
+            f.write(line.format(50, 1, 1))
+        self.assertEqual(log_analyzer.load_checkpoint(checkpoint_file, log_name, True),
+                         (None, None))
+
+        shutil.rmtree(work_dir)
+
+    def testCheckpointIsIncremental(self):
+        salt = int(time.mktime(datetime.datetime.now().timetuple()))
+        work_dir = '/tmp/some_work_dir_inc' + str(salt)
+        os.makedirs(work_dir)
+        log_name = os.path.join(work_dir, 'nginx-access-ui.log-20170629')
+        checkpoint_file = os.path.join(work_dir, 'log.checkpoint')
+        line = ('1.196.116.32 -  - [29/Jun/2017:03:{:02d}:00 +0300] "GET /{} HTTP/1.1" '
+                '200 927 "-" "Lynx/2.8.8dev.9" "-" "1498697422-2190034393-4708-9752759" '
+                '"dc7161be3" 0.{}\n')
+        with open(log_name, 'w') as f:
+            for i in range(60):
+                f.write(line.format(i // 4, i % 3, i % 10))
+
+        logger = logging.getLogger()
+        full_series = {}
+        with open(log_name) as f:
+            full = log_analyzer.parser(f, logger, 100, full_series)
+
+        sizes = []
+
+        def checkpoint(state, series):
+            log_analyzer.save_checkpoint(checkpoint_file, log_name, state, series)
+            sizes.append(os.path.getsize(checkpoint_file + '.data'))
+
+        with open(log_name) as f:
+            log_analyzer.parser(f, logger, 100, {}, None, checkpoint, 10)
+        # every segment holds only the ten new timings and a few buckets
+        growth = [b - a for a, b in zip([0] + sizes, sizes)]
+        self.assertEqual(len(sizes), 5)
+        self.assertLess(max(growth) - min(growth), 40)
+
+        # a segment cut short by a kill is past the header's size
+        with open(checkpoint_file + '.data', 'ab') as f:
+            f.write('\x00' * 7)
+        state, series = log_analyzer.load_checkpoint(checkpoint_file, log_name, True)
+        self.assertEqual(state["records_num"], 50)
+        with open(log_name) as f:
+            f.seek(state["offset"])
+            resumed = log_analyzer.parser(f, logger, 100, series, state, checkpoint, 5)
+        self.assertEqual(resumed, full)
+        self.assertEqual(sizes[-1], os.path.getsize(checkpoint_file + '.data'))
+
+        state, series = log_analyzer.load_checkpoint(checkpoint_file, log_name, True)
+        self.assertEqual(state["records_num"], 55)
+        with open(log_name) as f:
+            f.seek(state["offset"])
+            self.assertEqual(log_analyzer.parser(f, logger, 100, series, state), full)
+        self.assertEqual(log_analyzer.generate_series_data(series, ["/0", "/1", "/2"]),
+                         log_analyzer.generate_series_data(full_series, ["/0", "/1", "/2"]))
+
+        shutil.rmtree(work_dir)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,90 @@
+import json
+import Queue
+import random
+import logging
+import threading
+
+STOP = object()
+
+
+class AccessLog(object):
+    # Request threads only put a record dict on a queue: truncation,
+    # serialization and disk writes are done by a background writer.
+    # Records that don't fit into a full queue are dropped and counted.
+
+    def __init__(self, filename=None, body_limit=256, sample_rate=1.0,
+                 queue_size=10000, batch_size=256):
+        self.filename = filename
+        self.body_limit = body_limit
+        self.sample_rate = sample_rate
+        self.batch_size = batch_size
+        self.queue = Queue.Queue(maxsize=queue_size)
+        self.dropped = 0
+        self.written = 0
+        self.logger = logging.getLogger("access")
+        self.writer = None
+
+    def start(self):
+        self.writer = threading.Thread(target=self.run, name="access-log")
+        self.writer.daemon = True
+        self.writer.start()
+
+    def close(self):
+        if self.writer:
+            self.queue.put(STOP)
+            self.writer.join()
+            self.writer = None
+
+    def sampled(self, code):
+        # errors are always kept, successful requests are sampled
+        return code >= 400 or self.sample_rate >= 1 or random.random() < self.sample_rate
+
+    def log(self, record):
+        if not self.sampled(record.get("code", 0)):
+            return
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+    def format(self, record):
+        body = record.pop("body", None)
+        if body is not None and self.body_limit:
+            record["body"] = body[:self.body_limit].decode("utf-8", "replace")
+            if len(body) > self.body_limit:
+                record["body_truncated"] = True
+        return json.dumps(record, default=str)
+
+    def write(self, stream, records):
+        if not records:
+            return
+        lines = [self.format(r) for r in records]
+        if stream:
+            stream.write("\n".join(lines) + "\n")
+            stream.flush()
+        else:
+            for line in lines:
+                self.logger.info(line)
+        self.written += len(lines)
+
+    def run(self):
+        stream = open(self.filename, "a") if self.filename else None
+        try:
+            stop = False
+            while not stop:
+                records = [self.queue.get()]
+                while len(records) < self.batch_size:
+                    try:
+                        records.append(self.queue.get_nowait())
+                    except Queue.Empty:
+                        break
+                if STOP in records:
+                    records.remove(STOP)
+                    stop = True
+                try:
+                    self.write(stream, records)
+                except Exception:
+                    logging.exception("Access log write failed")
+        finally:
+            if stream:
+                stream.close()
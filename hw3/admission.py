@@ -0,0 +1,93 @@
+import time
+import threading
+import metrics
+
+REJECTED = metrics.Counter(
+    "scoring_api_rejected_total", "Requests rejected by admission control", "reason")
+
+
+class TokenBucket(object):
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst, now=None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.time() if now is None else now
+
+    def take(self, now, n=1):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= n:
+            self.tokens -= n
+            return True
+        return False
+
+
+def worker_share(limit, workers, least=0):
+    # one worker's part of a limit its supervisor's `workers` processes
+    # share; 0 stays no limit
+    if not limit or workers <= 1:
+        return limit
+    return max(limit / float(workers), least)
+
+
+class Admission(object):
+    # Token bucket per account (login for requests without one) plus a
+    # global cap on requests being handled at once. rate=0 disables the
+    # buckets and max_concurrency=0 the cap. `limits` overrides
+    # (rate, burst) for particular accounts.
+
+    def __init__(self, rate=0, burst=0, limits=None, max_concurrency=0):
+        self.rate = rate
+        self.burst = burst or rate
+        self.limits = limits or {}
+        self.max_concurrency = max_concurrency
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.active = 0
+
+    def split(self, workers):
+        # the limits of one of `workers` processes that share these; with
+        # reuse-port connections, not accounts, are spread evenly, so per
+        # account limits only hold roughly
+        limits = dict((key, (worker_share(rate, workers), worker_share(burst, workers, 1)))
+                      for key, (rate, burst) in self.limits.items())
+        return Admission(worker_share(self.rate, workers),
+                         worker_share(self.burst, workers, 1), limits,
+                         int(worker_share(self.max_concurrency, workers, 1)))
+
+    def bucket(self, key, now):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            rate, burst = self.limits.get(key, (self.rate, self.burst))
+            bucket = self.buckets[key] = TokenBucket(rate, burst or rate, now)
+        return bucket
+
+    def admit(self, account, login):
+        if not self.rate and not self.limits:
+            return True
+        key = account or login
+        now = time.time()
+        with self.lock:
+            bucket = self.bucket(key, now)
+            if not bucket.rate or bucket.take(now):
+                return True
+        REJECTED.inc("rate")
+        return False
+
+    def enter(self):
+        if not self.max_concurrency:
+            return True
+        with self.lock:
+            if self.active >= self.max_concurrency:
+                REJECTED.inc("concurrency")
+                return False
+            self.active += 1
+        return True
+
+    def leave(self):
+        if not self.max_concurrency:
+            return
+        with self.lock:
+            self.active -= 1
@@ -1,34 +1,90 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import re
 import abc
 import json
+import time
 import datetime
 import logging
+import os
+import sys
+import hmac
+import signal
+import socket
+import select
 import hashlib
 import uuid
+import zlib
+import threading
+from collections import OrderedDict
 from optparse import OptionParser
 from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
 import scoring
+import metrics
+import tracing
+import profiling
+import msgpackcodec
+from accesslog import AccessLog
+from admission import Admission
+from registry import MethodRegistry
+from supervisor import Supervisor
+from store import (Store, DeadlineStore, DeadlineExceeded, StoreError,
+                   CircuitBreaker, WriteBehind, ShardedBackend, backend_from_url)
+from snapshot import CacheSnapshot
+from shmcache import SharedCache
 
 SALT = "Otus"
 ADMIN_LOGIN = "admin"
 ADMIN_SALT = "42"
+AUTH_CACHE_SIZE = 100000
 
 OK = 200
 BAD_REQUEST = 400
 FORBIDDEN = 403
 NOT_FOUND = 404
 INVALID_REQUEST = 422
+TOO_MANY_REQUESTS = 429
 INTERNAL_ERROR = 500
+DEADLINE_EXCEEDED = 504
 ERRORS = {
     BAD_REQUEST: "Bad Request",
     FORBIDDEN: "Forbidden",
     NOT_FOUND: "Not Found",
     INVALID_REQUEST: "Invalid Request",
+    TOO_MANY_REQUESTS: "Too Many Requests",
     INTERNAL_ERROR: "Internal Server Error",
+    DEADLINE_EXCEEDED: "Deadline Exceeded",
 }
 
+# X-Request-Timeout may shorten or extend a method's deadline up to this
+MAX_REQUEST_TIMEOUT = 60.0
+
+MAX_BATCH_SIZE = 1000
+
+# zlib wbits for each supported content coding
+CODINGS = {
+    "gzip": 16 + zlib.MAX_WBITS,
+    "deflate": zlib.MAX_WBITS,
+}
+
+JSON = "application/json"
+# media type: (name, loads, dumps)
+WIRE_FORMATS = {
+    JSON: ("json", json.loads, json.dumps),
+    "application/msgpack": ("msgpack", msgpackcodec.unpackb, msgpackcodec.packb),
+    "application/x-msgpack": ("msgpack", msgpackcodec.unpackb, msgpackcodec.packb),
+}
+
+STAGE_SECONDS = metrics.Histogram(
+    "scoring_api_stage_seconds", "Time spent in each request processing stage",
+    "stage")
+METHOD_SECONDS = metrics.Histogram(
+    "scoring_api_method_seconds", "Time spent in each method handler", "method")
+RESPONSES = metrics.Counter(
+    "scoring_api_responses_total", "Responses sent by code", "code")
+
 UNKNOWN = 0
 MALE = 1
 FEMALE = 2
@@ -83,25 +139,55 @@ class EmailField(CharField):
 
 class PhoneField(Field):
     def parse_validate(self, value):
-        value = str(value)
+        if not isinstance(value, str):
+            value = str(value)
         if value and value.isdigit() and value[0] == "7":
             return value
 
 
 class DateField(Field):
+    date_re = re.compile(r"(\d{1,2})\.(\d{1,2})\.(\d{4})$")
+    # the same few thousand dates come over and over again
+    parsed = {}
+    max_parsed = 50000
+
     def parse_validate(self, value):
         try:
-            d = datetime.datetime.strptime(value, "%d.%m.%Y")
-            return d
-        except:
+            d = self.parsed.get(value)
+            if d is not None:
+                return d
+            day, month, year = self.date_re.match(value).groups()
+            d = datetime.datetime(int(year), int(month), int(day))
+        except (TypeError, ValueError, AttributeError):
             raise ValueError("value is not a date")
+        if len(self.parsed) >= self.max_parsed:
+            self.parsed.clear()
+        self.parsed[value] = d
+        return d
 
 
 class BirthDayField(DateField):
+    max_age = 70
+    # the oldest birthday which is still too old, recomputed at local midnight
+    cutoff = None
+    cutoff_expires = 0
+
+    def too_old(self):
+        now = time.time()
+        if now >= self.cutoff_expires:
+            today = datetime.date.fromtimestamp(now)
+            tomorrow = today + datetime.timedelta(days=1)
+            # too old when (today - bd).days / 365 > max_age
+            cls = type(self)
+            cls.cutoff = datetime.datetime.combine(
+                today - datetime.timedelta(days=(self.max_age + 1) * 365),
+                datetime.time())
+            cls.cutoff_expires = time.mktime(tomorrow.timetuple())
+        return self.cutoff
+
     def parse_validate(self, value):
         bd = super(BirthDayField, self).parse_validate(value)
-        diff = datetime.datetime.now() - bd
-        if (diff.days / 365) > 70:
+        if bd <= self.too_old():
             raise ValueError("age is greater then 70")
         return bd
 
@@ -123,7 +209,25 @@ class ClientIDsField(Field):
         return len(self.value)
 
 
+class PositiveNumberField(Field):
+    def parse_validate(self, value):
+        if isinstance(value, (int, float)) and not isinstance(value, bool) and value > 0:
+            return value
+        raise ValueError("value is not a positive number")
+
+
+class BatchItemsField(Field):
+    def parse_validate(self, value):
+        if (isinstance(value, list) and 0 < len(value) <= MAX_BATCH_SIZE and
+                all(isinstance(item, dict) for item in value)):
+            return value
+        raise ValueError("value is not a list of method calls")
+
+
 class RequestHandler(object):
+    # the list argument a method policy's max_size applies to
+    size_argument = None
+
     def validate_handle(self, request, arguments, ctx, store):
         if not request.is_valid():
             return request.errfmt(), INVALID_REQUEST
@@ -132,6 +236,53 @@ class RequestHandler(object):
     def handle(request, arguments, ctx, store):
         return {}, OK
 
+    def store_keys(self, request, arguments):
+        # (store keys, cache keys) handle() will read, so a batch can read
+        # the keys of all its calls at once
+        return (), ()
+
+
+MISSING = object()
+
+CLEAN_TEMPLATE = """
+def clean(self):
+    request = self.request
+    if not isinstance(request, dict):
+        request = {}
+    errors = self.errors
+%s
+    self.is_cleaned = True
+"""
+
+CLEAN_FIELD_TEMPLATE = """
+    value = request.get("%(name)s", MISSING)
+    if value is MISSING:
+        %(missing)s
+    elif not value and value != 0:
+        %(empty)s
+    else:
+        try:
+            self.%(name)s = validate_%(name)s(value)
+        except ValueError:
+            self.%(name)s = None
+            errors.append("%(name)s field validation error")
+"""
+
+
+def compile_clean(fields):
+    namespace = {"MISSING": MISSING}
+    code = []
+    for f in fields:
+        error = 'self.{0} = None; errors.append("{0} field {1}")'.format
+        empty = "self.%s = value" % f.name if f.nullable else error(f.name, "is empty")
+        missing = error(f.name, "not found") if f.required else "value = None; " + empty
+        code.append(CLEAN_FIELD_TEMPLATE % {"name": f.name,
+                                            "missing": missing,
+                                            "empty": empty})
+        namespace["validate_" + f.name] = f.parse_validate
+    exec CLEAN_TEMPLATE % ("".join(code) or "    pass") in namespace
+    return namespace["clean"]
+
 
 class RequestMeta(type):
     def __new__(mcs, name, bases, attrs):
@@ -142,46 +293,31 @@ class RequestMeta(type):
                 v.name = k
                 fields_list.append(v)
 
+        # cleaned values live in slots, so fields can't stay class attributes
+        for f in fields_list:
+            del attrs[f.name]
+        attrs["__slots__"] = tuple(attrs.get("__slots__", ())) + tuple(
+            f.name for f in fields_list)
+        for base in bases:
+            fields_list = getattr(base, "fields", []) + fields_list
+
         cls = super(RequestMeta, mcs).__new__(mcs, name, bases, attrs)
         cls.fields = fields_list
+        # validation plan is built once per class instead of on every request
+        cls.clean = compile_clean(fields_list)
 
         return cls
 
 
 class Request(object):
     __metaclass__ = RequestMeta
+    __slots__ = ("errors", "request", "is_cleaned")
 
     def __init__(self, request):
         self.errors = []
         self.request = request
         self.is_cleaned = False
 
-    def clean(self):
-
-        for f in self.fields:
-            value = None
-
-            try:
-                value = self.request[f.name]
-            except (KeyError, TypeError):
-                if f.required:
-                    self.errors.append("{} field not found".format(f.name))
-                    continue
-
-            if not value and value != 0:
-                if f.nullable:
-                    setattr(self, f.name, value)
-                else:
-                    self.errors.append("{} field is empty".format(f.name))
-                continue
-
-            try:
-                setattr(self, f.name, f.parse_validate(value))
-            except ValueError:
-                self.errors.append("{} field validation error".format(f.name))
-
-        self.is_cleaned = True
-
     def is_valid(self):
 
         if not self.is_cleaned:
@@ -200,11 +336,14 @@ class ClientsInterestsRequest(Request):
 
 class ClientsInterestsHandler(RequestHandler):
     request_type = ClientsInterestsRequest
+    size_argument = "client_ids"
 
     def handle(self, request, arguments, ctx, store):
         ctx["nclients"] = len(arguments.client_ids)
-        return {
-            cid: scoring.get_interests(store, cid) for cid in arguments.client_ids}, OK
+        return scoring.get_interests_many(store, arguments.client_ids), OK
+
+    def store_keys(self, request, arguments):
+        return [scoring.interests_key(cid) for cid in arguments.client_ids], ()
 
 
 class OnlineScoreRequest(Request):
@@ -255,6 +394,108 @@ class OnlineScoreHandler(RequestHandler):
 
         return {"score": score}, OK
 
+    def store_keys(self, request, arguments):
+        if request.is_admin:
+            return (), ()
+        return (), (scoring.score_key(arguments.first_name, arguments.last_name,
+                                      arguments.birthday),)
+
+
+class BatchRequest(Request):
+    requests = BatchItemsField(required=True)
+
+
+# store view shared by the calls of one batch: every key is read
+# from the store once, no matter how many calls ask for it
+class BatchStore(object):
+    def __init__(self, store):
+        self.store = store
+        self.values = {}
+        self.cache = {}
+
+    def prefetch(self, keys, cache_keys):
+        # one round trip for the keys of every call; if it fails, the
+        # calls read their keys themselves and fail or fall back as usual
+        if not keys and not cache_keys:
+            return
+        try:
+            values, cached = self.store.get_many_cached(keys, cache_keys)
+        except DeadlineExceeded:
+            raise
+        except StoreError:
+            return
+        self.values.update(zip(keys, values))
+        self.cache.update(zip(cache_keys, cached))
+
+    def get(self, key):
+        if key not in self.values:
+            self.values[key] = self.store.get(key)
+        return self.values[key]
+
+    def get_many(self, keys):
+        missing = [key for key in keys if key not in self.values]
+        if missing:
+            self.values.update(zip(missing, self.store.get_many(missing)))
+        return [self.values[key] for key in keys]
+
+    def cache_get(self, key):
+        if key not in self.cache:
+            self.cache[key] = self.store.cache_get(key)
+        return self.cache[key]
+
+    def cache_set(self, key, value, expires):
+        self.cache[key] = value
+        return self.store.cache_set(key, value, expires)
+
+
+class BatchHandler(RequestHandler):
+    request_type = BatchRequest
+    size_argument = "requests"
+
+    def prepare(self, item):
+        # calls run in the batch's slot, with its deadline and store view;
+        # of their own policies only max_size applies
+        method = methods.get(item.get("method"))
+        if method is None or not method.batchable:
+            return None, ("Method not found", NOT_FOUND)
+        arguments, error = method.validate(item.get("arguments"))
+        if error:
+            return None, (error, INVALID_REQUEST)
+        return (method.handler, arguments), None
+
+    def handle(self, request, arguments, ctx, store):
+        # every call is validated before any of them touches the store
+        calls = [self.prepare(item) for item in arguments.requests]
+        store = BatchStore(store)
+        keys, cache_keys = set(), set()
+        for call, _ in calls:
+            if call:
+                handler, call_arguments = call
+                call_keys, call_cache_keys = handler.store_keys(request, call_arguments)
+                keys.update(call_keys)
+                cache_keys.update(call_cache_keys)
+        store.prefetch(list(keys), list(cache_keys))
+        results = []
+        for call, error in calls:
+            if call:
+                handler, call_arguments = call
+                try:
+                    response, code = handler.handle(request, call_arguments, {}, store)
+                except DeadlineExceeded:
+                    raise
+                except StoreError as e:
+                    # only this call fails, the rest of the batch is answered
+                    logging.warning("Batch call failed: %s" % e)
+                    response, code = None, INTERNAL_ERROR
+            else:
+                response, code = error
+            if code not in ERRORS:
+                results.append({"response": response, "code": code})
+            else:
+                results.append({"error": response or ERRORS[code], "code": code})
+        ctx["nrequests"] = len(results)
+        return results, OK
+
 
 class MethodRequest(Request):
     account = CharField(required=False, nullable=True)
@@ -268,68 +509,370 @@ class MethodRequest(Request):
         return self.login == ADMIN_LOGIN
 
 
+class ProfileRequest(Request):
+    login = CharField(required=True, nullable=False)
+    token = CharField(required=True, nullable=True)
+    seconds = PositiveNumberField(required=False, nullable=True)
+    requests = PositiveNumberField(required=False, nullable=True)
+    interval = PositiveNumberField(required=False, nullable=True)
+
+    @property
+    def is_admin(self):
+        return self.login == ADMIN_LOGIN
+
+
+def user_token(account, login):
+    return hashlib.sha512(account + login + SALT).hexdigest()
+
+
+def admin_token(hour=None):
+    datenow = (hour or datetime.datetime.now()).strftime("%Y%m%d%H")
+    return hashlib.sha512(datenow + ADMIN_SALT).hexdigest()
+
+
+class HourlyAdminToken(object):
+    def __init__(self):
+        self.token = None
+        self.expires = 0
+
+    def get(self):
+        now = time.time()
+        if now >= self.expires:
+            hour = datetime.datetime.fromtimestamp(now).replace(
+                minute=0, second=0, microsecond=0)
+            self.token = admin_token(hour)
+            self.expires = time.mktime(
+                (hour + datetime.timedelta(hours=1)).timetuple())
+        return self.token
+
+
+# LRU of (account, login, token) triples whose token has already been
+# checked against its digest; failed checks are never cached
+class AuthCache(object):
+    def __init__(self, size):
+        self.size = size
+        self.verified = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self.lock:
+            try:
+                self.verified[key] = self.verified.pop(key)
+            except KeyError:
+                return False
+        return True
+
+    def add(self, key):
+        with self.lock:
+            self.verified[key] = True
+            if len(self.verified) > self.size:
+                self.verified.popitem(last=False)
+
+
+auth_cache = AuthCache(AUTH_CACHE_SIZE)
+hourly_admin_token = HourlyAdminToken()
+
+
 def check_auth(request):
+    token = (request.token or u"").encode("utf-8")
     if request.is_admin:
-        datenow = datetime.datetime.now().strftime("%Y%m%d%H")
-        digest = hashlib.sha512(datenow + ADMIN_SALT).hexdigest()
-    else:
-        digest = hashlib.sha512(request.account + request.login + SALT).hexdigest()
+        return hmac.compare_digest(hourly_admin_token.get(), token)
 
-    if digest == request.token:
+    key = (request.account, request.login, token)
+    if key in auth_cache:
+        return True
+    if hmac.compare_digest(user_token(request.account, request.login), token):
+        auth_cache.add(key)
         return True
     return False
 
 
-def method_handler(request, ctx, store):
+admission = Admission()
+tracer = tracing.Tracer()
+profiler = profiling.Profiler()
 
-    method_map = {
-        "online_score": OnlineScoreHandler,
-        "clients_interests": ClientsInterestsHandler}
+# new methods are a handler and a register() call away; policies can be
+# changed at startup with --method-policies
+methods = MethodRegistry()
+methods.register("online_score", OnlineScoreHandler, deadline=1.0)
+methods.register("clients_interests", ClientsInterestsHandler, deadline=5.0)
+methods.register("batch", BatchHandler, batchable=False, deadline=10.0)
+
+
+def request_timeout(headers, deadline):
+    try:
+        timeout = float(headers.get("X-Request-Timeout"))
+    except (TypeError, ValueError):
+        timeout = 0
+    if not 0 < timeout < float("inf"):
+        return deadline
+    return min(timeout, MAX_REQUEST_TIMEOUT)
+
+
+def method_handler(request, ctx, store):
+    started = time.time()
 
-    method_request = MethodRequest(request["body"])
-    if not method_request.is_valid():
+    with STAGE_SECONDS.time("validate"), tracing.span("validate"):
+        method_request = MethodRequest(request["body"])
+        valid = method_request.is_valid()
+    if not valid:
         return method_request.errfmt(), INVALID_REQUEST
 
-    if not check_auth(method_request):
+    with STAGE_SECONDS.time("check_auth"), tracing.span("check_auth"):
+        authorized = check_auth(method_request)
+    if not authorized:
         return None, FORBIDDEN
 
-    handler_cls = method_map.get(method_request.method, None)
-    if not handler_cls:
+    if not admission.admit(method_request.account, method_request.login):
+        return None, TOO_MANY_REQUESTS
+
+    method = methods.get(method_request.method)
+    if method is None:
         return "Method not found", NOT_FOUND
+    policy = method.policy
+
+    ctx["deadline"] = started + request_timeout(request["headers"], policy.deadline)
+    if store is not None:
+        store = DeadlineStore(store, ctx["deadline"], policy.store_timeout, policy.cache)
+
+    if not admission.enter():
+        return None, TOO_MANY_REQUESTS
+    # most methods have no cap of their own
+    capped = policy.max_concurrency
+    if capped and not policy.enter():
+        admission.leave()
+        return None, TOO_MANY_REQUESTS
+    try:
+        return handle_method(method, method_request, ctx, store)
+    except DeadlineExceeded:
+        return "Request deadline exceeded", DEADLINE_EXCEEDED
+    finally:
+        if capped:
+            policy.leave()
+        admission.leave()
+
+
+def handle_method(method, method_request, ctx, store):
+    with STAGE_SECONDS.time("validate_arguments"), tracing.span("validate_arguments"):
+        arguments, error = method.validate(method_request.arguments)
+    if error:
+        return error, INVALID_REQUEST
+    if time.time() >= ctx["deadline"]:
+        raise DeadlineExceeded("request deadline exceeded")
+
+    started = time.time()
+    with tracing.span("handler", method=method.name):
+        response, code = method.handler.validate_handle(
+            method_request,
+            arguments,
+            ctx, store)
+    elapsed = time.time() - started
+    STAGE_SECONDS.observe(elapsed, "handler")
+    METHOD_SECONDS.observe(elapsed, method.name)
+    return response, code
 
-    arguments = handler_cls().request_type(method_request.arguments)
-    if not arguments.is_valid():
-        return arguments.errfmt(), INVALID_REQUEST
 
-    response, code = handler_cls().validate_handle(
-        method_request,
-        arguments,
-        ctx, store)
-    return response, code
+def responses_sent():
+    return sum(counts[0] for counts in RESPONSES.collect().values())
+
+
+def profile_handler(request, ctx, store):
+    # samples the stacks of other request threads for `seconds`, or until
+    # `requests` more responses were sent, and returns the profile
+    profile_request = ProfileRequest(request["body"])
+    if not profile_request.is_valid():
+        return profile_request.errfmt(), INVALID_REQUEST
+    if not profile_request.is_admin or not check_auth(profile_request):
+        return None, FORBIDDEN
+    report = profiler.profile(
+        MainHTTPHandler.process_post.__func__.func_code,
+        profile_request.seconds or 10,
+        int(profile_request.requests or 0), responses_sent,
+        profile_request.interval or 0.005)
+    if report is None:
+        return "Another profile is running", TOO_MANY_REQUESTS
+    return report, OK
+
+
+def parse_qlist(header):
+    # (lowercased value, q) pairs of an Accept style header
+    for part in header.split(","):
+        value, _, params = part.partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                continue
+        yield value.strip().lower(), q
 
 
 class MainHTTPHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # idle keep-alive connections are dropped after `timeout` seconds
+    timeout = 60
+    max_requests = 100
+    # headers and body go out in one packet instead of a write per line
+    wbufsize = -1
+    disable_nagle_algorithm = True
+    # responses at least this big are compressed if the client accepts it
+    compress_min_size = 1024
+    compress_level = 6
+    # bodies bigger than that are written past the buffer instead of into it
+    direct_write_size = 64 * 1024
+    max_decoded_size = 16 * 1024 * 1024
     router = {
-        "method": method_handler
+        "method": method_handler,
+        "profile": profile_handler,
     }
     store = None
+    access_log = None
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.nrequests = 0
 
     def get_request_id(self, headers):
         return headers.get('HTTP_X_REQUEST_ID', uuid.uuid4().hex)
 
+    def read_body(self):
+        try:
+            length = int(self.headers.get('Content-Length'))
+        except (TypeError, ValueError):
+            length = -1
+        if length < 0:
+            # body can't be delimited, so the rest of the stream is lost
+            self.close_connection = 1
+            return None
+        return self.rfile.read(length)
+
+    def decode_body(self, data):
+        coding = self.headers.get("Content-Encoding", "identity").strip().lower()
+        if coding == "identity":
+            return data
+        if coding not in CODINGS:
+            raise ValueError("unsupported content coding: %s" % coding)
+        decompressor = zlib.decompressobj(CODINGS[coding])
+        decoded = decompressor.decompress(data, self.max_decoded_size)
+        if decompressor.unconsumed_tail:
+            raise ValueError("decoded body is too large")
+        return decoded
+
+    def accepted_coding(self):
+        # the preferred of CODINGS with a non-zero q value, if any
+        best, best_q = None, 0
+        for coding, q in parse_qlist(self.headers.get("Accept-Encoding", "")):
+            if coding not in CODINGS:
+                continue
+            if q > best_q or (q and q == best_q and coding == "gzip"):
+                best, best_q = coding, q
+        return best
+
+    def request_format(self):
+        media_type = self.headers.get("Content-Type", JSON).split(";")[0].strip().lower()
+        return media_type if media_type in WIRE_FORMATS else JSON
+
+    def response_format(self, request_format):
+        # the preferred of WIRE_FORMATS in Accept, else the request's own
+        best, best_q = request_format, 0
+        for media_type, q in parse_qlist(self.headers.get("Accept", "")):
+            if media_type not in WIRE_FORMATS:
+                continue
+            if q > best_q or (q and q == best_q and media_type == request_format):
+                best, best_q = media_type, q
+        return best
+
+    def encode_body(self, body):
+        if len(body) < self.compress_min_size:
+            return body, None
+        coding = self.accepted_coding()
+        if not coding:
+            return body, None
+        compressor = zlib.compressobj(self.compress_level, zlib.DEFLATED, CODINGS[coding])
+        return compressor.compress(body) + compressor.flush(), coding
+
+    def send_body(self, code, body, content_type=JSON):
+        self.nrequests += 1
+        if self.nrequests >= self.max_requests or self.server.draining:
+            self.close_connection = 1
+        body, coding = self.encode_body(body)
+        self.send_response(code, ERRORS.get(code))
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if coding:
+            self.send_header("Content-Encoding", coding)
+        if len(body) >= self.compress_min_size or coding:
+            self.send_header("Vary", "Accept-Encoding")
+        if self.close_connection:
+            self.send_header("Connection", "close")
+        elif self.request_version == "HTTP/1.0":
+            self.send_header("Connection", "keep-alive")
+        self.end_headers()
+        if self.command != "HEAD":
+            if len(body) >= self.direct_write_size:
+                # a flush joins the buffered pieces into one string; flushing
+                # the headers first lets a big body go out without a copy
+                self.wfile.flush()
+            self.wfile.write(body)
+        return len(body)
+
+    def send_error(self, code, message=None):
+        try:
+            short = self.responses[code][0]
+        except KeyError:
+            short = "Unknown Error"
+        self.log_error("code %d, message %s", code, message)
+        self.close_connection = 1
+        self.send_body(code, json.dumps({"error": message or short, "code": code}))
+
+    def log_request(self, code='-', size='-'):
+        # requests are recorded by access_log, off the request thread
+        pass
+
+    def log_access(self, context, started, body, request, response_size):
+        if not self.access_log:
+            return
+        context["path"] = self.path
+        context["method"] = request.get("method") if isinstance(request, dict) else None
+        context["latency"] = round(time.time() - started, 6)
+        context["request_size"] = len(body) if body else 0
+        context["response_size"] = response_size
+        context["body"] = body
+        self.access_log.log(context)
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] == "/metrics":
+            self.send_body(OK, metrics.render(), "text/plain; version=0.0.4")
+        else:
+            self.send_error(NOT_FOUND)
+
     def do_POST(self):
+        self.server.request_started()
+        try:
+            self.process_post()
+        finally:
+            self.server.request_finished()
+
+    def process_post(self):
+        started = time.time()
         response, code = {}, OK
         context = {"request_id": self.get_request_id(self.headers)}
+        tracer.start(context["request_id"])
         request = None
+        with tracing.span("read_body"):
+            data_string = self.read_body()
+        request_format = self.request_format()
+        name, loads, _ = WIRE_FORMATS[request_format]
         try:
-            data_string = self.rfile.read(int(self.headers['Content-Length']))
-            request = json.loads(data_string)
+            data_string = self.decode_body(data_string)
+            with STAGE_SECONDS.time(name + "_loads"), tracing.span(name + "_loads"):
+                request = loads(data_string)
         except:
             code = BAD_REQUEST
 
         if request:
             path = self.path.strip("/")
-            logging.info("%s: %s %s" % (self.path, data_string, context["request_id"]))
             if path in self.router:
                 try:
                     response, code = self.router[path](
@@ -342,32 +885,162 @@ class MainHTTPHandler(BaseHTTPRequestHandler):
             else:
                 code = NOT_FOUND
 
-        self.send_response(code)
-        self.send_header("Content-Type", "application/json")
-        self.end_headers()
         if code not in ERRORS:
             r = {"response": response, "code": code}
         else:
             r = {"error": response or ERRORS.get(code, "Unknown Error"), "code": code}
-        context.update(r)
-        logging.info(context)
-        self.wfile.write(json.dumps(r))
+        response_format = self.response_format(request_format)
+        name, _, dumps = WIRE_FORMATS[response_format]
+        with STAGE_SECONDS.time(name + "_dumps"), tracing.span(name + "_dumps"):
+            body = dumps(r)
+        with tracing.span("send"):
+            sent = self.send_body(code, body, response_format)
+        RESPONSES.inc(code)
+        context["code"] = code
+        self.log_access(context, started, data_string, request, sent)
+        tracer.finish(path=self.path, code=code)
         return
 
 
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    # keep-alive connections hold a thread each while idle
+    daemon_threads = True
+    # lets several worker processes listen on one port
+    reuse_port = False
+
+    def __init__(self, *args, **kwargs):
+        self.active = 0
+        self.draining = False
+        self.idle = threading.Condition()
+        HTTPServer.__init__(self, *args, **kwargs)
+
+    def server_bind(self):
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        HTTPServer.server_bind(self)
+
+    def request_started(self):
+        with self.idle:
+            self.active += 1
+
+    def request_finished(self):
+        with self.idle:
+            self.active -= 1
+            if not self.active:
+                self.idle.notify_all()
+
+    def stop(self, timeout=30):
+        # called after serve_forever() returned: connections already queued
+        # on the socket are still served, keep-alive connections are closed
+        # after their current response, in-flight requests are waited for
+        self.draining = True
+        while select.select([self.socket], [], [], 0)[0]:
+            self._handle_request_noblock()
+        self.server_close()
+        deadline = time.time() + timeout
+        with self.idle:
+            while self.active and time.time() < deadline:
+                self.idle.wait(deadline - time.time())
+
+
 if __name__ == "__main__":
     op = OptionParser()
     op.add_option("-p", "--port", action="store", type=int, default=8080)
     op.add_option("-l", "--log", action="store", default=None)
+    op.add_option("-w", "--workers", action="store", type=int, default=0,
+                  help="run a supervisor with this many worker processes; rate and "
+                       "concurrency limits are split evenly among them")
+    op.add_option("--worker-count", action="store", type=int, default=1,
+                  help="workers the limits are shared by, set by the supervisor")
+    op.add_option("--reuse-port", action="store_true", default=False)
+    op.add_option("--graceful-timeout", action="store", type=float, default=30)
+    op.add_option("--keepalive-timeout", action="store", type=float, default=60)
+    op.add_option("--max-requests", action="store", type=int, default=100)
+    op.add_option("--store", action="store", default="memory://")
+    op.add_option("--store-timeout", action="store", type=float, default=1.0)
+    op.add_option("--store-max-connections", action="store", type=int, default=None,
+                  help="connection pool size of every store node")
+    op.add_option("--store-max-failures", action="store", type=int, default=5)
+    op.add_option("--store-reset-timeout", action="store", type=float, default=5.0)
+    op.add_option("--store-write-queue", action="store", type=int, default=10000,
+                  help="cache writes queued for write-behind, 0 to write inline")
+    op.add_option("--cache-snapshot", action="store", default=None,
+                  help="file to keep the hottest cache entries in across restarts")
+    op.add_option("--cache-snapshot-size", action="store", type=int, default=100000)
+    op.add_option("--cache-snapshot-interval", action="store", type=float, default=300)
+    op.add_option("--shm-cache", action="store", default=None,
+                  help="score cache file shared by the workers, e.g. /dev/shm/scoring")
+    op.add_option("--shm-cache-slots", action="store", type=int, default=1 << 20)
+    op.add_option("--shm-cache-ttl", action="store", type=float, default=60)
+    op.add_option("--rate-limit", action="store", type=float, default=0,
+                  help="requests per second per account, 0 for no limit")
+    op.add_option("--rate-burst", action="store", type=float, default=0)
+    op.add_option("--rate-limits", action="store", default=None,
+                  help='json file with per account limits: {"account": [rate, burst]}')
+    op.add_option("--max-concurrency", action="store", type=int, default=0)
+    op.add_option("--method-policies", action="store", default=None,
+                  help='json file with per method policies: {"method": {"deadline": '
+                       '1.0, "store_timeout": 0.5, "cache": "cache|refresh|bypass", '
+                       '"max_size": 500, "max_concurrency": 100}}')
+    op.add_option("--access-log", action="store", default=None)
+    op.add_option("--access-log-body", action="store", type=int, default=256)
+    op.add_option("--access-log-sample", action="store", type=float, default=1.0)
+    op.add_option("--trace-slow", action="store", type=float, default=0,
+                  help="log span trees of requests slower than this many ms")
+    op.add_option("--trace-sample", action="store", type=float, default=1.0)
+    op.add_option("--profile-dir", action="store", default=None,
+                  help="also save profiles taken with /profile here")
     (opts, args) = op.parse_args()
     logging.basicConfig(filename=opts.log,
                         level=logging.INFO,
                         format='[%(asctime)s] %(levelname).1s %(message)s',
                         datefmt='%Y.%m.%d %H:%M:%S')
-    server = HTTPServer(("localhost", opts.port), MainHTTPHandler)
+    if opts.workers:
+        argv = ([sys.executable, os.path.abspath(__file__)] + sys.argv[1:] +
+                ["--workers=0", "--worker-count=%d" % opts.workers, "--reuse-port"])
+        Supervisor(argv, opts.workers, opts.graceful_timeout).run()
+        sys.exit(0)
+    limits = {}
+    if opts.rate_limits:
+        with open(opts.rate_limits) as f:
+            limits = dict((k, tuple(v)) for k, v in json.load(f).items())
+    admission = Admission(opts.rate_limit, opts.rate_burst, limits,
+                          opts.max_concurrency).split(opts.worker_count)
+    if opts.method_policies:
+        with open(opts.method_policies) as f:
+            methods.configure(json.load(f))
+    methods.split(opts.worker_count)
+    tracer = tracing.Tracer(opts.trace_slow / 1000.0, opts.trace_sample)
+    profiler = profiling.Profiler(opts.profile_dir)
+    MainHTTPHandler.timeout = opts.keepalive_timeout
+    MainHTTPHandler.max_requests = opts.max_requests
+    new_breaker = lambda: CircuitBreaker(opts.store_max_failures, opts.store_reset_timeout)
+    backend = backend_from_url(opts.store, opts.store_timeout, opts.store_max_connections,
+                               new_breaker)
+    MainHTTPHandler.store = Store(
+        backend,
+        timeout=opts.store_timeout,
+        # shards have a breaker each
+        breaker=CircuitBreaker(0) if isinstance(backend, ShardedBackend) else new_breaker(),
+        write_behind=WriteBehind(opts.store_write_queue) if opts.store_write_queue else None,
+        snapshot=CacheSnapshot(opts.cache_snapshot, opts.cache_snapshot_size,
+                               opts.cache_snapshot_interval) if opts.cache_snapshot else None,
+        local_cache=SharedCache(opts.shm_cache, opts.shm_cache_slots,
+                                ttl=opts.shm_cache_ttl) if opts.shm_cache else None)
+    MainHTTPHandler.access_log = AccessLog(opts.access_log,
+                                           body_limit=opts.access_log_body,
+                                           sample_rate=opts.access_log_sample)
+    MainHTTPHandler.access_log.start()
+    ThreadedHTTPServer.reuse_port = opts.reuse_port
+    server = ThreadedHTTPServer(("localhost", opts.port), MainHTTPHandler)
+    # shutdown() waits for serve_forever(), so it can't run in this thread
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(
+        target=server.shutdown).start())
     logging.info("Starting server at %s" % opts.port)
     try:
         server.serve_forever()
     except KeyboardInterrupt:
         pass
-    server.server_close()
+    server.stop(opts.graceful_timeout)
+    MainHTTPHandler.store.close()
+    MainHTTPHandler.access_log.close()
\ No newline at end of file
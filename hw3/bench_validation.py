@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Per-request validation cost of the api Request classes.
+#   python bench_validation.py [-n NUMBER]
+
+import timeit
+from optparse import OptionParser
+import api
+
+METHOD_REQUEST = {
+    "account": "horns&hoofs", "login": "h&f", "method": "online_score",
+    "token": "55cc9ce545bcd144300fe9efc28e65d415b923ebb6be1e19d2750a2c03e80dd2"
+             "09a27954dca045e5bb12418e7d89b6d718a9e35af34e14e1d5bcd5a08f21fc95",
+    "arguments": {},
+}
+SCORE_ARGUMENTS = {
+    "phone": "79175002040", "email": "stupnikov@otus.ru", "gender": 1,
+    "birthday": "01.01.2000", "first_name": "a", "last_name": "b",
+}
+INTERESTS_ARGUMENTS = {"client_ids": [1, 2, 3, 4], "date": "20.07.2017"}
+
+CASES = [
+    ("MethodRequest", api.MethodRequest, METHOD_REQUEST),
+    ("OnlineScoreRequest", api.OnlineScoreRequest, SCORE_ARGUMENTS),
+    ("ClientsInterestsRequest", api.ClientsInterestsRequest, INTERESTS_ARGUMENTS),
+]
+
+
+def bench(request_type, body, number):
+    def run():
+        request = request_type(body)
+        assert request.is_valid(), request.errfmt()
+    return min(timeit.repeat(run, number=number, repeat=5)) / number
+
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("-n", "--number", action="store", type=int, default=20000)
+    (opts, args) = op.parse_args()
+    total = 0
+    for name, request_type, body in CASES:
+        cost = bench(request_type, body, opts.number)
+        total += cost
+        print("%-24s %8.2f us" % (name, cost * 1e6))
+    print("%-24s %8.2f us" % ("total", total * 1e6))
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Per-request cost of decoding a request body and encoding its response,
+# JSON against MessagePack (the C extension, when installed, and the pure
+# Python codec).
+#   python bench_wire.py [-n NUMBER] [--clients N]
+
+import json
+import timeit
+from optparse import OptionParser
+import msgpackcodec
+from bench_validation import METHOD_REQUEST, SCORE_ARGUMENTS
+from interests import VOCABULARY
+
+
+def cases(clients):
+    score_request = dict(METHOD_REQUEST, arguments=SCORE_ARGUMENTS)
+    score_response = {"response": {"score": 5.0}, "code": 200}
+    interests_request = dict(METHOD_REQUEST, method="clients_interests",
+                             arguments={"client_ids": range(clients),
+                                        "date": "20.07.2017"})
+    interests_response = {"response": dict((cid, VOCABULARY[cid % 5:cid % 5 + 2])
+                                           for cid in range(clients)),
+                          "code": 200}
+    return [
+        ("online_score", score_request, score_response),
+        ("clients_interests", interests_request, interests_response),
+    ]
+
+
+def codecs():
+    yield "json", json.loads, json.dumps
+    if msgpackcodec.msgpack is not None:
+        yield "msgpack", msgpackcodec.unpackb, msgpackcodec.packb
+    yield "msgpack (python)", msgpackcodec.py_unpackb, msgpackcodec.py_packb
+
+
+def bench(func, arg, number):
+    return min(timeit.repeat(lambda: func(arg), number=number, repeat=5)) / number
+
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("-n", "--number", action="store", type=int, default=2000)
+    op.add_option("--clients", action="store", type=int, default=500)
+    (opts, args) = op.parse_args()
+    print("%-18s %-18s %10s %10s %10s %8s" % ("method", "codec", "decode us",
+                                              "encode us", "total us", "bytes"))
+    for method, request, response in cases(opts.clients):
+        for name, loads, dumps in codecs():
+            body = dumps(request)
+            decode = bench(loads, body, opts.number)
+            encode = bench(dumps, response, opts.number)
+            print("%-18s %-18s %10.2f %10.2f %10.2f %8d" % (
+                method, name, decode * 1e6, encode * 1e6, (decode + encode) * 1e6,
+                len(body) + len(dumps(response))))
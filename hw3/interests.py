@@ -0,0 +1,53 @@
+import json
+
+# Index in this list is the bit of an interest in encoded values, so it
+# is append only: never remove or reorder entries.
+VOCABULARY = ["cars", "pets", "travel", "hi-tech", "sport", "music",
+              "books", "tv", "cinema", "geek", "otus"]
+BITS = dict((name, 1 << i) for i, name in enumerate(VOCABULARY))
+
+# Encoded value: a version byte followed by the bitmask of interests,
+# least significant bits first, 7 bits per byte. Keeping the high bit
+# clear keeps values ASCII, so they survive JSON (cache snapshots) as is.
+# Values starting with "[" are legacy JSON lists and still decode.
+VERSION = "\x01"
+
+decoded = {}
+
+
+def encodable(interests):
+    return all(name in BITS for name in interests)
+
+
+def encode(interests):
+    # raises KeyError on names outside the vocabulary
+    mask = 0
+    for name in interests:
+        mask |= BITS[name]
+    chars = [VERSION]
+    while True:
+        chars.append(chr(mask & 0x7f))
+        mask >>= 7
+        if not mask:
+            return "".join(chars)
+
+
+def decode_mask(value):
+    mask = 0
+    for i, char in enumerate(value[1:]):
+        mask |= ord(char) << (7 * i)
+    return tuple(name for i, name in enumerate(VOCABULARY) if mask & (1 << i))
+
+
+def decode(value):
+    if not value:
+        return []
+    if value[0] != VERSION:
+        if value[0] == "[":
+            return json.loads(value)
+        raise ValueError("unsupported interests encoding: %r" % value[:1])
+    # there are only 2 ** len(VOCABULARY) distinct values
+    names = decoded.get(value)
+    if names is None:
+        names = decoded[value] = decode_mask(value)
+    return list(names)
@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Load generator for the scoring API.
+#
+#   python loadtest.py --url http://localhost:8080/method -c 20 -d 30
+#   python loadtest.py --local --store-latency 0.002 --rate 500 -d 10
+#
+# With --rate requests are sent on a fixed schedule and latency is counted
+# from the scheduled send time, so a stalled server shows up in the
+# percentiles instead of just slowing the generator down.
+
+import json
+import time
+import random
+import socket
+import urlparse
+import httplib
+import itertools
+import threading
+from optparse import OptionParser
+import api
+import interests
+from store import Store, MemoryBackend
+
+ACCOUNT = "horns&hoofs"
+LOGIN = "h&f"
+
+
+def sign(request):
+    if request.get("login") == api.ADMIN_LOGIN:
+        request["token"] = api.admin_token()
+    else:
+        request["token"] = api.user_token(request.get("account", ""),
+                                          request.get("login", ""))
+    return request
+
+
+def online_score_arguments(rnd, clients):
+    n = rnd.randrange(clients)
+    return {"phone": "7%010d" % n,
+            "email": "client%d@otus.ru" % n,
+            "first_name": "first%d" % n,
+            "last_name": "last%d" % n,
+            "birthday": "%02d.%02d.%d" % (n % 28 + 1, n % 12 + 1, 1960 + n % 50),
+            "gender": n % 3}
+
+
+def clients_interests_arguments(rnd, clients, size=10):
+    return {"client_ids": [rnd.randrange(clients) for _ in range(size)],
+            "date": "20.07.2017"}
+
+
+ARGUMENTS = {
+    "online_score": online_score_arguments,
+    "clients_interests": clients_interests_arguments,
+}
+
+
+def parse_mix(mix):
+    weights = []
+    for part in mix.split(","):
+        method, _, weight = part.partition("=")
+        if method not in ARGUMENTS:
+            raise ValueError("unknown method in mix: %s" % method)
+        weights.append((method, float(weight or 1)))
+    return weights
+
+
+def make_bodies(mix, clients, n, seed=0):
+    # requests are built and signed upfront to keep the generator cheap
+    rnd = random.Random(seed)
+    total = sum(w for _, w in mix)
+    bodies = []
+    for _ in range(n):
+        point = rnd.uniform(0, total)
+        for method, weight in mix:
+            point -= weight
+            if point <= 0:
+                break
+        request = {"account": ACCOUNT, "login": LOGIN, "method": method,
+                   "arguments": ARGUMENTS[method](rnd, clients)}
+        bodies.append(json.dumps(sign(request)))
+    return bodies
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    k = max(0, int(round(p / 100.0 * len(sorted_values))) - 1)
+    return sorted_values[min(k, len(sorted_values) - 1)]
+
+
+class LoadTest(object):
+    def __init__(self, url, bodies, concurrency=10, rate=0, duration=10,
+                 requests=0, timeout=10):
+        parsed = urlparse.urlparse(url)
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self.path = parsed.path or "/method"
+        self.bodies = bodies
+        self.concurrency = concurrency
+        self.rate = rate
+        self.duration = duration
+        self.requests = requests
+        self.timeout = timeout
+        self.tickets = itertools.count()
+        self.latencies = []
+        self.codes = {}
+        self.lock = threading.Lock()
+
+    def next_ticket(self):
+        n = next(self.tickets)
+        if self.requests and n >= self.requests:
+            return None
+        if self.rate:
+            scheduled = self.started + float(n) / self.rate
+        else:
+            scheduled = time.time()
+        if scheduled - self.started >= self.duration:
+            return None
+        return n, scheduled
+
+    def send(self, conn, body):
+        conn.request("POST", self.path, body, {"Content-Type": "application/json"})
+        response = conn.getresponse()
+        code = json.loads(response.read()).get("code", response.status)
+        if response.will_close:
+            conn.close()
+        return code
+
+    def worker(self):
+        conn = httplib.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        latencies, codes = [], {}
+        while True:
+            ticket = self.next_ticket()
+            if ticket is None:
+                break
+            n, scheduled = ticket
+            wait = scheduled - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            body = self.bodies[n % len(self.bodies)]
+            reused = conn.sock is not None
+            try:
+                try:
+                    code = self.send(conn, body)
+                except (httplib.BadStatusLine, socket.error):
+                    # the server may close an idle keep-alive connection
+                    # just as the request goes out; retry on a fresh one
+                    conn.close()
+                    if not reused:
+                        raise
+                    code = self.send(conn, body)
+            except Exception as e:
+                code = type(e).__name__
+                conn.close()
+            latencies.append(time.time() - scheduled)
+            codes[code] = codes.get(code, 0) + 1
+        conn.close()
+        with self.lock:
+            self.latencies.extend(latencies)
+            for code, count in codes.items():
+                self.codes[code] = self.codes.get(code, 0) + count
+
+    def run(self):
+        self.started = time.time()
+        workers = [threading.Thread(target=self.worker)
+                   for _ in range(self.concurrency)]
+        for w in workers:
+            w.daemon = True
+            w.start()
+        for w in workers:
+            w.join()
+        self.elapsed = time.time() - self.started
+        return self.report()
+
+    def report(self):
+        latencies = sorted(self.latencies)
+        return {
+            "requests": len(latencies),
+            "elapsed": self.elapsed,
+            "throughput": len(latencies) / self.elapsed if self.elapsed else 0.0,
+            "codes": self.codes,
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "max": latencies[-1] if latencies else 0.0,
+        }
+
+
+def local_server(latency, jitter, clients):
+    backend = MemoryBackend()
+    rnd = random.Random(0)
+    for cid in range(clients):
+        backend.set("i:%s" % cid,
+                    interests.encode(rnd.sample(interests.VOCABULARY, 2)))
+    backend.latency, backend.jitter = latency, jitter
+    api.MainHTTPHandler.store = Store(backend)
+    server = api.ThreadedHTTPServer(("localhost", 0), api.MainHTTPHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def print_report(report):
+    print("requests    %d in %.2fs" % (report["requests"], report["elapsed"]))
+    print("throughput  %.1f req/s" % report["throughput"])
+    for p in ("p50", "p95", "p99", "max"):
+        print("%-11s %.2f ms" % (p, report[p] * 1000))
+    for code, count in sorted(report["codes"].items()):
+        print("code %-6s %d" % (code, count))
+
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("-u", "--url", action="store", default="http://localhost:8080/method")
+    op.add_option("-c", "--concurrency", action="store", type=int, default=10)
+    op.add_option("-r", "--rate", action="store", type=float, default=0,
+                  help="requests per second, 0 for as fast as possible")
+    op.add_option("-d", "--duration", action="store", type=float, default=10)
+    op.add_option("-n", "--requests", action="store", type=int, default=0)
+    op.add_option("-m", "--mix", action="store",
+                  default="online_score=0.8,clients_interests=0.2")
+    op.add_option("--clients", action="store", type=int, default=10000)
+    op.add_option("--local", action="store_true", default=False,
+                  help="run against an in-process server with an in-memory store")
+    op.add_option("--store-latency", action="store", type=float, default=0.0)
+    op.add_option("--store-jitter", action="store", type=float, default=0.0)
+    (opts, args) = op.parse_args()
+
+    url, server = opts.url, None
+    if opts.local:
+        server = local_server(opts.store_latency, opts.store_jitter, opts.clients)
+        url = "http://%s:%s/method" % server.server_address
+    bodies = make_bodies(parse_mix(opts.mix), opts.clients, 10000)
+    test = LoadTest(url, bodies, concurrency=opts.concurrency, rate=opts.rate,
+                    duration=opts.duration, requests=opts.requests)
+    print_report(test.run())
+    if server:
+        server.shutdown()
+        server.server_close()
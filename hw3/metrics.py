@@ -0,0 +1,158 @@
+import time
+import bisect
+import threading
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+REGISTRY = []
+
+
+class Metric(object):
+    # Every thread updates its own shard without locking; shards are only
+    # merged (under a lock) when the metrics are rendered. Shards of dead
+    # threads are folded into `retired`, on render and whenever the number
+    # of shards has doubled, so per-connection threads don't pile up.
+    kind = None
+    min_prune = 64
+
+    def __init__(self, name, doc, label=None, registry=REGISTRY):
+        self.name = name
+        self.doc = doc
+        self.label = label
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.shards = []
+        self.retired = {}
+        self.prune_at = self.min_prune
+        registry.append(self)
+
+    def shard(self):
+        try:
+            return self.local.values
+        except AttributeError:
+            values = self.local.values = {}
+            with self.lock:
+                self.shards.append((threading.current_thread(), values))
+                if len(self.shards) >= self.prune_at:
+                    self.retire()
+            return values
+
+    def retire(self):
+        # called with the lock held
+        alive = []
+        for thread, values in self.shards:
+            if thread.is_alive():
+                alive.append((thread, values))
+            else:
+                self.merge(self.retired, values)
+        self.shards = alive
+        self.prune_at = max(self.min_prune, 2 * len(alive))
+
+    def merge(self, totals, values):
+        for label, counts in values.items():
+            total = totals.get(label)
+            if total is None:
+                totals[label] = list(counts)
+            else:
+                for i, n in enumerate(counts):
+                    total[i] += n
+
+    def collect(self):
+        with self.lock:
+            self.retire()
+            totals = {}
+            self.merge(totals, self.retired)
+            for _, values in self.shards:
+                self.merge(totals, values)
+        return totals
+
+    def labels(self, label, **extra):
+        pairs = []
+        if label is not None:
+            pairs.append((self.label, label))
+        pairs.extend(sorted(extra.items()))
+        if not pairs:
+            return ""
+        return "{%s}" % ",".join('%s="%s"' % (k, str(v).replace('"', '\\"'))
+                                 for k, v in pairs)
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.doc),
+                 "# TYPE %s %s" % (self.name, self.kind)]
+        for label, counts in sorted(self.collect().items()):
+            lines.extend(self.render_values(label, counts))
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, label=None, n=1):
+        values = self.shard()
+        try:
+            values[label][0] += n
+        except KeyError:
+            values[label] = [n]
+
+    def value(self, label=None):
+        return self.collect().get(label, [0])[0]
+
+    def render_values(self, label, counts):
+        return ["%s%s %s" % (self.name, self.labels(label), counts[0])]
+
+
+class Timer(object):
+    __slots__ = ("histogram", "label", "started")
+
+    def __init__(self, histogram, label):
+        self.histogram = histogram
+        self.label = label
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.time() - self.started, self.label)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, doc, label=None, buckets=LATENCY_BUCKETS, **kwargs):
+        super(Histogram, self).__init__(name, doc, label, **kwargs)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, label=None):
+        values = self.shard()
+        counts = values.get(label)
+        if counts is None:
+            # one slot per bucket, +Inf bucket and the sum
+            counts = values[label] = [0] * (len(self.buckets) + 2)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def time(self, label=None):
+        return Timer(self, label)
+
+    def count(self, label=None):
+        return sum(self.collect().get(label, [0])[:-1])
+
+    def render_values(self, label, counts):
+        lines = []
+        cumulative = 0
+        for le, n in zip(self.buckets + ("+Inf",), counts):
+            cumulative += n
+            lines.append("%s_bucket%s %d" % (self.name, self.labels(label, le=le),
+                                             cumulative))
+        lines.append("%s_sum%s %r" % (self.name, self.labels(label), counts[-1]))
+        lines.append("%s_count%s %d" % (self.name, self.labels(label), cumulative))
+        return lines
+
+
+def render(registry=REGISTRY):
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
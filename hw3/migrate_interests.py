@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Rewrites i:<cid> values stored as JSON lists in the compact interests
+# encoding, keeping their TTL.
+#
+#   python migrate_interests.py --store redis://localhost:6379/0
+#   python migrate_interests.py --store redis://localhost:6379/0 --dry-run
+#
+# Run it once the API reads the new encoding. Values written between the
+# read and the rewrite of a batch are overwritten, so run it after the
+# writers are switched to the new encoding too; their values are skipped.
+
+import time
+import json
+import logging
+from optparse import OptionParser
+import interests
+from store import Store, StoreError, backend_from_url
+
+
+def migrate_batch(store, keys, stats, dry_run=False):
+    items = []
+    for key, value, ttl in store.dump(keys):
+        stats["scanned"] += 1
+        if not value or value[0] != "[":
+            stats["encoded"] += 1
+            continue
+        try:
+            names = json.loads(value)
+            encoded = interests.encode(names)
+        except (ValueError, KeyError):
+            # kept as JSON, decode() still reads it
+            stats["skipped"] += 1
+            continue
+        if ttl is not None and ttl < 1:
+            # about to expire, and a zero TTL would mean no expiry at all
+            stats["skipped"] += 1
+            continue
+        stats["bytes_before"] += len(value)
+        stats["bytes_after"] += len(encoded)
+        items.append((key, encoded, ttl))
+    if items and not dry_run:
+        store.set_many(items)
+    stats["migrated"] += len(items)
+
+
+def migrate(store, batch_size=1000, dry_run=False, match="i:*"):
+    stats = {"scanned": 0, "migrated": 0, "encoded": 0, "skipped": 0,
+             "failed": 0, "bytes_before": 0, "bytes_after": 0}
+    cursor = 0
+    while True:
+        cursor, keys = store.scan(cursor, match, batch_size)
+        if keys:
+            try:
+                migrate_batch(store, keys, stats, dry_run)
+            except StoreError as e:
+                logging.error("Batch of %d keys failed: %s" % (len(keys), e))
+                stats["failed"] += len(keys)
+        if not cursor:
+            return stats
+
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("--store", action="store", default="redis://localhost:6379/0")
+    op.add_option("--store-timeout", action="store", type=float, default=5.0)
+    op.add_option("--batch-size", action="store", type=int, default=1000)
+    op.add_option("--dry-run", action="store_true", default=False,
+                  help="count what would be rewritten without writing")
+    op.add_option("-l", "--log", action="store", default=None)
+    (opts, args) = op.parse_args()
+    logging.basicConfig(filename=opts.log,
+                        level=logging.INFO,
+                        format='[%(asctime)s] %(levelname).1s %(message)s',
+                        datefmt='%Y.%m.%d %H:%M:%S')
+    store = Store(backend_from_url(opts.store, opts.store_timeout),
+                  timeout=opts.store_timeout)
+    started = time.time()
+    stats = migrate(store, opts.batch_size, opts.dry_run)
+    logging.info("Migrated %(migrated)d of %(scanned)d values, %(encoded)d already "
+                 "encoded, %(skipped)d skipped, %(failed)d failed" % stats)
+    logging.info("Values took %(bytes_before)d bytes, now %(bytes_after)d" % stats)
+    logging.info("Done in %.1fs" % (time.time() - started))
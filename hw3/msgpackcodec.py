@@ -0,0 +1,192 @@
+# MessagePack packb/unpackb: the msgpack C extension when it is installed,
+# else the pure Python codec below. Both pack str and unicode as msgpack
+# str and unpack msgpack str to unicode, like json does, so requests
+# validate the same either way.
+
+import struct
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+def py_packb(obj):
+    chunks = []
+    pack(obj, chunks.append)
+    return "".join(chunks)
+
+
+def pack(obj, write):
+    try:
+        packer = PACKERS[type(obj)]
+    except KeyError:
+        for cls, packer in PACKERS.items():
+            if isinstance(obj, cls):
+                break
+        else:
+            raise TypeError("can't pack %r" % type(obj))
+    packer(obj, write)
+
+
+def pack_constant(obj, write):
+    write("\xc0" if obj is None else "\xc3" if obj else "\xc2")
+
+
+def pack_float(obj, write):
+    write(struct.pack(">Bd", 0xcb, obj))
+
+
+def pack_str(obj, write):
+    if isinstance(obj, unicode):
+        obj = obj.encode("utf-8")
+    n = len(obj)
+    if n < 32:
+        write(chr(0xa0 | n))
+    elif n < 0x100:
+        write(struct.pack(">BB", 0xd9, n))
+    elif n < 0x10000:
+        write(struct.pack(">BH", 0xda, n))
+    else:
+        write(struct.pack(">BI", 0xdb, n))
+    write(obj)
+
+
+def pack_array(obj, write):
+    pack_header(len(obj), 0x90, 0xdc, write)
+    for item in obj:
+        pack(item, write)
+
+
+def pack_map(obj, write):
+    pack_header(len(obj), 0x80, 0xde, write)
+    for key, value in obj.iteritems():
+        pack(key, write)
+        pack(value, write)
+
+
+def pack_int(n, write):
+    if 0 <= n < 0x80:
+        write(chr(n))
+    elif -32 <= n < 0:
+        write(chr(n & 0xff))
+    elif 0 <= n < 0x100:
+        write(struct.pack(">BB", 0xcc, n))
+    elif 0 <= n < 0x10000:
+        write(struct.pack(">BH", 0xcd, n))
+    elif 0 <= n < 0x100000000:
+        write(struct.pack(">BI", 0xce, n))
+    elif 0 <= n < 0x10000000000000000:
+        write(struct.pack(">BQ", 0xcf, n))
+    elif -0x80 <= n < 0:
+        write(struct.pack(">Bb", 0xd0, n))
+    elif -0x8000 <= n < 0:
+        write(struct.pack(">Bh", 0xd1, n))
+    elif -0x80000000 <= n < 0:
+        write(struct.pack(">Bi", 0xd2, n))
+    elif -0x8000000000000000 <= n < 0:
+        write(struct.pack(">Bq", 0xd3, n))
+    else:
+        raise ValueError("integer out of range: %d" % n)
+
+
+def pack_header(n, fix, base, write):
+    # fixarray/fixmap, 16 or 32 bit length
+    if n < 16:
+        write(chr(fix | n))
+    elif n < 0x10000:
+        write(struct.pack(">BH", base, n))
+    else:
+        write(struct.pack(">BI", base + 1, n))
+
+
+PACKERS = {
+    type(None): pack_constant, bool: pack_constant,
+    int: pack_int, long: pack_int, float: pack_float,
+    str: pack_str, unicode: pack_str,
+    list: pack_array, tuple: pack_array, dict: pack_map,
+}
+
+# type byte: (struct format of what follows it, kind)
+FORMATS = {
+    0xc4: (">B", "bin"), 0xc5: (">H", "bin"), 0xc6: (">I", "bin"),
+    0xca: (">f", "value"), 0xcb: (">d", "value"),
+    0xcc: (">B", "value"), 0xcd: (">H", "value"),
+    0xce: (">I", "value"), 0xcf: (">Q", "value"),
+    0xd0: (">b", "value"), 0xd1: (">h", "value"),
+    0xd2: (">i", "value"), 0xd3: (">q", "value"),
+    0xd9: (">B", "str"), 0xda: (">H", "str"), 0xdb: (">I", "str"),
+    0xdc: (">H", "array"), 0xdd: (">I", "array"),
+    0xde: (">H", "map"), 0xdf: (">I", "map"),
+}
+CONSTANTS = {0xc0: None, 0xc2: False, 0xc3: True}
+
+
+def py_unpackb(data):
+    try:
+        obj, offset = unpack(data, 0)
+    except (IndexError, struct.error):
+        raise ValueError("truncated msgpack data")
+    if offset != len(data):
+        raise ValueError("extra data after msgpack object")
+    return obj
+
+
+def unpack(data, offset):
+    b = ord(data[offset])
+    offset += 1
+    if b < 0x80:
+        return b, offset
+    if b >= 0xe0:
+        return b - 0x100, offset
+    if 0xa0 <= b < 0xc0:
+        n, kind = b & 0x1f, "str"
+    elif 0x90 <= b < 0xa0:
+        n, kind = b & 0x0f, "array"
+    elif 0x80 <= b < 0x90:
+        n, kind = b & 0x0f, "map"
+    elif b in CONSTANTS:
+        return CONSTANTS[b], offset
+    elif b in FORMATS:
+        fmt, kind = FORMATS[b]
+        n = struct.unpack_from(fmt, data, offset)[0]
+        offset += struct.calcsize(fmt)
+        if kind == "value":
+            return n, offset
+    else:
+        raise ValueError("unsupported msgpack type 0x%02x" % b)
+    if kind == "str" or kind == "bin":
+        end = offset + n
+        if end > len(data):
+            raise ValueError("truncated msgpack data")
+        value = data[offset:end]
+        return (value.decode("utf-8") if kind == "str" else value), end
+    if kind == "array":
+        items = []
+        for _ in xrange(n):
+            item, offset = unpack(data, offset)
+            items.append(item)
+        return items, offset
+    result = {}
+    for _ in xrange(n):
+        key, offset = unpack(data, offset)
+        result[key], offset = unpack(data, offset)
+    return result, offset
+
+
+def no_ext(code, data):
+    raise ValueError("unsupported msgpack ext type %d" % code)
+
+
+if msgpack is not None:
+    def packb(obj):
+        return msgpack.packb(obj, use_bin_type=False)
+
+    def unpackb(data):
+        try:
+            return msgpack.unpackb(data, raw=False, ext_hook=no_ext)
+        except Exception as e:
+            raise ValueError(str(e))
+else:
+    packb = py_packb
+    unpackb = py_unpackb
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Scores a known list of clients ahead of time and writes the uid:<md5>
+# entries to the store, so peak traffic is served from a warm cache.
+#
+#   python prewarm.py clients.jsonl --store redis://localhost:6379/0
+#   python prewarm.py clients.csv -j 8 --results scores.jsonl
+#
+# Input is JSON lines or CSV with a header, one client per line, with the
+# online_score arguments (phone, email, first_name, last_name, birthday,
+# gender). Lines are validated exactly like online_score requests.
+
+import csv
+import json
+import time
+import logging
+import multiprocessing
+from optparse import OptionParser
+import api
+import scoring
+from store import Store, StoreError, backend_from_url
+
+
+def read_lines(path, fmt):
+    with open(path) as f:
+        if fmt == "csv":
+            for lineno, row in enumerate(csv.DictReader(f), 2):
+                yield lineno, row
+        else:
+            for lineno, line in enumerate(f, 1):
+                if line.strip():
+                    yield lineno, line
+
+
+def chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def parse(record):
+    if isinstance(record, basestring):
+        return json.loads(record)
+    # csv values are all strings; empty cells are missing fields
+    record = dict((k, v) for k, v in record.items() if v not in ("", None))
+    if record.get("gender", "").isdigit():
+        record["gender"] = int(record["gender"])
+    return record
+
+
+def score_chunk(chunk):
+    # runs in a worker process: (lineno, key, score, error) per line
+    results = []
+    for lineno, record in chunk:
+        try:
+            arguments = api.OnlineScoreRequest(parse(record))
+        except ValueError:
+            results.append((lineno, None, None, "invalid json"))
+            continue
+        if not arguments.is_valid():
+            results.append((lineno, None, None, arguments.errfmt()))
+            continue
+        key = scoring.score_key(arguments.first_name, arguments.last_name,
+                                arguments.birthday)
+        score = scoring.calculate_score(arguments.phone, arguments.email,
+                                        arguments.birthday, arguments.gender,
+                                        arguments.first_name, arguments.last_name)
+        results.append((lineno, key, score, None))
+    return results
+
+
+def prewarm(lines, store, processes=None, chunk_size=1000, write_batch=1000,
+            ttl=scoring.SCORE_TTL, results=None):
+    stats = {"lines": 0, "scored": 0, "invalid": 0, "written": 0, "failed": 0}
+    pending = {}
+
+    def write():
+        try:
+            store.set_many([(k, v, ttl) for k, v in pending.items()])
+            stats["written"] += len(pending)
+        except StoreError as e:
+            logging.error("Bulk write of %d keys failed: %s" % (len(pending), e))
+            stats["failed"] += len(pending)
+        pending.clear()
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        for chunk_results in pool.imap(score_chunk, chunks(lines, chunk_size)):
+            for lineno, key, score, error in chunk_results:
+                stats["lines"] += 1
+                if error:
+                    stats["invalid"] += 1
+                    record = {"line": lineno, "error": error}
+                else:
+                    stats["scored"] += 1
+                    pending[key] = score
+                    record = {"line": lineno, "key": key, "score": score}
+                if results:
+                    results.write(json.dumps(record) + "\n")
+            if len(pending) >= write_batch:
+                write()
+        if pending:
+            write()
+    finally:
+        pool.close()
+        pool.join()
+    return stats
+
+
+if __name__ == "__main__":
+    op = OptionParser(usage="%prog [options] FILE")
+    op.add_option("--format", action="store", choices=["jsonl", "csv"], default=None,
+                  help="input format, guessed from the extension by default")
+    op.add_option("--store", action="store", default="redis://localhost:6379/0")
+    op.add_option("--store-timeout", action="store", type=float, default=5.0)
+    op.add_option("-j", "--processes", action="store", type=int, default=None)
+    op.add_option("--chunk-size", action="store", type=int, default=1000)
+    op.add_option("--write-batch", action="store", type=int, default=1000)
+    op.add_option("--ttl", action="store", type=int, default=scoring.SCORE_TTL)
+    op.add_option("--results", action="store", default=None,
+                  help="write per line scores and errors to this file")
+    op.add_option("-l", "--log", action="store", default=None)
+    (opts, args) = op.parse_args()
+    if len(args) != 1:
+        op.error("input file is required")
+    logging.basicConfig(filename=opts.log,
+                        level=logging.INFO,
+                        format='[%(asctime)s] %(levelname).1s %(message)s',
+                        datefmt='%Y.%m.%d %H:%M:%S')
+    fmt = opts.format or ("csv" if args[0].endswith(".csv") else "jsonl")
+    store = Store(backend_from_url(opts.store, opts.store_timeout),
+                  timeout=opts.store_timeout)
+    results = open(opts.results, "w") if opts.results else None
+    started = time.time()
+    try:
+        stats = prewarm(read_lines(args[0], fmt), store, opts.processes,
+                        opts.chunk_size, opts.write_batch, opts.ttl, results)
+    finally:
+        if results:
+            results.close()
+    logging.info("Scored %(scored)d of %(lines)d lines, %(invalid)d invalid, "
+                 "%(written)d keys written, %(failed)d failed" % stats)
+    logging.info("Done in %.1fs" % (time.time() - started))
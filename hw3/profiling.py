@@ -0,0 +1,109 @@
+import os
+import sys
+import time
+import thread
+import threading
+from collections import defaultdict
+
+
+def frame_name(code):
+    return "%s:%d:%s" % (os.path.basename(code.co_filename), code.co_firstlineno,
+                         code.co_name)
+
+
+class StackSampler(object):
+    # Wakes up every `interval` seconds and records the stack of every
+    # thread that is inside `root` (the request handler), trimmed to start
+    # there. Nothing runs between samples, so request threads are only
+    # slowed down while a profile is being taken, and by very little.
+
+    def __init__(self, root, interval=0.005, max_depth=100):
+        self.root = root
+        self.interval = interval
+        self.max_depth = max_depth
+        self.stacks = defaultdict(int)
+        self.samples = 0
+
+    def sample(self, skip):
+        for ident, frame in sys._current_frames().items():
+            if ident == skip:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(frame.f_code)
+                if frame.f_code is self.root:
+                    break
+                frame = frame.f_back
+            if frame is None:
+                continue
+            stack.reverse()
+            self.stacks[tuple(stack[:self.max_depth])] += 1
+            self.samples += 1
+
+    def run(self, seconds, requests=None, count_requests=None):
+        # until `seconds` passed or `requests` more were counted
+        me = thread.get_ident()
+        deadline = time.time() + seconds
+        if requests:
+            target = count_requests() + requests
+        while time.time() < deadline:
+            self.sample(me)
+            if requests and count_requests() >= target:
+                break
+            time.sleep(self.interval)
+
+    def folded(self):
+        # flamegraph.pl input: frame;frame;frame count
+        return ["%s %d" % (";".join(frame_name(c) for c in stack), n)
+                for stack, n in sorted(self.stacks.items(), key=lambda i: -i[1])]
+
+    def functions(self):
+        # samples with the function on top of the stack and anywhere on it
+        own, total = defaultdict(int), defaultdict(int)
+        for stack, n in self.stacks.items():
+            own[stack[-1]] += n
+            for code in set(stack):
+                total[code] += n
+        return sorted(({"function": frame_name(c), "self": own[c], "total": n}
+                       for c, n in total.items()),
+                      key=lambda f: (-f["self"], -f["total"]))
+
+
+class Profiler(object):
+    # Takes one profile at a time. Profiles are returned aggregated and, if
+    # `save_dir` is set, saved there in folded format as well.
+
+    def __init__(self, save_dir=None, max_seconds=300, limit=50):
+        self.save_dir = save_dir
+        self.max_seconds = max_seconds
+        self.limit = limit
+        self.lock = threading.Lock()
+
+    def profile(self, root, seconds, requests=None, count_requests=None,
+                interval=0.005):
+        # None while another profile is running
+        if not self.lock.acquire(False):
+            return None
+        try:
+            started = time.time()
+            sampler = StackSampler(root, interval)
+            sampler.run(min(seconds, self.max_seconds), requests, count_requests)
+            folded = sampler.folded()
+            report = {
+                "seconds": round(time.time() - started, 3),
+                "samples": sampler.samples,
+                "stacks": folded[:self.limit],
+                "functions": sampler.functions()[:self.limit],
+            }
+            if self.save_dir:
+                report["saved"] = self.save(folded)
+            return report
+        finally:
+            self.lock.release()
+
+    def save(self, folded):
+        path = os.path.join(self.save_dir, "profile-%s-%d.folded" % (
+            time.strftime("%Y%m%d%H%M%S"), os.getpid()))
+        with open(path, "w") as f:
+            f.write("\n".join(folded) + "\n")
+        return path
@@ -0,0 +1,117 @@
+import threading
+from admission import REJECTED, worker_share
+from store import CACHE, CACHE_STRATEGIES
+
+DEFAULT_DEADLINE = 5.0
+
+
+class MethodPolicy(object):
+    # How calls of one method are run:
+    #   deadline         seconds a call may take unless the client asks for
+    #                    another (X-Request-Timeout)
+    #   store_timeout    timeout of each store call, instead of the store's
+    #   cache            score cache strategy, one of CACHE_STRATEGIES
+    #   max_size         most items the method's size argument may have
+    #   max_concurrency  calls of the method handled at once
+    # store_timeout=None, max_size=0 and max_concurrency=0 mean no limit.
+    __slots__ = ("deadline", "store_timeout", "cache", "max_size",
+                 "max_concurrency", "active", "lock")
+    settings = ("deadline", "store_timeout", "cache", "max_size", "max_concurrency")
+
+    def __init__(self, deadline=DEFAULT_DEADLINE, store_timeout=None, cache=CACHE,
+                 max_size=0, max_concurrency=0):
+        self.active = 0
+        self.lock = threading.Lock()
+        self.update(deadline=deadline, store_timeout=store_timeout, cache=cache,
+                    max_size=max_size, max_concurrency=max_concurrency)
+
+    def update(self, **settings):
+        for name, value in settings.items():
+            if name not in self.settings:
+                raise ValueError("unknown method policy setting %r" % name)
+            if name == "cache":
+                if value not in CACHE_STRATEGIES:
+                    raise ValueError("cache must be one of %s" %
+                                     ", ".join(CACHE_STRATEGIES))
+            elif value is None:
+                if name != "store_timeout":
+                    raise ValueError("%s can't be null" % name)
+            elif (isinstance(value, bool) or not isinstance(value, (int, long, float)) or
+                    value < 0 or (value == 0 and name in ("deadline", "store_timeout"))):
+                raise ValueError("%s is not a valid %s" % (value, name))
+            setattr(self, name, value)
+
+    def enter(self):
+        if not self.max_concurrency:
+            return True
+        with self.lock:
+            if self.active >= self.max_concurrency:
+                REJECTED.inc("method_concurrency")
+                return False
+            self.active += 1
+        return True
+
+    def leave(self):
+        if not self.max_concurrency:
+            return
+        with self.lock:
+            self.active -= 1
+
+
+class Method(object):
+    # A registered method: its handler, created once, and its policy.
+    # Handlers name the argument `max_size` applies to in `size_argument`.
+    __slots__ = ("name", "handler", "request_type", "size_argument", "policy",
+                 "batchable")
+
+    def __init__(self, name, handler, policy, batchable=True):
+        self.name = name
+        self.handler = handler
+        self.request_type = handler.request_type
+        self.size_argument = getattr(handler, "size_argument", None)
+        self.policy = policy
+        self.batchable = batchable
+
+    def validate(self, raw):
+        # (arguments, None) or (None, error message)
+        arguments = self.request_type(raw)
+        if not arguments.is_valid():
+            return None, arguments.errfmt()
+        max_size = self.policy.max_size
+        if max_size and self.size_argument:
+            size = len(getattr(arguments, self.size_argument) or ())
+            if size > max_size:
+                return None, "%s has %d items, at most %d allowed" % (
+                    self.size_argument, size, max_size)
+        return arguments, None
+
+
+class MethodRegistry(object):
+    # Methods by name. Everything a call needs is prepared at registration,
+    # so dispatching one is a dict lookup.
+
+    def __init__(self):
+        self.methods = {}
+
+    def register(self, name, handler_cls, batchable=True, **policy):
+        method = Method(name, handler_cls(), MethodPolicy(**policy), batchable)
+        self.methods[name] = method
+        return method
+
+    def get(self, name):
+        return self.methods.get(name)
+
+    def configure(self, policies):
+        # {method: {setting: value}}, e.g. loaded from --method-policies
+        for name, settings in policies.items():
+            method = self.methods.get(name)
+            if method is None:
+                raise ValueError("unknown method %r" % name)
+            method.policy.update(**dict((str(k), v) for k, v in settings.items()))
+
+    def split(self, workers):
+        # per method concurrency caps of one of `workers` processes
+        for method in self.methods.values():
+            policy = method.policy
+            policy.update(max_concurrency=int(worker_share(policy.max_concurrency,
+                                                           workers, 1)))
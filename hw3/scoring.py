@@ -1,20 +1,132 @@
 import hashlib
-import json
+import threading
+import metrics
+import tracing
+import interests
+from store import DeadlineExceeded
 
+STORE_SECONDS = metrics.Histogram(
+    "scoring_store_seconds", "Store call latency", "op")
+SCORE_CACHE = metrics.Counter(
+    "scoring_score_cache_total", "get_score cache lookups by result", "result")
+COALESCED = metrics.Counter(
+    "scoring_coalesced_total", "Lookups served by another in-flight lookup", "kind")
 
-def get_score(store, phone, email, birthday=None, gender=None,
-              first_name=None, last_name=None):
+
+class Flight(object):
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    # Concurrent calls for the same key wait for the first one and share
+    # its result (or exception) instead of repeating the store round trip.
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.lock = threading.Lock()
+        self.flights = {}
+
+    def do(self, key, func, *args):
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+        if not leader:
+            COALESCED.inc(self.kind)
+            with tracing.span("coalesced_wait", kind=self.kind):
+                flight.done.wait()
+            if isinstance(flight.error, DeadlineExceeded):
+                # the leader ran out of its own time, not ours
+                return func(*args)
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = func(*args)
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+        return flight.result
+
+    def do_many(self, keys, func):
+        # {key: result}: keys already in flight are waited for, the rest
+        # are looked up by one func(keys) call, which returns results in
+        # the order of its keys, for anyone asking for them meanwhile
+        led = []
+        followed = []
+        with self.lock:
+            for key in keys:
+                flight = self.flights.get(key)
+                if flight is None:
+                    led.append((key, Flight()))
+                    self.flights[key] = led[-1][1]
+                else:
+                    followed.append((key, flight))
+        results = {}
+        if led:
+            led_keys = [key for key, _ in led]
+            try:
+                results.update(zip(led_keys, func(led_keys)))
+            except Exception as e:
+                for _, flight in led:
+                    flight.error = e
+                raise
+            finally:
+                with self.lock:
+                    for key, _ in led:
+                        del self.flights[key]
+                for key, flight in led:
+                    flight.result = results.get(key)
+                    flight.done.set()
+        if not followed:
+            return results
+        COALESCED.inc(self.kind, len(followed))
+        retry = []
+        with tracing.span("coalesced_wait", kind=self.kind, keys=len(followed)):
+            for key, flight in followed:
+                flight.done.wait()
+                if isinstance(flight.error, DeadlineExceeded):
+                    # the leader ran out of its own time, not ours
+                    retry.append(key)
+                elif flight.error is not None:
+                    raise flight.error
+                else:
+                    results[key] = flight.result
+        if retry:
+            results.update(zip(retry, func(retry)))
+        return results
+
+
+score_flights = SingleFlight("score")
+interests_flights = SingleFlight("interests")
+
+
+# cache for 60 minutes
+SCORE_TTL = 60 * 60
+
+
+def score_key(first_name=None, last_name=None, birthday=None):
     key_parts = [
         first_name or "",
         last_name or "",
         birthday.strftime("%Y%m%d") if birthday is not None else "",
     ]
-    key = "uid:" + hashlib.md5("".join(key_parts)).hexdigest()
-    # try get from cache,
-    # fallback to heavy calculation in case of cache miss
-    score = store.cache_get(key) or 0
-    if score:
-        return score
+    return "uid:" + hashlib.md5("".join(key_parts)).hexdigest()
+
+
+def calculate_score(phone, email, birthday=None, gender=None,
+                    first_name=None, last_name=None):
+    score = 0
     if phone:
         score += 1.5
     if email:
@@ -23,11 +135,67 @@ def get_score(store, phone, email, birthday=None, gender=None,
         score += 1.5
     if first_name and last_name:
         score += 0.5
-    # cache for 60 minutes
-    store.cache_set(key, score,  60 * 60)
     return score
 
 
+def get_score(store, phone, email, birthday=None, gender=None,
+              first_name=None, last_name=None):
+    key = score_key(first_name, last_name, birthday)
+    return score_flights.do(key, compute_score, store, key, phone, email, birthday,
+                            gender, first_name, last_name)
+
+
+def compute_score(store, key, phone, email, birthday, gender, first_name, last_name):
+    # try get from cache,
+    # fallback to heavy calculation in case of cache miss
+    with STORE_SECONDS.time("cache_get"), tracing.span("store.cache_get", key=key):
+        score = store.cache_get(key)
+    # redis hands the cached number back as a string
+    try:
+        score = float(score or 0)
+    except (TypeError, ValueError):
+        score = 0
+    if score:
+        SCORE_CACHE.inc("hit")
+        return score
+    SCORE_CACHE.inc("miss")
+    score = calculate_score(phone, email, birthday, gender, first_name, last_name)
+    with STORE_SECONDS.time("cache_set"), tracing.span("store.cache_set", key=key):
+        store.cache_set(key, score, SCORE_TTL)
+    return score
+
+
+def interests_key(cid):
+    return "i:%s" % cid
+
+
 def get_interests(store, cid):
-    r = store.get("i:%s" % cid)
-    return json.loads(r) if r else []
+    key = interests_key(cid)
+    return interests_flights.do(key, load_interests, store, key)
+
+
+def load_interests(store, key):
+    with STORE_SECONDS.time("get"), tracing.span("store.get", key=key):
+        r = store.get(key)
+    return interests.decode(r)
+
+
+def get_interests_many(store, cids):
+    # {cid: interests} with one store round trip per store node; keys
+    # other requests are already reading are waited for instead
+    keys = dict((cid, interests_key(cid)) for cid in cids)
+    values = interests_flights.do_many(set(keys.values()),
+                                       lambda unique: load_interests_many(store, unique))
+    return dict((cid, values[key]) for cid, key in keys.items())
+
+
+def load_interests_many(store, keys):
+    with STORE_SECONDS.time("get_many"), tracing.span("store.get_many", keys=len(keys)):
+        values = store.get_many(keys)
+    return [interests.decode(value) for value in values]
+
+
+def set_interests(store, cid, names, expires=None):
+    key = interests_key(cid)
+    with STORE_SECONDS.time("set"), tracing.span("store.set", key=key):
+        store.set(key, interests.encode(names), expires)
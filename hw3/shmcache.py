@@ -0,0 +1,130 @@
+import os
+import mmap
+import fcntl
+import struct
+import hashlib
+import threading
+import time
+
+MAGIC = "SCORESHM1"
+HEADER = struct.Struct("<16sQQ")
+# seq, key digest, value, expires
+SLOT = struct.Struct("<Q16sdd")
+EMPTY_KEY = "\0" * 16
+
+
+class SharedCache(object):
+    # Fixed size hash table of numbers in a memory mapped file, shared by
+    # every process that opens the same path (the workers of one host).
+    #
+    # Open addressing with linear probing over at most `max_probe` slots;
+    # a full probe window evicts its entry that expires first. Keys are
+    # stored as their md5 digest.
+    #
+    # Readers don't lock: each slot carries a sequence number that writers
+    # make odd while they write, and a read is retried if the number was
+    # odd or changed under it. Writers lock the stripes covering the probe
+    # window, with a thread lock for this process and an fcntl byte range
+    # lock on the file for the others.
+
+    def __init__(self, path, slots=1 << 20, stripes=256, max_probe=8, ttl=60):
+        self.path = path
+        self.max_probe = max_probe
+        # lifetime of entries copied from the store, whose ttl is unknown
+        self.ttl = ttl
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        size = HEADER.size + slots * SLOT.size
+        # the first process to get here sizes and stamps the file
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, 1, 0)
+        try:
+            if os.fstat(self.fd).st_size == 0:
+                os.ftruncate(self.fd, size)
+                os.write(self.fd, HEADER.pack(MAGIC, slots, stripes))
+            self.map = mmap.mmap(self.fd, 0)
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, 0)
+        magic, self.slots, self.stripes = HEADER.unpack_from(self.map, 0)
+        if magic.rstrip("\0") != MAGIC:
+            raise ValueError("%s is not a shared cache file" % path)
+        # stripes are runs of adjacent slots, so a probe window spans two
+        # stripes at most
+        self.stripe_size = max(max_probe, -(-self.slots // self.stripes))
+        self.locks = [threading.Lock() for _ in range(self.stripes)]
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
+
+    def slot(self, digest):
+        return struct.unpack_from("<Q", digest)[0] % self.slots
+
+    def offset(self, index):
+        return HEADER.size + (index % self.slots) * SLOT.size
+
+    def read(self, index):
+        offset = self.offset(index)
+        for _ in range(10):
+            seq, key, value, expires = SLOT.unpack_from(self.map, offset)
+            if not seq & 1 and struct.unpack_from("<Q", self.map, offset)[0] == seq:
+                return key, value, expires
+        return None, None, None
+
+    def write(self, index, key, value, expires):
+        offset = self.offset(index)
+        # odd even if a writer died halfway and left it odd
+        seq = struct.unpack_from("<Q", self.map, offset)[0] + 1 | 1
+        struct.pack_into("<Q", self.map, offset, seq)
+        SLOT.pack_into(self.map, offset, seq, key, value, expires)
+        struct.pack_into("<Q", self.map, offset, seq + 1)
+
+    def get(self, key):
+        digest = hashlib.md5(key).digest()
+        home = self.slot(digest)
+        now = time.time()
+        for i in range(home, home + self.max_probe):
+            stored, value, expires = self.read(i)
+            if stored == EMPTY_KEY:
+                return None
+            if stored == digest:
+                return value if expires > now else None
+        return None
+
+    def set(self, key, value, expires):
+        # `expires` is a ttl in seconds, like the store's
+        digest = hashlib.md5(key).digest()
+        home = self.slot(digest)
+        now = time.time()
+        stripes = sorted(set(((home + i) % self.slots) // self.stripe_size
+                             for i in (0, self.max_probe - 1)))
+        self.lock(stripes)
+        try:
+            # the key's own slot, else the first free or expired one, else
+            # the one that expires first
+            target = free = oldest = None
+            for i in range(home, home + self.max_probe):
+                stored, _, stored_expires = self.read(i)
+                if stored == digest:
+                    target = i
+                    break
+                if free is None and (stored == EMPTY_KEY or stored_expires <= now):
+                    free = i
+                if stored == EMPTY_KEY:
+                    break
+                if oldest is None or stored_expires < oldest[1]:
+                    oldest = (i, stored_expires)
+            if target is None:
+                target = free if free is not None else oldest[0]
+            self.write(target, digest, float(value), now + expires)
+        finally:
+            self.unlock(stripes)
+
+    def lock(self, stripes):
+        for stripe in stripes:
+            self.locks[stripe].acquire()
+            # lock bytes past the end of the table, not its data
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, 1, len(self.map) + stripe)
+
+    def unlock(self, stripes):
+        for stripe in reversed(stripes):
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, len(self.map) + stripe)
+            self.locks[stripe].release()
@@ -0,0 +1,175 @@
+import os
+import fcntl
+import gzip
+import json
+import time
+import heapq
+import logging
+import operator
+import threading
+import metrics
+
+SNAPSHOT_ENTRIES = metrics.Counter(
+    "scoring_cache_snapshot_entries_total", "Cache snapshot entries by outcome",
+    "outcome")
+
+VERSION = 1
+
+
+class CacheSnapshot(object):
+    # Counts reads per key and writes the hottest `max_entries` keys, with
+    # their remaining TTL, to a gzipped JSON lines file on close and every
+    # `interval` seconds. On start the previous snapshot is loaded back in
+    # a background thread; restored keys never overwrite keys that live
+    # traffic has already written.
+    #
+    # Workers of one supervisor share the path: all of them restore, but
+    # only the one holding a lock on `path`.lock saves. Another worker
+    # takes over the lock when that one exits.
+
+    def __init__(self, path, max_entries=100000, interval=300, batch_size=1000,
+                 max_hits=None):
+        self.path = path
+        self.max_entries = max_entries
+        self.interval = interval
+        self.batch_size = batch_size
+        # keys counted between saves, beyond which the cold ones are dropped
+        self.max_hits = max_hits or 4 * max_entries
+        self.hits = {}
+        # full hit dicts swapped out by touch, trimmed by the worker
+        self.overflow = []
+        self.lock_fd = None
+        self.stopped = threading.Event()
+        self.wakeup = threading.Event()
+        self.worker = None
+        self.store = None
+        self.restored = None
+
+    def touch(self, key):
+        # racy on purpose: a lost increment doesn't change what is hot
+        hits = self.hits
+        hits[key] = hits.get(key, 0) + 1
+        if len(hits) > self.max_hits and self.hits is hits:
+            # start counting afresh and leave the sorting to the worker
+            self.hits = {}
+            self.overflow.append(hits)
+            self.wakeup.set()
+
+    def trim(self):
+        # folds the hottest keys of the swapped out dicts back into hits
+        while self.overflow:
+            full = self.overflow.pop()
+            top = heapq.nlargest(self.max_entries, full.items(), key=operator.itemgetter(1))
+            hits = self.hits
+            for key, n in top:
+                hits[key] = hits.get(key, 0) + n
+
+    def hottest(self):
+        self.trim()
+        hits = self.hits
+        top = heapq.nlargest(self.max_entries, hits.items(), key=operator.itemgetter(1))
+        # halve the counts, so keys that went cold eventually drop out
+        self.hits = dict((k, n // 2) for k, n in top if n > 1)
+        return [k for k, _ in top]
+
+    def is_writer(self):
+        if self.lock_fd is not None:
+            return True
+        fd = os.open(self.path + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            os.close(fd)
+            return False
+        self.lock_fd = fd
+        return True
+
+    def save(self):
+        if not self.is_writer():
+            return 0
+        entries = []
+        keys = self.hottest()
+        for i in range(0, len(keys), self.batch_size):
+            entries.extend(self.store.dump(keys[i:i + self.batch_size]))
+        now = time.time()
+        tmp = "%s.%d.tmp" % (self.path, os.getpid())
+        with gzip.open(tmp, "wb") as f:
+            f.write(json.dumps({"version": VERSION, "saved": now}) + "\n")
+            for key, value, ttl in entries:
+                expires = now + ttl if ttl is not None else None
+                f.write(json.dumps([key, value, expires]) + "\n")
+        os.rename(tmp, self.path)
+        SNAPSHOT_ENTRIES.inc("saved", len(entries))
+        return len(entries)
+
+    def load(self):
+        stats = {"total": 0, "restored": 0, "expired": 0}
+        if not os.path.exists(self.path):
+            return stats
+        with gzip.open(self.path, "rb") as f:
+            header = json.loads(f.readline())
+            if header.get("version") != VERSION:
+                logging.error("Unsupported cache snapshot version: %s" % header)
+                return stats
+            batch = []
+            for line in f:
+                key, value, expires = json.loads(line)
+                stats["total"] += 1
+                ttl = expires - time.time() if expires is not None else None
+                if ttl is not None and ttl <= 0:
+                    stats["expired"] += 1
+                    continue
+                batch.append((key, value, ttl))
+                if len(batch) >= self.batch_size:
+                    self.store.set_many(batch, only_missing=True)
+                    stats["restored"] += len(batch)
+                    batch = []
+                    self.trim()
+            if batch:
+                self.store.set_many(batch, only_missing=True)
+                stats["restored"] += len(batch)
+        return stats
+
+    def run(self):
+        try:
+            started = time.time()
+            self.restored = self.load()
+            SNAPSHOT_ENTRIES.inc("restored", self.restored["restored"])
+            SNAPSHOT_ENTRIES.inc("expired", self.restored["expired"])
+            logging.info("Restored %(restored)d of %(total)d cached entries "
+                         "(%(expired)d expired)" % self.restored +
+                         " in %.2fs" % (time.time() - started))
+        except Exception:
+            logging.exception("Cache snapshot restore failed")
+        next_save = time.time() + self.interval
+        while not self.stopped.is_set():
+            self.wakeup.wait(max(0, next_save - time.time()))
+            self.wakeup.clear()
+            self.trim()
+            if self.stopped.is_set() or time.time() < next_save:
+                continue
+            next_save += self.interval
+            try:
+                self.save()
+            except Exception:
+                logging.exception("Cache snapshot save failed")
+
+    def start(self, store):
+        self.store = store
+        self.worker = threading.Thread(target=self.run, name="cache-snapshot")
+        self.worker.daemon = True
+        self.worker.start()
+
+    def close(self):
+        if self.worker:
+            self.stopped.set()
+            self.wakeup.set()
+            self.worker.join()
+            self.worker = None
+        try:
+            self.save()
+        except Exception:
+            logging.exception("Cache snapshot save failed")
+        if self.lock_fd is not None:
+            os.close(self.lock_fd)
+            self.lock_fd = None
@@ -0,0 +1,755 @@
+import time
+import bisect
+import random
+import struct
+import fnmatch
+import hashlib
+import threading
+import logging
+import urlparse
+from collections import OrderedDict
+import metrics
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+STORE_ERRORS = metrics.Counter(
+    "scoring_store_errors_total", "Failed or rejected store calls", "reason")
+CACHE_LOOKUPS = metrics.Counter(
+    "scoring_store_cache_hits_total", "Cache hits by where they were found",
+    "source")
+CACHE_WRITES = metrics.Counter(
+    "scoring_store_cache_writes_total", "Write-behind cache writes by outcome",
+    "outcome")
+
+# score cache strategies: read it and write misses back, skip reading it
+# but write fresh values, or leave it alone
+CACHE = "cache"
+REFRESH = "refresh"
+BYPASS = "bypass"
+CACHE_STRATEGIES = (CACHE, REFRESH, BYPASS)
+
+
+class StoreError(Exception):
+    pass
+
+
+class StoreTimeout(StoreError):
+    pass
+
+
+class StoreUnavailable(StoreError):
+    pass
+
+
+class DeadlineExceeded(StoreTimeout):
+    # the request ran out of time, the store isn't to blame
+    pass
+
+
+class MemoryBackend(object):
+    # In-process stand-in for the key-value server. Every call sleeps for
+    # `latency` plus up to `jitter` seconds; a call slower than its timeout
+    # gives up after the timeout, like a socket read would.
+
+    def __init__(self, latency=0.0, jitter=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.data = {}
+        self.lock = threading.Lock()
+
+    def delay(self, timeout):
+        delay = self.latency + (random.uniform(0, self.jitter) if self.jitter else 0)
+        if timeout is not None and delay > timeout:
+            time.sleep(timeout)
+            raise StoreTimeout("store call timed out after %ss" % timeout)
+        if delay:
+            time.sleep(delay)
+
+    def get(self, key, timeout=None):
+        self.delay(timeout)
+        with self.lock:
+            value, expires = self.data.get(key, (None, None))
+            if expires is not None and expires <= time.time():
+                del self.data[key]
+                return None
+        return value
+
+    def get_many(self, keys, timeout=None):
+        self.delay(timeout)
+        now = time.time()
+        values = []
+        with self.lock:
+            for key in keys:
+                value, expires = self.data.get(key, (None, None))
+                if expires is not None and expires <= now:
+                    del self.data[key]
+                    value = None
+                values.append(value)
+        return values
+
+    def set(self, key, value, expires=None, timeout=None):
+        self.delay(timeout)
+        with self.lock:
+            self.data[key] = (value, time.time() + expires if expires else None)
+
+    def set_many(self, items, timeout=None, only_missing=False):
+        self.delay(timeout)
+        now = time.time()
+        with self.lock:
+            for key, value, expires in items:
+                if only_missing and key in self.data:
+                    continue
+                self.data[key] = (value, now + expires if expires else None)
+
+    def dump(self, keys, timeout=None):
+        # (key, value, seconds to live or None) for keys that are present
+        self.delay(timeout)
+        now = time.time()
+        entries = []
+        with self.lock:
+            for key in keys:
+                value, expires = self.data.get(key, (None, None))
+                if value is None:
+                    continue
+                if expires is None:
+                    entries.append((key, value, None))
+                elif expires > now:
+                    entries.append((key, value, expires - now))
+        return entries
+
+    def scan(self, cursor, match=None, count=1000, timeout=None):
+        # like redis SCAN: (next cursor, keys), next cursor 0 when done
+        self.delay(timeout)
+        with self.lock:
+            keys = sorted(self.data)
+        keys = keys[cursor:cursor + count]
+        cursor = cursor + count if len(keys) == count else 0
+        if match:
+            keys = [k for k in keys if fnmatch.fnmatchcase(k, match)]
+        return cursor, keys
+
+
+# timeout of the store call the current thread is making
+call_timeouts = threading.local()
+
+if redis is not None:
+    class TimeoutConnection(redis.Connection):
+        # redis-py sets socket timeouts per connection; this one applies the
+        # timeout of the call being made before sending it, so a call waits
+        # no longer than its own budget
+        def send_packed_command(self, *args, **kwargs):
+            timeout = getattr(call_timeouts, "timeout", None) or self.socket_timeout
+            if not self._sock:
+                self.socket_connect_timeout = timeout
+                self.connect()
+            self._sock.settimeout(timeout)
+            return super(TimeoutConnection, self).send_packed_command(*args, **kwargs)
+
+
+class RedisBackend(object):
+    def __init__(self, host="localhost", port=6379, db=0, timeout=1.0,
+                 max_connections=None):
+        if redis is None:
+            raise StoreError("redis package is not installed")
+        # every backend has a connection pool of its own
+        pool = redis.ConnectionPool(connection_class=TimeoutConnection,
+                                    host=host, port=port, db=db,
+                                    socket_timeout=timeout,
+                                    socket_connect_timeout=timeout,
+                                    max_connections=max_connections)
+        self.client = redis.StrictRedis(connection_pool=pool)
+
+    def command(self, timeout, func, *args, **kwargs):
+        call_timeouts.timeout = timeout
+        try:
+            return func(*args, **kwargs)
+        except redis.TimeoutError as e:
+            raise StoreTimeout(str(e))
+        except redis.RedisError as e:
+            raise StoreError(str(e))
+        finally:
+            call_timeouts.timeout = None
+
+    def get(self, key, timeout=None):
+        return self.command(timeout, self.client.get, key)
+
+    def get_many(self, keys, timeout=None):
+        return self.command(timeout, self.client.mget, keys)
+
+    def set(self, key, value, expires=None, timeout=None):
+        self.command(timeout, self.client.set, key, value,
+                     ex=int(expires) if expires else None)
+
+    def set_many(self, items, timeout=None, only_missing=False):
+        pipe = self.client.pipeline(transaction=False)
+        for key, value, expires in items:
+            pipe.set(key, value, ex=int(expires) if expires else None, nx=only_missing)
+        self.command(timeout, pipe.execute)
+
+    def dump(self, keys, timeout=None):
+        pipe = self.client.pipeline(transaction=False)
+        for key in keys:
+            pipe.get(key)
+            pipe.pttl(key)
+        replies = self.command(timeout, pipe.execute)
+        entries = []
+        for key, value, pttl in zip(keys, replies[::2], replies[1::2]):
+            # pttl is -1 for keys without expiry and -2 for missing ones
+            if value is not None and pttl != -2:
+                entries.append((key, value, pttl / 1000.0 if pttl >= 0 else None))
+        return entries
+
+    def scan(self, cursor, match=None, count=1000, timeout=None):
+        return self.command(timeout, self.client.scan, cursor, match=match, count=count)
+
+
+class HashRing(object):
+    # Consistent hashing: every node owns `vnodes` points on the ring per
+    # unit of weight and a key belongs to the first point after its hash,
+    # so adding or removing a node only moves keys to or from that node.
+
+    def __init__(self, vnodes=160):
+        self.vnodes = vnodes
+        self.weights = {}
+        self.points = ([], [])
+
+    @staticmethod
+    def hash(key):
+        return struct.unpack_from(">Q", hashlib.md5(key).digest())[0]
+
+    def add(self, node, weight=1):
+        self.weights[node] = weight
+        self.build()
+
+    def remove(self, node):
+        del self.weights[node]
+        self.build()
+
+    def build(self):
+        points = sorted((self.hash("%s-%d" % (node, i)), node)
+                        for node, weight in self.weights.items()
+                        for i in range(max(1, int(round(weight * self.vnodes)))))
+        # swapped in as a whole, so lookups never see half a ring
+        self.points = ([h for h, _ in points], [node for _, node in points])
+
+    def node(self, key):
+        hashes, nodes = self.points
+        if not hashes:
+            raise StoreUnavailable("no store nodes")
+        return nodes[bisect.bisect(hashes, self.hash(key)) % len(hashes)]
+
+
+class ShardedBackend(object):
+    # Spreads keys over several backends with a HashRing. Calls with many
+    # keys are split by node and the nodes are queried in parallel.
+    #
+    # Every node has a breaker of its own, so a dead node only fails the
+    # calls that need it; the Store in front should get a breaker that
+    # never opens. `timeout` is the nodes' own, which tells a node's
+    # timeouts from ones cut short by a deadline (see Store).
+    # seconds a fan-out waits past its timeout for the nodes to give up
+    fanout_slack = 0.05
+
+    def __init__(self, nodes=(), vnodes=160, timeout=1.0, breaker=None):
+        self.ring = HashRing(vnodes)
+        self.backends = {}
+        self.breakers = {}
+        self.timeout = timeout
+        # makes the breaker of each node
+        self.new_breaker = breaker or CircuitBreaker
+        for name, backend, weight in nodes:
+            self.add_node(name, backend, weight)
+
+    def add_node(self, name, backend, weight=1):
+        self.backends[name] = backend
+        self.breakers[name] = self.new_breaker()
+        self.ring.add(name, weight)
+
+    def remove_node(self, name):
+        self.ring.remove(name)
+        self.breakers.pop(name)
+        return self.backends.pop(name)
+
+    def backend(self, key):
+        return self.backends[self.ring.node(key)]
+
+    def group(self, items, key=lambda item: item):
+        # node -> [(position in items, item)]
+        groups = OrderedDict()
+        for i, item in enumerate(items):
+            groups.setdefault(self.ring.node(key(item)), []).append((i, item))
+        return groups
+
+    def node_call(self, node, method, args, kwargs):
+        breaker = self.breakers[node]
+        if not breaker.allow():
+            STORE_ERRORS.inc("rejected")
+            raise StoreUnavailable("store node %s circuit is open" % node)
+        timeout = kwargs.get("timeout")
+        blame = timeout is None or timeout >= self.timeout * Store.deadline_share
+        return breaker.guard(getattr(self.backends[node], method), args, kwargs, blame)
+
+    def fanout(self, calls, timeout):
+        # runs (node, method, args, kwargs) calls in parallel, the first one
+        # on this thread and the others on threads of their own, so
+        # concurrent requests never queue for each other; results in order
+        results = [None] * len(calls)
+        errors = []
+
+        def run(i):
+            try:
+                results[i] = self.node_call(*calls[i])
+            except Exception as e:
+                errors.append((i, e))
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(1, len(calls))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        started = time.time()
+        run(0)
+        for thread in threads:
+            # nodes time out on their own, this only bounds the whole wait
+            thread.join(None if timeout is None else
+                        max(0, started + timeout + self.fanout_slack - time.time()))
+            if thread.is_alive():
+                raise StoreTimeout("store call timed out after %ss" % timeout)
+        if errors:
+            raise min(errors)[1]
+        return results
+
+    def get(self, key, timeout=None):
+        return self.node_call(self.ring.node(key), "get", (key,), {"timeout": timeout})
+
+    def set(self, key, value, expires=None, timeout=None):
+        return self.node_call(self.ring.node(key), "set", (key, value, expires),
+                              {"timeout": timeout})
+
+    def get_many(self, keys, timeout=None):
+        groups = self.group(keys)
+        results = self.fanout([(node, "get_many", ([key for _, key in group],),
+                                {"timeout": timeout})
+                               for node, group in groups.items()], timeout)
+        values = [None] * len(keys)
+        for group, group_values in zip(groups.values(), results):
+            for (i, _), value in zip(group, group_values):
+                values[i] = value
+        return values
+
+    def set_many(self, items, timeout=None, only_missing=False):
+        groups = self.group(items, key=lambda item: item[0])
+        self.fanout([(node, "set_many", ([item for _, item in group],),
+                      {"timeout": timeout, "only_missing": only_missing})
+                     for node, group in groups.items()], timeout)
+
+    def dump(self, keys, timeout=None):
+        groups = self.group(keys)
+        results = self.fanout([(node, "dump", ([key for _, key in group],),
+                                {"timeout": timeout})
+                               for node, group in groups.items()], timeout)
+        return [entry for entries in results for entry in entries]
+
+    def scan(self, cursor, match=None, count=1000, timeout=None):
+        # node by node; the cursor holds the node's index and its own cursor
+        nodes = sorted(self.backends)
+        if not nodes:
+            return 0, []
+        node_cursor, i = divmod(cursor, len(nodes))
+        node_cursor, keys = self.node_call(nodes[i], "scan", (node_cursor, match, count),
+                                           {"timeout": timeout})
+        if node_cursor:
+            return node_cursor * len(nodes) + i, keys
+        return (i + 1 if i + 1 < len(nodes) else 0), keys
+
+
+def backend_from_url(url, timeout=1.0, max_connections=None, breaker=None):
+    # memory:// or redis://host:port/db, or several of them separated by
+    # commas to shard keys over them, each with an optional ?weight=N;
+    # `breaker` makes the breakers of the shards
+    urls = [u.strip() for u in url.split(",") if u.strip()]
+    if len(urls) > 1:
+        nodes = []
+        for node_url in urls:
+            name, _, query = node_url.partition("?")
+            weight = float(urlparse.parse_qs(query).get("weight", ["1"])[0])
+            nodes.append((name, backend_from_url(name, timeout, max_connections),
+                          weight))
+        return ShardedBackend(nodes, timeout=timeout, breaker=breaker)
+    parsed = urlparse.urlparse(urls[0] if urls else url)
+    if parsed.scheme == "memory":
+        return MemoryBackend()
+    if parsed.scheme == "redis":
+        return RedisBackend(parsed.hostname or "localhost", parsed.port or 6379,
+                            int(parsed.path.strip("/") or 0), timeout,
+                            max_connections)
+    raise ValueError("unsupported store url: %s" % url)
+
+
+class CircuitBreaker(object):
+    # closed: calls go through, consecutive failures are counted;
+    # open: calls are rejected at once until reset_timeout passes;
+    # half_open: a single probe call decides whether to close or reopen.
+    # max_failures=0 never opens.
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, max_failures=5, reset_timeout=5.0):
+        self.max_failures = max_failures
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        if self.state == self.CLOSED:
+            return True
+        with self.lock:
+            if (self.state == self.OPEN and
+                    time.time() - self.opened_at >= self.reset_timeout):
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def success(self):
+        if self.state == self.CLOSED and not self.failures:
+            return
+        with self.lock:
+            self.failures = 0
+            self.state = self.CLOSED
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or (self.max_failures and
+                                                self.failures >= self.max_failures):
+                self.state = self.OPEN
+                self.opened_at = time.time()
+
+    def release(self):
+        # a call that tells nothing about the store; if it was the probe,
+        # the next call probes again
+        if self.state != self.HALF_OPEN:
+            return
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+
+    def guard(self, func, args, kwargs, blame_timeout=True):
+        # runs an allowed call and settles the breaker by how it went;
+        # every way out settles it, or a half-open probe would keep it
+        # half-open for good. StoreTimeout is a failure only if
+        # `blame_timeout`, otherwise it tells nothing about the store.
+        outcome = self.release
+        try:
+            result = func(*args, **kwargs)
+            outcome = self.success
+        except StoreTimeout:
+            if blame_timeout:
+                outcome = self.failure
+            raise
+        except StoreError:
+            outcome = self.failure
+            raise
+        finally:
+            outcome()
+        return result
+
+
+class WriteBehind(object):
+    # Cache writes are queued and a background worker flushes them to the
+    # backend in pipelined batches, so a cache miss doesn't pay for the
+    # write round trip. A repeated write to a queued key replaces it. When
+    # the queue is full the new write is dropped, or the oldest one if
+    # drop_oldest is set. close() flushes whatever is left.
+
+    def __init__(self, max_size=10000, batch_size=100, interval=0.01,
+                 drop_oldest=False):
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.interval = interval
+        self.drop_oldest = drop_oldest
+        self.pending = OrderedDict()
+        self.cond = threading.Condition()
+        self.closed = False
+        self.worker = None
+
+    def start(self, flush):
+        self.flush = flush
+        self.worker = threading.Thread(target=self.run, name="write-behind")
+        self.worker.daemon = True
+        self.worker.start()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        if self.worker:
+            self.worker.join()
+            self.worker = None
+
+    def put(self, key, value, expires):
+        with self.cond:
+            if key not in self.pending and len(self.pending) >= self.max_size:
+                CACHE_WRITES.inc("dropped")
+                if not self.drop_oldest:
+                    return False
+                self.pending.popitem(last=False)
+            self.pending[key] = (value, expires)
+            CACHE_WRITES.inc("queued")
+            if len(self.pending) >= self.batch_size:
+                self.cond.notify()
+        return True
+
+    def get(self, key):
+        item = self.pending.get(key)
+        return item[0] if item else None
+
+    def take(self):
+        items = []
+        while self.pending and len(items) < self.batch_size:
+            key, (value, expires) = self.pending.popitem(last=False)
+            items.append((key, value, expires))
+        return items
+
+    def run(self):
+        while True:
+            with self.cond:
+                if len(self.pending) < self.batch_size and not self.closed:
+                    self.cond.wait(self.interval)
+                items = self.take()
+                done = self.closed and not self.pending
+            if items:
+                try:
+                    self.flush(items)
+                    CACHE_WRITES.inc("flushed", len(items))
+                except StoreError:
+                    CACHE_WRITES.inc("failed", len(items))
+                except Exception:
+                    logging.exception("Write-behind flush failed")
+                    CACHE_WRITES.inc("failed", len(items))
+            if done:
+                return
+
+
+class Store(object):
+    # get() is for data the caller can't do without and raises StoreError;
+    # the cache_* calls are best effort and only raise DeadlineExceeded,
+    # which isn't worth carrying on after. Every call is
+    # bounded by `timeout`, and while the breaker is open calls fail
+    # without touching the backend at all. cache_* calls go to
+    # `local_cache`, a SharedCache of this host's workers, first.
+    # A timed out call is blamed on the request's deadline, not on the
+    # store, only if the deadline left it less than this share of its
+    # timeout.
+    deadline_share = 0.5
+    # Best effort cache_* calls get at most this share of what is left of
+    # the deadline, so the request has time to carry on without them.
+    cache_share = 0.5
+
+    def __init__(self, backend, timeout=1.0, breaker=None, write_behind=None,
+                 snapshot=None, local_cache=None):
+        self.backend = backend
+        self.timeout = timeout
+        self.breaker = breaker or CircuitBreaker()
+        self.write_behind = write_behind
+        self.snapshot = snapshot
+        self.local_cache = local_cache
+        if write_behind:
+            write_behind.start(self.set_many)
+        if snapshot:
+            snapshot.start(self)
+
+    def close(self):
+        if self.write_behind:
+            self.write_behind.close()
+        if self.snapshot:
+            self.snapshot.close()
+        if self.local_cache:
+            self.local_cache.close()
+
+    def call(self, method, *args, **kwargs):
+        # with a deadline the call only gets what is left of it; `timeout`
+        # replaces the store's own
+        deadline = kwargs.pop("deadline", None)
+        share = kwargs.pop("share", 1.0)
+        limit = kwargs.pop("timeout", None) or self.timeout
+        timeout = limit
+        if deadline is not None:
+            left = deadline - time.time()
+            if left <= 0:
+                STORE_ERRORS.inc("deadline")
+                raise DeadlineExceeded("request deadline exceeded")
+            timeout = min(timeout, left * share)
+        if not self.breaker.allow():
+            STORE_ERRORS.inc("rejected")
+            raise StoreUnavailable("store circuit is open")
+        kwargs["timeout"] = timeout
+        blame = timeout >= limit * share * self.deadline_share
+        try:
+            return self.breaker.guard(method, args, kwargs, blame)
+        except StoreTimeout:
+            if not blame:
+                STORE_ERRORS.inc("deadline")
+                raise DeadlineExceeded("request deadline exceeded")
+            STORE_ERRORS.inc("timeout")
+            if deadline is not None and time.time() >= deadline:
+                raise DeadlineExceeded("request deadline exceeded")
+            raise
+        except StoreError:
+            STORE_ERRORS.inc("error")
+            raise
+
+    def get(self, key, deadline=None, timeout=None):
+        value = self.call(self.backend.get, key, deadline=deadline, timeout=timeout)
+        if self.snapshot and value is not None:
+            self.snapshot.touch(key)
+        return value
+
+    def get_many(self, keys, deadline=None, timeout=None):
+        # values of keys, in order, in one round trip per node
+        if not keys:
+            return []
+        values = self.call(self.backend.get_many, keys, deadline=deadline,
+                           timeout=timeout)
+        if self.snapshot:
+            for key, value in zip(keys, values):
+                if value is not None:
+                    self.snapshot.touch(key)
+        return values
+
+    def set(self, key, value, expires=None, deadline=None, timeout=None):
+        return self.call(self.backend.set, key, value, expires, deadline=deadline,
+                         timeout=timeout)
+
+    def set_many(self, items, only_missing=False):
+        # items are (key, value, expires) triples, written in one round trip
+        return self.call(self.backend.set_many, items, only_missing=only_missing)
+
+    def dump(self, keys):
+        return self.call(self.backend.dump, keys)
+
+    def scan(self, cursor, match=None, count=1000):
+        return self.call(self.backend.scan, cursor, match, count)
+
+    def cache_get(self, key, deadline=None, timeout=None):
+        # best effort, except that a passed deadline is raised
+        value = self.cache_peek(key)
+        if value is not None:
+            return value
+        try:
+            value = self.call(self.backend.get, key, deadline=deadline,
+                              timeout=timeout, share=self.cache_share)
+        except DeadlineExceeded:
+            # only its share of the deadline may have run out
+            if deadline is None or time.time() >= deadline:
+                raise
+            return None
+        except StoreError:
+            return None
+        if self.snapshot and value is not None:
+            self.snapshot.touch(key)
+        return self.cache_found(key, value)
+
+    def cache_peek(self, key):
+        # what cache_get finds without going to the backend
+        if self.local_cache:
+            value = self.local_cache.get(key)
+            if value is not None:
+                CACHE_LOOKUPS.inc("local")
+                if self.snapshot:
+                    self.snapshot.touch(key)
+                return value
+        if self.write_behind:
+            value = self.write_behind.get(key)
+            if value is not None:
+                CACHE_LOOKUPS.inc("pending")
+                return value
+        return None
+
+    def cache_found(self, key, value):
+        # a cache entry read from the backend
+        if value is not None:
+            CACHE_LOOKUPS.inc("store")
+            if self.local_cache:
+                self.local_set(key, value, self.local_cache.ttl)
+        return value
+
+    def get_many_cached(self, keys, cache_keys, deadline=None, timeout=None):
+        # get_many of `keys` and cache_get of `cache_keys` in one backend
+        # round trip; unlike cache_get, a failure raises StoreError
+        cached = {}
+        missing = []
+        for key in cache_keys:
+            value = self.cache_peek(key)
+            if value is None:
+                missing.append(key)
+            else:
+                cached[key] = value
+        values = self.get_many(list(keys) + missing, deadline=deadline, timeout=timeout)
+        for key, value in zip(missing, values[len(keys):]):
+            cached[key] = self.cache_found(key, value)
+        return values[:len(keys)], [cached[key] for key in cache_keys]
+
+    def local_set(self, key, value, expires):
+        try:
+            self.local_cache.set(key, value, expires)
+        except (TypeError, ValueError):
+            # only numbers fit
+            pass
+
+    def cache_set(self, key, value, expires, deadline=None, timeout=None):
+        if self.local_cache:
+            self.local_set(key, value, expires)
+        if self.write_behind:
+            self.write_behind.put(key, value, expires)
+            return
+        try:
+            self.call(self.backend.set, key, value, expires, deadline=deadline,
+                      timeout=timeout, share=self.cache_share)
+        except StoreError:
+            pass
+
+
+class DeadlineStore(object):
+    # The store as one request sees it: every call is bounded by what is
+    # left of the request's deadline and raises DeadlineExceeded once it
+    # has passed. `timeout` and `cache` are the method's store timeout and
+    # score cache strategy.
+
+    def __init__(self, store, deadline, timeout=None, cache=CACHE):
+        self.store = store
+        self.deadline = deadline
+        self.timeout = timeout
+        self.cache = cache
+
+    def get(self, key):
+        return self.store.get(key, deadline=self.deadline, timeout=self.timeout)
+
+    def get_many(self, keys):
+        return self.store.get_many(keys, deadline=self.deadline, timeout=self.timeout)
+
+    def set(self, key, value, expires=None):
+        return self.store.set(key, value, expires, deadline=self.deadline,
+                              timeout=self.timeout)
+
+    def cache_get(self, key):
+        if self.cache != CACHE:
+            return None
+        return self.store.cache_get(key, deadline=self.deadline, timeout=self.timeout)
+
+    def get_many_cached(self, keys, cache_keys):
+        if self.cache != CACHE:
+            return self.get_many(keys), [None] * len(cache_keys)
+        return self.store.get_many_cached(keys, cache_keys, deadline=self.deadline,
+                                          timeout=self.timeout)
+
+    def cache_set(self, key, value, expires):
+        if self.cache == BYPASS:
+            return
+        return self.store.cache_set(key, value, expires, deadline=self.deadline,
+                                    timeout=self.timeout)
@@ -0,0 +1,92 @@
+import time
+import signal
+import logging
+import subprocess
+
+
+class Supervisor(object):
+    # Runs `workers` copies of the worker command, all listening on the same
+    # port with SO_REUSEPORT, and keeps that many alive.
+    #   SIGHUP           rolling restart: one worker at a time, a fresh one
+    #                    is started before the old one is asked to stop
+    #   SIGTERM, SIGINT  graceful stop of every worker
+    # Workers are stopped with SIGTERM: they stop accepting, finish
+    # in-flight requests and exit. Workers that die on their own are
+    # restarted, after `restart_delay` if they crashed right after start.
+
+    def __init__(self, argv, workers, graceful_timeout=30, startup_delay=1.0,
+                 restart_delay=1.0, poll_interval=0.2):
+        self.argv = argv
+        self.nworkers = workers
+        self.graceful_timeout = graceful_timeout
+        self.startup_delay = startup_delay
+        self.restart_delay = restart_delay
+        self.poll_interval = poll_interval
+        self.workers = {}
+        self.reload_requested = False
+        self.stop_requested = False
+
+    def spawn(self):
+        process = subprocess.Popen(self.argv)
+        self.workers[process.pid] = (process, time.time())
+        logging.info("Started worker %s" % process.pid)
+        return process
+
+    def stop_worker(self, process):
+        if process.poll() is None:
+            process.send_signal(signal.SIGTERM)
+        deadline = time.time() + self.graceful_timeout
+        while process.poll() is None and time.time() < deadline:
+            time.sleep(self.poll_interval)
+        if process.poll() is None:
+            logging.error("Worker %s didn't stop in time, killing it" % process.pid)
+            process.kill()
+            process.wait()
+        self.workers.pop(process.pid, None)
+
+    def reap(self):
+        for pid, (process, started) in self.workers.items():
+            if process.poll() is None:
+                continue
+            del self.workers[pid]
+            logging.error("Worker %s exited with %s" % (pid, process.returncode))
+            if time.time() - started < self.startup_delay:
+                time.sleep(self.restart_delay)
+            if not self.stop_requested:
+                self.spawn()
+
+    def rolling_restart(self):
+        logging.info("Rolling restart of %d workers" % len(self.workers))
+        for process, _ in self.workers.values():
+            fresh = self.spawn()
+            time.sleep(self.startup_delay)
+            if fresh.poll() is not None:
+                logging.error("New worker %s failed to start, restart aborted"
+                              % fresh.pid)
+                return
+            self.stop_worker(process)
+
+    def on_reload(self, signum, frame):
+        self.reload_requested = True
+
+    def on_stop(self, signum, frame):
+        self.stop_requested = True
+
+    def run(self):
+        signal.signal(signal.SIGHUP, self.on_reload)
+        signal.signal(signal.SIGTERM, self.on_stop)
+        signal.signal(signal.SIGINT, self.on_stop)
+        for _ in range(self.nworkers):
+            self.spawn()
+        while not self.stop_requested:
+            if self.reload_requested:
+                self.reload_requested = False
+                self.rolling_restart()
+            self.reap()
+            time.sleep(self.poll_interval)
+        logging.info("Stopping %d workers" % len(self.workers))
+        for process, _ in self.workers.values():
+            if process.poll() is None:
+                process.send_signal(signal.SIGTERM)
+        for process, _ in self.workers.values():
+            self.stop_worker(process)
@@ -1,5 +1,68 @@
+import os
+import sys
+import signal
+import shutil
+import json
+import time
+import datetime
+import hashlib
+import socket
+import StringIO
+import httplib
+import tempfile
+import zlib
+import threading
 import unittest
 import api
+import metrics
+import tracing
+import profiling
+import multiprocessing
+import scoring
+import store
+import loadtest
+import prewarm
+import interests
+import migrate_interests
+import msgpackcodec
+from admission import Admission, TokenBucket
+from registry import MethodPolicy
+from supervisor import Supervisor
+from snapshot import CacheSnapshot
+from shmcache import SharedCache
+from accesslog import AccessLog
+from store import (Store, StoreError, StoreTimeout, StoreUnavailable,
+                   DeadlineExceeded, DeadlineStore, MemoryBackend, CircuitBreaker,
+                   WriteBehind, HashRing, ShardedBackend, backend_from_url, CACHE_WRITES)
+
+
+class FakeStore(object):
+    def __init__(self, data=None):
+        self.data = data or {}
+        self.calls = []
+        self.round_trips = 0
+
+    def get(self, key, deadline=None, timeout=None):
+        self.calls.append(key)
+        self.round_trips += 1
+        return self.data.get(key)
+
+    def get_many(self, keys, deadline=None, timeout=None):
+        self.calls.extend(keys)
+        self.round_trips += 1
+        return [self.data.get(key) for key in keys]
+
+    def get_many_cached(self, keys, cache_keys, deadline=None, timeout=None):
+        values = self.get_many(list(keys) + list(cache_keys))
+        return values[:len(keys)], values[len(keys):]
+
+    def cache_get(self, key, deadline=None, timeout=None):
+        self.calls.append(key)
+        self.round_trips += 1
+        return self.data.get(key)
+
+    def cache_set(self, key, value, expires, deadline=None, timeout=None):
+        self.data[key] = value
 
 
 class TestSuite(unittest.TestCase):
@@ -13,10 +76,1339 @@ class TestSuite(unittest.TestCase):
                                   self.context,
                                   self.store)
 
+    def set_valid_auth(self, request):
+        msg = request.get("account", "") + request.get("login", "") + api.SALT
+        request["token"] = hashlib.sha512(msg).hexdigest()
+
     def test_empty_request(self):
         _, code = self.get_response({})
         self.assertEqual(api.INVALID_REQUEST, code)
 
+    def test_cleaned_request(self):
+        request = api.OnlineScoreRequest({"first_name": "a", "last_name": "b",
+                                          "birthday": "1.2.2000"})
+        self.assertTrue(request.is_valid())
+        self.assertFalse(hasattr(request, "__dict__"))
+        self.assertEqual(None, request.phone)
+        self.assertEqual(datetime.datetime(2000, 2, 1), request.birthday)
+
+        request = api.OnlineScoreRequest({"first_name": 1, "birthday": "31.02.2000"})
+        self.assertFalse(request.is_valid())
+        self.assertEqual(["birthday field validation error",
+                          "first_name field validation error"], sorted(request.errors))
+
+    def test_birthday_age_limit(self):
+        field = api.BirthDayField()
+        today = datetime.date.today()
+        youngest_too_old = today - datetime.timedelta(days=71 * 365)
+        self.assertTrue(field.parse_validate(
+            (youngest_too_old + datetime.timedelta(days=1)).strftime("%d.%m.%Y")))
+        self.assertRaises(ValueError, field.parse_validate,
+                          youngest_too_old.strftime("%d.%m.%Y"))
+
+    def test_batch_request(self):
+        self.store = FakeStore({"i:1": '["cars"]', "i:2": '["pets", "tv"]'})
+        calls = [
+            {"method": "clients_interests", "arguments": {"client_ids": [1, 2]}},
+            {"method": "online_score", "arguments": {"phone": "79175002040"}},
+            {"method": "clients_interests", "arguments": {"client_ids": [2, 3]}},
+            {"method": "unknown", "arguments": {}},
+            {"method": "online_score",
+             "arguments": {"first_name": "a", "last_name": "b"}},
+            {"method": "online_score",
+             "arguments": {"first_name": "a", "last_name": "b"}},
+        ]
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "batch",
+                   "arguments": {"requests": calls}}
+        self.set_valid_auth(request)
+        response, code = self.get_response(request)
+        self.assertEqual(api.OK, code)
+        self.assertEqual([api.OK, api.INVALID_REQUEST, api.OK, api.NOT_FOUND,
+                          api.OK, api.OK], [r["code"] for r in response])
+        self.assertEqual({1: ["cars"], 2: ["pets", "tv"]}, response[0]["response"])
+        self.assertEqual({2: ["pets", "tv"], 3: []}, response[2]["response"])
+        self.assertEqual(response[4], response[5])
+        self.assertEqual(len(self.store.calls), len(set(self.store.calls)))
+        # every call's keys are read in one round trip
+        self.assertEqual(1, self.store.round_trips)
+
+    def test_batch_round_trips(self):
+        backend = MemoryBackend()
+        backend.set("i:1", '["cars"]')
+        backend.set(scoring.score_key("a", "b"), "2.5")
+        trips = []
+        get, get_many = backend.get, backend.get_many
+        backend.get = lambda *args, **kwargs: trips.append("get") or get(*args, **kwargs)
+        backend.get_many = lambda *args, **kwargs: (trips.append("get_many") or
+                                                    get_many(*args, **kwargs))
+        self.store = Store(backend, write_behind=WriteBehind(interval=60))
+        self.store.cache_set(scoring.score_key("c", "d"), 1.0, 60)
+        calls = [
+            {"method": "online_score", "arguments": {"first_name": "a", "last_name": "b"}},
+            {"method": "online_score", "arguments": {"first_name": "c", "last_name": "d"}},
+            {"method": "online_score", "arguments": {"first_name": "e", "last_name": "f"}},
+            {"method": "clients_interests", "arguments": {"client_ids": [1, 2]}},
+        ]
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "batch",
+                   "arguments": {"requests": calls}}
+        self.set_valid_auth(request)
+        response, code = self.get_response(request)
+        self.assertEqual(api.OK, code)
+        self.assertEqual([{"score": 2.5}, {"score": 1.0}, {"score": 0.5},
+                          {1: ["cars"], 2: []}], [r["response"] for r in response])
+        self.assertEqual(["get_many"], trips)
+        # the calls fall back to their own reads when the shared one fails
+        self.store.breaker.state = CircuitBreaker.OPEN
+        self.store.breaker.opened_at = time.time()
+        request["arguments"]["requests"] = calls[:3]
+        response, code = self.get_response(request)
+        self.assertEqual(api.OK, code)
+        self.assertEqual([{"score": 0.5}, {"score": 1.0}, {"score": 0.5}],
+                         [r["response"] for r in response])
+        self.store.close()
+
+    def test_batch_with_store_down(self):
+        self.store = Store(MemoryBackend())
+        self.store.breaker.state = CircuitBreaker.OPEN
+        self.store.breaker.opened_at = time.time()
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "batch",
+                   "arguments": {"requests": [
+                       {"method": "online_score",
+                        "arguments": {"first_name": "a", "last_name": "b"}},
+                       {"method": "clients_interests", "arguments": {"client_ids": [1]}}]}}
+        self.set_valid_auth(request)
+        response, code = self.get_response(request)
+        self.assertEqual(api.OK, code)
+        self.assertEqual([{"response": {"score": 0.5}, "code": api.OK},
+                          {"error": api.ERRORS[api.INTERNAL_ERROR],
+                           "code": api.INTERNAL_ERROR}], response)
+
+    def test_invalid_batch_request(self):
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "batch",
+                   "arguments": {"requests": []}}
+        self.set_valid_auth(request)
+        _, code = self.get_response(request)
+        self.assertEqual(api.INVALID_REQUEST, code)
+
+
+class AdmissionTest(unittest.TestCase):
+    def setUp(self):
+        self.request = {"account": "horns&hoofs", "login": "h&f",
+                        "method": "online_score", "arguments": {"phone": "79175002040"}}
+        self.request["token"] = api.user_token("horns&hoofs", "h&f")
+
+    def tearDown(self):
+        api.admission = Admission()
+
+    def get_code(self):
+        _, code = api.method_handler({"body": self.request, "headers": {}}, {}, None)
+        return code
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=2, burst=2, now=0)
+        self.assertTrue(bucket.take(0))
+        self.assertTrue(bucket.take(0))
+        self.assertFalse(bucket.take(0.25))
+        self.assertTrue(bucket.take(0.5))
+        self.assertFalse(bucket.take(0.5))
+
+    def test_rate_limit(self):
+        api.admission = Admission(rate=0.001, burst=2, limits={"other": (0, 0)})
+        self.assertEqual([api.INVALID_REQUEST, api.INVALID_REQUEST,
+                          api.TOO_MANY_REQUESTS],
+                         [self.get_code() for _ in range(3)])
+        self.request["account"] = "other"
+        self.request["token"] = api.user_token("other", "h&f")
+        self.assertEqual([api.INVALID_REQUEST] * 3, [self.get_code() for _ in range(3)])
+
+    def test_concurrency_limit(self):
+        api.admission = Admission(max_concurrency=1)
+        self.assertTrue(api.admission.enter())
+        self.assertEqual(api.TOO_MANY_REQUESTS, self.get_code())
+        api.admission.leave()
+        self.assertEqual(api.INVALID_REQUEST, self.get_code())
+        self.assertEqual(0, api.admission.active)
+
+    def test_split_among_workers(self):
+        admission = Admission(rate=10, burst=4, limits={"big": (100, 0), "off": (0, 0)},
+                              max_concurrency=6).split(4)
+        self.assertEqual((2.5, 1.0, 1), (admission.rate, admission.burst,
+                                          admission.max_concurrency))
+        self.assertEqual({"big": (25.0, 0), "off": (0, 0)}, admission.limits)
+        self.assertEqual(25.0, admission.bucket("big", 0).burst)
+        unlimited = Admission().split(4)
+        self.assertEqual((0, 0, 0), (unlimited.rate, unlimited.burst,
+                                     unlimited.max_concurrency))
+
+
+class AuthTest(unittest.TestCase):
+    def get_request(self, login, token):
+        request = api.MethodRequest({"account": "horns&hoofs", "login": login,
+                                     "token": token, "method": "online_score",
+                                     "arguments": {}})
+        self.assertTrue(request.is_valid())
+        return request
+
+    def test_auth_cache_eviction(self):
+        cache = api.AuthCache(2)
+        cache.add("a")
+        cache.add("b")
+        self.assertTrue("a" in cache)
+        cache.add("c")
+        self.assertTrue("a" in cache)
+        self.assertFalse("b" in cache)
+        self.assertTrue("c" in cache)
+
+    def test_cached_token(self):
+        token = api.user_token("horns&hoofs", "cached")
+        self.assertTrue(api.check_auth(self.get_request("cached", token)))
+        self.assertTrue(("horns&hoofs", "cached", token) in api.auth_cache)
+        self.assertTrue(api.check_auth(self.get_request("cached", token)))
+        self.assertFalse(api.check_auth(self.get_request("cached", token[:-1])))
+        self.assertFalse(api.check_auth(self.get_request("cached", "")))
+
+    def test_admin_token(self):
+        self.assertTrue(api.check_auth(self.get_request("admin", api.admin_token())))
+        self.assertFalse(api.check_auth(self.get_request(
+            "admin", api.user_token("horns&hoofs", "admin"))))
+        self.assertEqual(api.admin_token(), api.HourlyAdminToken().get())
+
+
+class AccessLogTest(unittest.TestCase):
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def read_records(self):
+        with open(self.filename) as f:
+            return [json.loads(line) for line in f]
+
+    def test_records(self):
+        log = AccessLog(self.filename, body_limit=4, sample_rate=0)
+        log.start()
+        log.log({"request_id": "1", "code": 200, "body": "{}"})
+        log.log({"request_id": "2", "code": 422, "body": '{"login": "h&f"}'})
+        log.log({"request_id": "3", "code": 400, "body": "{}"})
+        log.close()
+        records = self.read_records()
+        self.assertEqual(["2", "3"], [r["request_id"] for r in records])
+        self.assertEqual('{"lo', records[0]["body"])
+        self.assertTrue(records[0]["body_truncated"])
+        self.assertEqual("{}", records[1]["body"])
+
+    def test_full_queue(self):
+        log = AccessLog(self.filename, queue_size=1)
+        log.log({"code": 200})
+        log.log({"code": 200})
+        self.assertEqual(1, log.dropped)
+        log.start()
+        log.close()
+        self.assertEqual(1, len(self.read_records()))
+
+
+class MetricsTest(unittest.TestCase):
+    def test_dead_thread_shards_are_folded(self):
+        counter = metrics.Counter("test_total", "Test", registry=[])
+        for _ in range(2000):
+            thread = threading.Thread(target=counter.inc)
+            thread.start()
+            thread.join()
+        self.assertLessEqual(len(counter.shards), counter.min_prune)
+        self.assertEqual(2000, counter.value())
+
+    def test_histogram_across_threads(self):
+        registry = []
+        histogram = metrics.Histogram("test_seconds", "Test", "stage",
+                                      buckets=(0.1, 1), registry=registry)
+        histogram.observe(0.05, "a")
+        thread = threading.Thread(target=histogram.observe, args=(0.5, "a"))
+        thread.start()
+        thread.join()
+        histogram.observe(5, "b")
+        self.assertEqual(2, histogram.count("a"))
+        # shard of the finished thread is retired on first collect, not lost
+        self.assertEqual(2, histogram.count("a"))
+        lines = metrics.render(registry).splitlines()
+        self.assertIn('test_seconds_bucket{stage="a",le="0.1"} 1', lines)
+        self.assertIn('test_seconds_bucket{stage="a",le="1"} 2', lines)
+        self.assertIn('test_seconds_bucket{stage="b",le="+Inf"} 1', lines)
+        self.assertIn('test_seconds_count{stage="b"} 1', lines)
+
+    def test_score_cache_counters(self):
+        hits = scoring.SCORE_CACHE.value("hit")
+        misses = scoring.SCORE_CACHE.value("miss")
+        store = FakeStore()
+        scoring.get_score(store, "79175002040", "a@b")
+        scoring.get_score(store, "79175002040", "a@b")
+        self.assertEqual(hits + 1, scoring.SCORE_CACHE.value("hit"))
+        self.assertEqual(misses + 1, scoring.SCORE_CACHE.value("miss"))
+
+
+class TracingTest(unittest.TestCase):
+    def names(self, node):
+        return [node["name"]] + sum([self.names(c) for c in node.get("children", [])], [])
+
+    def test_disabled(self):
+        tracer = tracing.Tracer()
+        tracer.start("req")
+        self.assertIs(tracing.NO_SPAN, tracing.span("a"))
+        self.assertIsNone(tracer.finish())
+        tracer = tracing.Tracer(slow_threshold=1e-9, sample_rate=0)
+        tracer.start("req")
+        self.assertIs(tracing.NO_SPAN, tracing.span("a"))
+
+    def test_span_tree(self):
+        tracer = tracing.Tracer(slow_threshold=1e-9)
+        tracer.start("req-1")
+        with tracing.span("a"):
+            with tracing.span("b", key="k"):
+                pass
+        try:
+            with tracing.span("c"):
+                raise ValueError()
+        except ValueError:
+            pass
+        record = tracer.finish(code=200)
+        self.assertEqual("req-1", record["request_id"])
+        self.assertEqual(200, record["code"])
+        a, c = record["children"]
+        self.assertEqual("k", a["children"][0]["key"])
+        self.assertEqual("ValueError", c["error"])
+        self.assertLessEqual(a["start_ms"], c["start_ms"])
+        self.assertIsNone(tracer.finish())
+
+    def test_fast_requests_are_not_logged(self):
+        tracer = tracing.Tracer(slow_threshold=10)
+        tracer.start("req")
+        with tracing.span("a"):
+            pass
+        self.assertIsNone(tracer.finish())
+
+    def test_method_handler_spans(self):
+        tracer = tracing.Tracer(slow_threshold=1e-9)
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score",
+                   "arguments": {"phone": "79175002040", "email": "a@b"}}
+        request["token"] = api.user_token(request["account"], request["login"])
+        tracer.start("req")
+        _, code = api.method_handler({"body": request, "headers": {}}, {}, FakeStore())
+        names = self.names(tracer.finish())
+        self.assertEqual(api.OK, code)
+        self.assertEqual(["request", "validate", "check_auth", "validate_arguments",
+                          "handler", "store.cache_get", "store.cache_set"], names)
+
+
+class ProfilerTest(unittest.TestCase):
+    def test_one_profile_at_a_time(self):
+        profiler = profiling.Profiler()
+        with profiler.lock:
+            self.assertIsNone(profiler.profile(None, 1))
+
+    def test_save(self):
+        def busy():
+            deadline = time.time() + 0.2
+            while time.time() < deadline:
+                pass
+
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        profiler = profiling.Profiler(save_dir=tmpdir)
+        thread = threading.Thread(target=busy)
+        thread.start()
+        report = profiler.profile(busy.func_code, 0.1, interval=0.01)
+        thread.join()
+        self.assertGreater(report["samples"], 0)
+        with open(report["saved"]) as f:
+            lines = f.read().splitlines()
+        self.assertTrue(lines[0].startswith("test.py:"))
+        self.assertEqual(report["samples"], sum(int(l.rsplit(" ", 1)[1]) for l in lines))
+
+
+class StoreTest(unittest.TestCase):
+    def test_timeout(self):
+        store = Store(MemoryBackend(latency=0.05), timeout=0.01)
+        self.assertRaises(StoreError, store.get, "i:1")
+        self.assertEqual(None, store.cache_get("uid:1"))
+        store.cache_set("uid:1", 1.5, 60)
+
+    def test_expires(self):
+        store = Store(MemoryBackend())
+        store.set("i:1", "[]")
+        store.cache_set("uid:1", 1.5, 0.01)
+        self.assertEqual(1.5, store.cache_get("uid:1"))
+        time.sleep(0.02)
+        self.assertEqual(None, store.cache_get("uid:1"))
+        self.assertEqual("[]", store.get("i:1"))
+
+
+    def test_circuit_breaker(self):
+        backend = MemoryBackend(latency=0.05)
+        store = Store(backend, timeout=0.01,
+                      breaker=CircuitBreaker(max_failures=2, reset_timeout=0.05))
+        backend.set("uid:1", 1.5)
+        self.assertEqual(None, store.cache_get("uid:1"))
+        self.assertEqual(None, store.cache_get("uid:1"))
+        self.assertEqual(CircuitBreaker.OPEN, store.breaker.state)
+
+        started = time.time()
+        self.assertRaises(StoreUnavailable, store.get, "i:1")
+        self.assertEqual(None, store.cache_get("uid:1"))
+        self.assertEqual(3.0, scoring.get_score(store, "79175002040", "a@b"))
+        self.assertTrue(time.time() - started < 0.01)
+
+        # a failed probe reopens the circuit, a successful one closes it
+        time.sleep(0.05)
+        self.assertEqual(None, store.cache_get("uid:1"))
+        self.assertEqual(CircuitBreaker.OPEN, store.breaker.state)
+        backend.latency = 0
+        time.sleep(0.05)
+        self.assertEqual(1.5, store.cache_get("uid:1"))
+        self.assertEqual(CircuitBreaker.CLOSED, store.breaker.state)
+
+
+class ShardingTest(unittest.TestCase):
+    keys = ["i:%d" % i for i in range(10000)]
+
+    def owners(self, ring):
+        return dict((key, ring.node(key)) for key in self.keys)
+
+    def test_weights(self):
+        ring = HashRing()
+        ring.add("a")
+        ring.add("b", weight=2)
+        counts = {"a": 0, "b": 0}
+        for node in self.owners(ring).values():
+            counts[node] += 1
+        self.assertAlmostEqual(2.0, counts["b"] / float(counts["a"]), delta=0.3)
+
+    def test_minimal_movement(self):
+        ring = HashRing()
+        for node in ("a", "b", "c"):
+            ring.add(node)
+        before = self.owners(ring)
+        ring.add("d")
+        after = self.owners(ring)
+        moved = [k for k in self.keys if before[k] != after[k]]
+        self.assertLess(len(moved), len(self.keys) * 0.35)
+        self.assertEqual(set(["d"]), set(after[k] for k in moved))
+        ring.remove("b")
+        removed = self.owners(ring)
+        self.assertEqual([k for k in self.keys if after[k] == "b"],
+                         [k for k in self.keys if after[k] != removed[k]])
+        self.assertRaises(StoreUnavailable, HashRing().node, "i:1")
+
+    def test_parallel_get_many(self):
+        nodes = [("node%d" % i, MemoryBackend(), 1) for i in range(3)]
+        store = Store(ShardedBackend(nodes))
+        keys = self.keys[:30]
+        store.set_many([(key, key.upper(), None) for key in keys])
+        for name, backend, _ in nodes:
+            self.assertTrue(backend.data)
+            self.assertTrue(all(store.backend.ring.node(k) == name for k in backend.data))
+            backend.latency = 0.05
+        started = time.time()
+        self.assertEqual([k.upper() for k in keys] + [None],
+                         store.get_many(keys + ["i:missing"]))
+        self.assertLess(time.time() - started, 0.12)
+        self.assertEqual(sorted(keys), sorted(k for k, _, _ in store.dump(keys)))
+        for backend in (b for _, b, _ in nodes):
+            backend.latency = 0
+        scanned, cursor = [], 0
+        while True:
+            cursor, found = store.scan(cursor, "i:*", count=4)
+            scanned.extend(found)
+            if not cursor:
+                break
+        self.assertEqual(sorted(keys), sorted(scanned))
+
+    def test_concurrent_fanouts(self):
+        nodes = [("node%d" % i, MemoryBackend(latency=0.05), 1) for i in range(3)]
+        store = Store(ShardedBackend(nodes))
+        keys = self.keys[:30]
+        took = []
+
+        def get_many():
+            started = time.time()
+            store.get_many(keys)
+            took.append(time.time() - started)
+
+        threads = [threading.Thread(target=get_many) for _ in range(40)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(40, len(took))
+        self.assertLess(max(took), 0.25)
+
+    def test_breaker_per_node(self):
+        dead = MemoryBackend(latency=10)
+        backend = ShardedBackend([("dead", dead, 1), ("alive", MemoryBackend(), 1)],
+                                 timeout=0.05,
+                                 breaker=lambda: CircuitBreaker(1, reset_timeout=60))
+        store = Store(backend, timeout=0.05, breaker=CircuitBreaker(0))
+        on_dead = [k for k in self.keys if backend.ring.node(k) == "dead"][0]
+        on_alive = [k for k in self.keys if backend.ring.node(k) == "alive"][0]
+        store.set(on_alive, "1")
+        self.assertRaises(StoreTimeout, store.get_many, [on_dead, on_alive])
+        self.assertEqual(CircuitBreaker.OPEN, backend.breakers["dead"].state)
+        self.assertEqual(CircuitBreaker.CLOSED, store.breaker.state)
+        started = time.time()
+        self.assertRaises(StoreUnavailable, store.get, on_dead)
+        self.assertEqual("1", store.get(on_alive))
+        self.assertEqual(["1"], store.get_many([on_alive]))
+        self.assertLess(time.time() - started, 0.02)
+
+    def test_add_and_remove_nodes(self):
+        backend = ShardedBackend([("a", MemoryBackend(), 1), ("b", MemoryBackend(), 1)])
+        store = Store(backend)
+        store.set_many([(key, "1", None) for key in self.keys])
+        backend.add_node("c", MemoryBackend())
+        values = store.get_many(self.keys)
+        missing = values.count(None)
+        # keys now owned by the new node aren't there until rewritten
+        self.assertEqual(missing, sum(1 for k in self.keys if backend.ring.node(k) == "c"))
+        self.assertLess(missing, len(self.keys) * 0.5)
+        backend.remove_node("c")
+        self.assertEqual(["1"] * len(self.keys), store.get_many(self.keys))
+
+    def test_backend_from_url(self):
+        backend = backend_from_url("memory://a, memory://b?weight=3")
+        self.assertEqual({"memory://a": 1, "memory://b": 3}, backend.ring.weights)
+        self.assertIsInstance(backend_from_url("memory://"), MemoryBackend)
+
+
+class WriteBehindTest(unittest.TestCase):
+    def counts(self):
+        return [CACHE_WRITES.value(outcome)
+                for outcome in ("queued", "flushed", "dropped")]
+
+    def test_flush(self):
+        backend = MemoryBackend()
+        flushes = []
+        backend.set_many = lambda items, **kwargs: flushes.append(items)
+        store = Store(backend, write_behind=WriteBehind(batch_size=2, interval=10))
+        before = self.counts()
+        store.cache_set("uid:1", 1.5, 60)
+        self.assertEqual(1.5, store.cache_get("uid:1"))
+        store.cache_set("uid:2", 3.0, 60)
+        store.cache_set("uid:3", 0.5, 60)
+        store.close()
+        self.assertEqual([[("uid:1", 1.5, 60), ("uid:2", 3.0, 60)],
+                          [("uid:3", 0.5, 60)]], flushes)
+        self.assertEqual([3, 3, 0], [a - b for a, b in zip(self.counts(), before)])
+
+    def test_drop_when_full(self):
+        write_behind = WriteBehind(max_size=2)
+        before = self.counts()
+        self.assertTrue(write_behind.put("uid:1", 1, 60))
+        self.assertTrue(write_behind.put("uid:2", 2, 60))
+        self.assertFalse(write_behind.put("uid:3", 3, 60))
+        self.assertTrue(write_behind.put("uid:2", 2.5, 60))
+        self.assertEqual(["uid:1", "uid:2"], list(write_behind.pending))
+
+        write_behind.drop_oldest = True
+        self.assertTrue(write_behind.put("uid:3", 3, 60))
+        self.assertEqual(["uid:2", "uid:3"], list(write_behind.pending))
+        self.assertEqual([4, 0, 2], [a - b for a, b in zip(self.counts(), before)])
+
+
+class CacheSnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mktemp()
+
+    def tearDown(self):
+        for path in (self.path, self.path + ".lock"):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def test_save_and_restore(self):
+        backend = MemoryBackend()
+        store = Store(backend, snapshot=CacheSnapshot(self.path, max_entries=3))
+        store.set("i:1", '["cars"]')
+        store.cache_set("uid:1", 1.5, 60)
+        store.cache_set("uid:2", 3.0, 0.05)
+        store.cache_set("uid:cold", 0.5, 60)
+        for key in ("i:1", "uid:1", "uid:2", "i:1", "uid:1", "uid:2", "uid:cold"):
+            store.cache_get(key)
+        store.close()
+        time.sleep(0.1)
+
+        backend = MemoryBackend()
+        backend.set("uid:1", 2.0)
+        snapshot = CacheSnapshot(self.path)
+        store = Store(backend, snapshot=snapshot)
+        while snapshot.restored is None:
+            time.sleep(0.01)
+        self.assertEqual({"total": 3, "restored": 2, "expired": 1}, snapshot.restored)
+        self.assertEqual('["cars"]', store.get("i:1"))
+        # live writes win over the snapshot
+        self.assertEqual(2.0, store.cache_get("uid:1"))
+        self.assertEqual(None, store.cache_get("uid:cold"))
+        self.assertEqual([("i:1", '["cars"]', None)], backend.dump(["i:1"]))
+        store.close()
+
+    def test_single_writer(self):
+        # as the workers of one supervisor share it
+        first, second = CacheSnapshot(self.path), CacheSnapshot(self.path)
+        first.store = second.store = Store(MemoryBackend())
+        first.touch("uid:1")
+        second.touch("uid:2")
+        self.assertEqual(0, first.save())
+        self.assertEqual(0, second.save())
+        self.assertFalse(second.is_writer())
+        self.assertEqual([], [f for f in os.listdir(os.path.dirname(self.path))
+                              if f.startswith(os.path.basename(self.path) + ".")
+                              and f.endswith(".tmp")])
+        # the writer's exit hands the snapshot over
+        first.close()
+        self.assertTrue(second.is_writer())
+        second.close()
+
+    def test_hits_are_bounded(self):
+        snapshot = CacheSnapshot(self.path, max_entries=10)
+        for _ in range(3):
+            snapshot.touch("uid:hot")
+        started = time.time()
+        for i in range(1000):
+            snapshot.touch("i:%d" % i)
+        # touch only swaps the full dict out, it never sorts
+        self.assertLess(time.time() - started, 0.05)
+        self.assertLessEqual(len(snapshot.hits), 40)
+        self.assertEqual(24, len(snapshot.overflow))
+        self.assertNotIn("uid:hot", snapshot.hits)
+        self.assertTrue(snapshot.wakeup.is_set())
+        snapshot.trim()
+        self.assertEqual([], snapshot.overflow)
+        self.assertIn("uid:hot", snapshot.hits)
+        self.assertEqual("uid:hot", snapshot.hottest()[0])
+
+    def test_worker_trims(self):
+        snapshot = CacheSnapshot(self.path, max_entries=10, interval=60)
+        store = Store(MemoryBackend(), snapshot=snapshot)
+        for i in range(100):
+            snapshot.touch("i:%d" % i)
+        deadline = time.time() + 1
+        while snapshot.overflow and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual([], snapshot.overflow)
+        store.close()
+
+
+def hammer_shared_cache(args):
+    # every value is derived from its key, so a torn read shows up
+    path, worker = args
+    cache = SharedCache(path, slots=64, max_probe=4)
+    bad = 0
+    for i in range(2000):
+        key = "uid:%d" % ((i * 7 + worker) % 100)
+        cache.set(key, float(len(key) * 1000 + i % 5), 60)
+        value = cache.get("uid:%d" % (i % 100))
+        if value is not None and value // 1000 != len("uid:%d" % (i % 100)):
+            bad += 1
+    cache.close()
+    return bad
+
+
+class SharedCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, "cache")
+
+    def test_get_set(self):
+        cache = SharedCache(self.path, slots=16)
+        self.assertIsNone(cache.get("uid:1"))
+        cache.set("uid:1", 3.0, 60)
+        cache.set("uid:2", "1.5", 60)
+        cache.set("uid:1", 4.5, 60)
+        cache.set("uid:3", 1, -1)
+        self.assertEqual(4.5, cache.get("uid:1"))
+        self.assertEqual(1.5, cache.get("uid:2"))
+        self.assertIsNone(cache.get("uid:3"))
+        self.assertRaises(ValueError, cache.set, "uid:4", "not a number", 60)
+
+    def test_full_table_evicts(self):
+        cache = SharedCache(self.path, slots=4, stripes=2, max_probe=2)
+        for i in range(50):
+            cache.set("uid:%d" % i, i, 60 + i)
+            self.assertEqual(i, cache.get("uid:%d" % i))
+
+    def test_shared_between_processes(self):
+        first = SharedCache(self.path, slots=16)
+        pool = multiprocessing.Pool(4)
+        try:
+            bad = pool.map(hammer_shared_cache, [(self.path, w) for w in range(4)])
+        finally:
+            pool.close()
+            pool.join()
+        self.assertEqual([0, 0, 0, 0], bad)
+        # the size of the table is fixed by whoever created the file
+        self.assertEqual(16, first.slots)
+        values = [(len("uid:%d" % i), first.get("uid:%d" % i)) for i in range(100)]
+        values = [(n, v // 1000) for n, v in values if v is not None]
+        self.assertTrue(values)
+        self.assertEqual([n for n, _ in values], [v for _, v in values])
+
+    def test_store_uses_local_cache(self):
+        backend = MemoryBackend()
+        store = Store(backend, local_cache=SharedCache(self.path, slots=16, ttl=60))
+        other = Store(MemoryBackend(), local_cache=SharedCache(self.path))
+        store.cache_set("uid:1", 3.0, 3600)
+        self.assertEqual(3.0, other.cache_get("uid:1"))
+        # store hits are copied to the local cache
+        backend.set("uid:2", "1.5")
+        self.assertEqual("1.5", store.cache_get("uid:2"))
+        self.assertEqual(1.5, other.cache_get("uid:2"))
+        store.cache_set("i:1", "[]", 60)
+        self.assertIsNone(other.cache_get("i:1"))
+
+
+class DeadlineTest(unittest.TestCase):
+    def test_request_timeout(self):
+        self.assertEqual(1.0, api.request_timeout({}, 1.0))
+        for header, timeout in [("0.25", 0.25), ("1e9", api.MAX_REQUEST_TIMEOUT),
+                                ("-1", 5.0), ("nan", 5.0), ("soon", 5.0)]:
+            self.assertEqual(timeout, api.request_timeout(
+                {"X-Request-Timeout": header}, 5.0))
+
+    def test_store_calls_get_the_remaining_budget(self):
+        store = Store(MemoryBackend(latency=0.2), timeout=1.0)
+        started = time.time()
+        self.assertRaises(DeadlineExceeded, store.get, "i:1", deadline=started + 0.02)
+        self.assertLess(time.time() - started, 0.15)
+        self.assertEqual(0, store.breaker.failures)
+        # no backend call at all once the deadline has passed
+        started = time.time()
+        view = DeadlineStore(store, started - 1)
+        self.assertRaises(DeadlineExceeded, view.get, "i:1")
+        self.assertRaises(DeadlineExceeded, view.cache_get, "uid:1")
+        view.cache_set("uid:1", 1.0, 60)
+        self.assertLess(time.time() - started, 0.05)
+
+    def test_hung_store_opens_the_breaker(self):
+        # a deadline as long as the store timeout is the store's fault,
+        # but the score is still computed in time without the cache
+        store = Store(MemoryBackend(latency=10), timeout=0.1,
+                      breaker=CircuitBreaker(max_failures=1, reset_timeout=60))
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score",
+                   "arguments": {"phone": "79175002040", "email": "a@b"}}
+        request["token"] = api.user_token(request["account"], request["login"])
+        headers = {"X-Request-Timeout": "0.1"}
+        started = time.time()
+        response, code = api.method_handler({"body": request, "headers": headers}, {},
+                                            store)
+        self.assertEqual((api.OK, {"score": 3.0}), (code, response))
+        # the cache read got half of the deadline and its timeout opened
+        # the breaker, so the write didn't wait at all
+        self.assertLess(time.time() - started, 0.08)
+        self.assertEqual(CircuitBreaker.OPEN, store.breaker.state)
+        # and from then on the store isn't waited for at all
+        started = time.time()
+        response, code = api.method_handler({"body": request, "headers": headers}, {},
+                                            store)
+        self.assertEqual((api.OK, {"score": 3.0}), (code, response))
+        self.assertLess(time.time() - started, 0.05)
+
+    def test_probe_cut_short_by_deadline(self):
+        backend = MemoryBackend(latency=0.2)
+        store = Store(backend, timeout=0.1,
+                      breaker=CircuitBreaker(max_failures=1, reset_timeout=0.01))
+        self.assertRaises(StoreTimeout, store.get, "i:1")
+        self.assertEqual(CircuitBreaker.OPEN, store.breaker.state)
+        time.sleep(0.02)
+        self.assertRaises(DeadlineExceeded, store.get, "i:1",
+                          deadline=time.time() + 0.01)
+        self.assertEqual(CircuitBreaker.OPEN, store.breaker.state)
+        backend.latency = 0
+        self.assertIsNone(store.get("i:1"))
+        self.assertEqual(CircuitBreaker.CLOSED, store.breaker.state)
+
+    def test_abandoned_request(self):
+        backend = MemoryBackend()
+        for cid in range(10):
+            backend.set("i:%s" % cid, '["cars"]')
+        backend.latency = 0.2
+        request = {"account": "horns&hoofs", "login": "h&f",
+                   "method": "clients_interests",
+                   "arguments": {"client_ids": range(10)}}
+        request["token"] = api.user_token(request["account"], request["login"])
+        ctx = {}
+        started = time.time()
+        response, code = api.method_handler(
+            {"body": request, "headers": {"X-Request-Timeout": "0.1"}}, ctx,
+            Store(backend))
+        self.assertEqual(api.DEADLINE_EXCEEDED, code)
+        self.assertLess(time.time() - started, 0.18)
+        self.assertAlmostEqual(started + 0.1, ctx["deadline"], places=2)
+        _, code = api.method_handler({"body": request, "headers": {}}, {},
+                                     Store(backend))
+        self.assertEqual(api.OK, code)
+
+
+class MethodRegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.policies = dict((name, method.policy)
+                             for name, method in api.methods.methods.items())
+        for name in self.policies:
+            api.methods.methods[name].policy = MethodPolicy(
+                deadline=self.policies[name].deadline)
+
+    def tearDown(self):
+        for name, policy in self.policies.items():
+            api.methods.methods[name].policy = policy
+
+    def call(self, method, arguments, store=None):
+        request = {"account": "horns&hoofs", "login": "h&f", "method": method,
+                   "arguments": arguments}
+        request["token"] = api.user_token(request["account"], request["login"])
+        return api.method_handler({"body": request, "headers": {}}, {}, store)
+
+    def test_dispatch(self):
+        method = api.methods.get("clients_interests")
+        self.assertIsInstance(method.handler, api.ClientsInterestsHandler)
+        self.assertEqual(5.0, method.policy.deadline)
+        self.assertIsNone(api.methods.get("unknown"))
+        self.assertEqual(api.NOT_FOUND, self.call("unknown", {})[1])
+        response, code = self.call("batch", {"requests": [{"method": "batch",
+                                                           "arguments": {}}]})
+        self.assertEqual(api.OK, code)
+        self.assertEqual(api.NOT_FOUND, response[0]["code"])
+
+    def test_configure(self):
+        api.methods.configure({"online_score": {u"store_timeout": 0.5,
+                                                u"cache": u"refresh"}})
+        policy = api.methods.get("online_score").policy
+        self.assertEqual((1.0, 0.5, "refresh"),
+                         (policy.deadline, policy.store_timeout, policy.cache))
+        for policies in [{"unknown": {}}, {"batch": {"retries": 1}},
+                         {"batch": {"cache": "sometimes"}},
+                         {"batch": {"deadline": 0}},
+                         {"batch": {"max_size": "10"}},
+                         {"batch": {"max_concurrency": None}}]:
+            self.assertRaises(ValueError, api.methods.configure, policies)
+
+    def test_max_size(self):
+        api.methods.configure({"clients_interests": {"max_size": 2}})
+        response, code = self.call("clients_interests", {"client_ids": [1, 2, 3]})
+        self.assertEqual(api.INVALID_REQUEST, code)
+        self.assertEqual("client_ids has 3 items, at most 2 allowed", response)
+        _, code = self.call("clients_interests", {"client_ids": [1, 2]}, FakeStore())
+        self.assertEqual(api.OK, code)
+        # batch calls are held to their own method's limit
+        response, code = self.call("batch", {"requests": [
+            {"method": "clients_interests", "arguments": {"client_ids": [1, 2, 3]}},
+            {"method": "clients_interests", "arguments": {"client_ids": [1]}}]},
+            FakeStore())
+        self.assertEqual(api.OK, code)
+        self.assertEqual([api.INVALID_REQUEST, api.OK], [r["code"] for r in response])
+
+    def test_max_concurrency(self):
+        api.methods.configure({"online_score": {"max_concurrency": 1}})
+        policy = api.methods.get("online_score").policy
+        self.assertTrue(policy.enter())
+        self.assertEqual(api.TOO_MANY_REQUESTS,
+                         self.call("online_score", {"phone": "79175002040",
+                                                    "email": "a@b"})[1])
+        # other methods are not held back
+        self.assertEqual(api.OK, self.call("clients_interests", {"client_ids": [1]},
+                                           FakeStore())[1])
+        policy.leave()
+        self.assertEqual(api.OK, self.call("online_score", {"phone": "79175002040",
+                                                            "email": "a@b"},
+                                           FakeStore())[1])
+        self.assertEqual(0, policy.active)
+        self.assertEqual(0, api.admission.active)
+
+    def test_cache_strategy(self):
+        arguments = {"phone": "79175002040", "email": "a@b",
+                     "first_name": "x%f" % time.time()}
+        key = scoring.score_key(arguments["first_name"])
+        store = FakeStore({key: 1.5})
+        self.assertEqual({"score": 1.5}, self.call("online_score", arguments, store)[0])
+        api.methods.configure({"online_score": {"cache": "refresh"}})
+        self.assertEqual({"score": 3.0}, self.call("online_score", arguments, store)[0])
+        self.assertEqual(3.0, store.data[key])
+        api.methods.configure({"online_score": {"cache": "bypass"}})
+        store.data[key] = 1.5
+        self.assertEqual({"score": 3.0}, self.call("online_score", arguments, store)[0])
+        self.assertEqual(1.5, store.data[key])
+
+    def test_store_timeout(self):
+        store = Store(MemoryBackend(latency=0.2), timeout=1.0)
+        api.methods.configure({"clients_interests": {"store_timeout": 0.05}})
+        started = time.time()
+        self.assertRaises(StoreTimeout, self.call, "clients_interests",
+                          {"client_ids": [1]}, store)
+        self.assertLess(time.time() - started, 0.15)
+        self.assertEqual(1, store.breaker.failures)
+
+
+@unittest.skipIf(store.redis is None, "redis package is not installed")
+class RedisBackendTest(unittest.TestCase):
+    def setUp(self):
+        # connections are queued, never answered
+        self.server = socket.socket()
+        self.server.bind(("127.0.0.1", 0))
+        self.server.listen(16)
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_call_timeout(self):
+        backend = store.RedisBackend(port=self.server.getsockname()[1], timeout=1.0)
+        for call in [lambda: backend.get("i:1", timeout=0.05),
+                     lambda: backend.get_many(["i:1", "i:2"], timeout=0.05),
+                     lambda: backend.set_many([("uid:1", 1.0, 60)], timeout=0.05)]:
+            started = time.time()
+            self.assertRaises(StoreTimeout, call)
+            self.assertLess(time.time() - started, 0.5)
+
+
+class ScoreCacheTest(unittest.TestCase):
+    def test_cached_score_is_a_number(self):
+        # as redis returns it
+        store = FakeStore({scoring.score_key("a", "b"): "1.5"})
+        self.assertEqual(1.5, scoring.get_score(store, None, None, first_name="a",
+                                                last_name="b"))
+        # an unreadable entry is a miss
+        store.data[scoring.score_key("a", "b")] = "garbage"
+        self.assertEqual(0.5, scoring.get_score(store, None, None, first_name="a",
+                                                last_name="b"))
+        self.assertEqual(0.5, store.data[scoring.score_key("a", "b")])
+
+
+class CoalescingTest(unittest.TestCase):
+    def run_concurrently(self, func, n=10):
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(func()))
+                   for _ in range(n)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return results
+
+    def test_concurrent_score_lookups(self):
+        store = FakeStore()
+        store.cache_get = lambda key: store.calls.append(key) or time.sleep(0.05)
+        results = self.run_concurrently(
+            lambda: scoring.get_score(store, "79175002040", "a@b", first_name="c"))
+        self.assertEqual([3.0] * 10, results)
+        self.assertEqual(1, len(store.calls))
+
+    def test_concurrent_interests_lookups(self):
+        backend = MemoryBackend(latency=0.05)
+        backend.data["i:7"] = ('["cars"]', None)
+        store = Store(backend)
+        coalesced = scoring.COALESCED.value("interests")
+        results = self.run_concurrently(lambda: scoring.get_interests(store, 7))
+        self.assertEqual([["cars"]] * 10, results)
+        self.assertEqual(coalesced + 9, scoring.COALESCED.value("interests"))
+
+    def test_concurrent_interests_many_lookups(self):
+        backend = MemoryBackend(latency=0.05)
+        backend.data["i:7"] = ('["cars"]', None)
+        fetched = []
+        get_many = backend.get_many
+        backend.get_many = lambda keys, timeout=None: fetched.extend(keys) or get_many(
+            keys, timeout)
+        store = Store(backend)
+        coalesced = scoring.COALESCED.value("interests")
+        results = self.run_concurrently(
+            lambda: scoring.get_interests_many(store, [7, 8, 7]))
+        self.assertEqual([{7: ["cars"], 8: []}] * 10, results)
+        self.assertEqual(["i:7", "i:8"], sorted(fetched))
+        self.assertEqual(coalesced + 18, scoring.COALESCED.value("interests"))
+
+
+class PrewarmTest(unittest.TestCase):
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def run_prewarm(self, content, fmt):
+        with open(self.filename, "w") as f:
+            f.write(content)
+        backend = MemoryBackend()
+        results = StringIO.StringIO()
+        stats = prewarm.prewarm(prewarm.read_lines(self.filename, fmt), Store(backend),
+                                processes=2, chunk_size=2, write_batch=2,
+                                results=results)
+        results = [json.loads(line) for line in results.getvalue().splitlines()]
+        return stats, backend, results
+
+    def test_jsonl(self):
+        lines = [
+            {"phone": "79175002040", "email": "a@b", "first_name": "a"},
+            {"first_name": "a", "last_name": "b", "gender": 1, "birthday": "01.01.2000"},
+            {"phone": "79175002040"},
+            {"first_name": "c", "last_name": "d"},
+        ]
+        content = "\n".join(json.dumps(l) for l in lines) + "\nnot json\n"
+        stats, backend, results = self.run_prewarm(content, "jsonl")
+        self.assertEqual({"lines": 5, "scored": 3, "invalid": 2, "written": 3,
+                          "failed": 0}, stats)
+        self.assertEqual([1, 2, 3, 4, 5], [r["line"] for r in results])
+        self.assertEqual("invalid json", results[4]["error"])
+        store = Store(backend)
+        self.assertEqual(3.0, scoring.get_score(store, "79175002040", "a@b",
+                                                first_name="a"))
+        birthday = datetime.datetime(2000, 1, 1)
+        self.assertEqual(results[1]["score"], store.cache_get(
+            scoring.score_key("a", "b", birthday)))
+
+    def test_csv(self):
+        content = ("phone,email,first_name,last_name,birthday,gender\n"
+                   "79175002040,a@b,,,,\n"
+                   ",,,,01.01.2000,0\n"
+                   ",,,,01.01.2000,x\n")
+        stats, backend, results = self.run_prewarm(content, "csv")
+        self.assertEqual(2, stats["written"])
+        self.assertEqual([2, 3, 4], [r["line"] for r in results])
+        self.assertEqual("gender field validation error", results[2]["error"])
+
+
+class InterestsCodecTest(unittest.TestCase):
+    def test_round_trip(self):
+        for names in ([], ["cars"], ["pets", "tv"], interests.VOCABULARY):
+            value = interests.encode(names)
+            self.assertEqual(interests.VERSION, value[0])
+            self.assertTrue(all(ord(c) < 0x80 for c in value))
+            self.assertLess(len(value), len(json.dumps(names)) + 1)
+            self.assertEqual(sorted(names), sorted(interests.decode(value)))
+        self.assertRaises(KeyError, interests.encode, ["knitting"])
+
+    def test_legacy_values(self):
+        self.assertEqual(["pets", "tv"], interests.decode('["pets", "tv"]'))
+        self.assertEqual([], interests.decode(None))
+        self.assertRaises(ValueError, interests.decode, "\x7f\x01")
+
+    def test_store_round_trip(self):
+        store = Store(MemoryBackend())
+        scoring.set_interests(store, 5, ["otus", "cars"])
+        self.assertEqual(["cars", "otus"], scoring.get_interests(store, 5))
+        self.assertEqual(3, len(store.get("i:5")))
+
+    def test_migrate(self):
+        backend = MemoryBackend()
+        backend.set("i:1", '["cars", "pets"]', 100)
+        backend.set("i:2", '["knitting"]')
+        backend.set("i:3", interests.encode(["tv"]))
+        backend.set("uid:1", "[]")
+        for cid in range(4, 10):
+            backend.set("i:%s" % cid, '["geek"]')
+        store = Store(backend)
+        stats = migrate_interests.migrate(store, batch_size=3, dry_run=True)
+        self.assertEqual(7, stats["migrated"])
+        self.assertEqual('["cars", "pets"]', store.get("i:1"))
+        stats = migrate_interests.migrate(store, batch_size=3)
+        self.assertEqual({"scanned": 9, "migrated": 7, "encoded": 1, "skipped": 1,
+                          "failed": 0, "bytes_before": 64, "bytes_after": 20}, stats)
+        self.assertEqual(interests.encode(["cars", "pets"]), store.get("i:1"))
+        self.assertAlmostEqual(100, backend.dump(["i:1"])[0][2], places=0)
+        self.assertEqual('["knitting"]', store.get("i:2"))
+        self.assertEqual("[]", store.get("uid:1"))
+        self.assertEqual(0, migrate_interests.migrate(store)["migrated"])
+
+
+class MsgpackCodecTest(unittest.TestCase):
+    values = [None, True, False, 0, 127, 128, 255, 256, 65536, 2 ** 32, 2 ** 64 - 1,
+              -1, -32, -33, -129, -32769, -2 ** 31 - 1, -2 ** 63, 1.5, -0.25,
+              u"", u"h&f", u"\u0432\u0430\u0441\u044f" * 20, u"x" * 70000,
+              [], range(20), range(70000), {}, {u"a": [1, {u"b": None}]},
+              dict((i, u"v") for i in range(20))]
+
+    def test_round_trip(self):
+        for value in self.values:
+            for packb, unpackb in [(msgpackcodec.py_packb, msgpackcodec.py_unpackb),
+                                   (msgpackcodec.packb, msgpackcodec.unpackb)]:
+                self.assertEqual(value, unpackb(packb(value)))
+        # byte strings are text, like in json
+        self.assertEqual(u"h&f", msgpackcodec.unpackb(msgpackcodec.py_packb("h&f")))
+        self.assertEqual("\x81\xa1a\x93\x01\xa1b\xc0",
+                         msgpackcodec.py_packb({"a": [1, "b", None]}))
+
+    def test_invalid_data(self):
+        for data in ["", "\x92\x01", "\x01\x02", "\xc7\x01\x00\x00", "\xa5ab",
+                     "\xa2\xff\xfe"]:
+            self.assertRaises(ValueError, msgpackcodec.py_unpackb, data)
+            self.assertRaises(ValueError, msgpackcodec.unpackb, data)
+        self.assertRaises(TypeError, msgpackcodec.py_packb, object())
+
+
+class LoadTestTest(unittest.TestCase):
+    def test_local_run(self):
+        server = loadtest.local_server(0, 0, 100)
+        try:
+            url = "http://%s:%s/method" % server.server_address
+            bodies = loadtest.make_bodies(
+                loadtest.parse_mix("online_score=1,clients_interests=1"), 100, 50)
+            report = loadtest.LoadTest(url, bodies, concurrency=2, requests=40).run()
+        finally:
+            server.shutdown()
+            server.server_close()
+            api.MainHTTPHandler.store = None
+        self.assertEqual({api.OK: 40}, report["codes"])
+        self.assertTrue(0 < report["p50"] <= report["p99"] <= report["max"])
+
+
+class SupervisorTest(unittest.TestCase):
+    def setUp(self):
+        argv = [sys.executable, "-c", "import time; time.sleep(30)"]
+        self.supervisor = Supervisor(argv, 2, graceful_timeout=1,
+                                     startup_delay=0.1, poll_interval=0.01)
+        for _ in range(2):
+            self.supervisor.spawn()
+
+    def tearDown(self):
+        for process, _ in self.supervisor.workers.values():
+            process.kill()
+            process.wait()
+
+    def test_restart_crashed_worker(self):
+        pids = set(self.supervisor.workers)
+        crashed = pids.pop()
+        os.kill(crashed, signal.SIGKILL)
+        time.sleep(0.2)
+        self.supervisor.reap()
+        self.assertEqual(2, len(self.supervisor.workers))
+        self.assertNotIn(crashed, self.supervisor.workers)
+        self.assertIn(pids.pop(), self.supervisor.workers)
+
+    def test_rolling_restart(self):
+        old = set(self.supervisor.workers)
+        self.supervisor.rolling_restart()
+        self.assertEqual(2, len(self.supervisor.workers))
+        self.assertFalse(old & set(self.supervisor.workers))
+
+
+class HTTPServerTest(unittest.TestCase):
+    body = json.dumps({"login": "h&f", "method": "online_score"})
+
+    def setUp(self):
+        self.server = api.ThreadedHTTPServer(("localhost", 0), api.MainHTTPHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.sock = socket.create_connection(self.server.server_address)
+
+    def tearDown(self):
+        self.sock.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def post(self, body):
+        return ("POST /method HTTP/1.1\r\nHost: localhost\r\n"
+                "Content-Length: %d\r\n\r\n%s" % (len(body), body))
+
+    def read_response(self):
+        response = httplib.HTTPResponse(self.sock)
+        response.begin()
+        return response, json.loads(response.read())
+
+    def test_pipelined_requests(self):
+        self.sock.sendall(self.post(self.body) + self.post("not json") + self.post(self.body))
+        codes = []
+        for _ in range(3):
+            response, body = self.read_response()
+            self.assertEqual(response.status, body["code"])
+            self.assertFalse(response.will_close)
+            codes.append(body["code"])
+        self.assertEqual([api.INVALID_REQUEST, api.BAD_REQUEST, api.INVALID_REQUEST],
+                         codes)
+
+    def test_max_requests(self):
+        old_max_requests = api.MainHTTPHandler.max_requests
+        api.MainHTTPHandler.max_requests = 2
+        try:
+            self.sock.sendall(self.post(self.body) + self.post(self.body))
+            first, _ = self.read_response()
+            second, _ = self.read_response()
+        finally:
+            api.MainHTTPHandler.max_requests = old_max_requests
+        self.assertFalse(first.will_close)
+        self.assertTrue(second.will_close)
+        self.assertEqual("", self.sock.recv(1))
+
+    def test_missing_content_length(self):
+        self.sock.sendall("POST /method HTTP/1.1\r\nHost: localhost\r\n\r\n{}")
+        response, body = self.read_response()
+        self.assertEqual(api.BAD_REQUEST, body["code"])
+        self.assertTrue(response.will_close)
+
+    def test_metrics(self):
+        self.sock.sendall(self.post(self.body))
+        self.read_response()
+        self.sock.sendall("GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n")
+        response = httplib.HTTPResponse(self.sock)
+        response.begin()
+        body = response.read()
+        self.assertEqual(200, response.status)
+        self.assertIn('scoring_api_stage_seconds_count{stage="validate"}', body)
+        self.assertIn('scoring_api_responses_total{code="422"}', body)
+
+    def test_reuse_port(self):
+        self.server.server_close()
+        api.ThreadedHTTPServer.reuse_port = True
+        try:
+            first = api.ThreadedHTTPServer(("localhost", 0), api.MainHTTPHandler)
+            second = api.ThreadedHTTPServer(first.server_address, api.MainHTTPHandler)
+        finally:
+            api.ThreadedHTTPServer.reuse_port = False
+        first.server_close()
+        second.server_close()
+
+    def test_graceful_stop(self):
+        finished = []
+
+        def slow_handler(request, ctx, store):
+            time.sleep(0.2)
+            finished.append(True)
+            return {}, api.OK
+
+        router = api.MainHTTPHandler.router
+        api.MainHTTPHandler.router = {"slow": slow_handler}
+        try:
+            self.sock.sendall(self.post(self.body).replace("/method", "/slow"))
+            time.sleep(0.05)
+            self.server.shutdown()
+            self.server.stop()
+        finally:
+            api.MainHTTPHandler.router = router
+        self.assertEqual([True], finished)
+        _, body = self.read_response()
+        self.assertEqual(api.OK, body["code"])
+
+    def echo_router(self):
+        def echo(request, ctx, store):
+            return request["body"], api.OK
+        self.addCleanup(setattr, api.MainHTTPHandler, "router",
+                        api.MainHTTPHandler.router)
+        api.MainHTTPHandler.router = {"method": echo}
+
+    def test_compressed_response(self):
+        self.echo_router()
+        payload = json.dumps({"interests": ["books", "travel"] * 200})
+        for coding, wbits in [("gzip", 31), ("deflate", 15)]:
+            self.sock.sendall(self.post(payload).replace(
+                "\r\n\r\n", "\r\nAccept-Encoding: %s;q=0.5, br\r\n\r\n" % coding, 1))
+            response = httplib.HTTPResponse(self.sock)
+            response.begin()
+            raw = response.read()
+            self.assertEqual(coding, response.getheader("Content-Encoding"))
+            self.assertEqual(len(raw), int(response.getheader("Content-Length")))
+            self.assertLess(len(raw), len(payload))
+            body = json.loads(zlib.decompress(raw, wbits))
+            self.assertEqual(json.loads(payload), body["response"])
+        # small responses and clients that refuse gzip get identity
+        self.sock.sendall(self.post(payload).replace(
+            "\r\n\r\n", "\r\nAccept-Encoding: gzip;q=0\r\n\r\n", 1))
+        response, body = self.read_response()
+        self.assertIsNone(response.getheader("Content-Encoding"))
+        self.sock.sendall(self.post(self.body).replace(
+            "\r\n\r\n", "\r\nAccept-Encoding: gzip\r\n\r\n", 1))
+        response, body = self.read_response()
+        self.assertIsNone(response.getheader("Content-Encoding"))
+
+    def test_compressed_request(self):
+        self.echo_router()
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        data = compressor.compress(self.body) + compressor.flush()
+        self.sock.sendall(self.post(data).replace(
+            "\r\n\r\n", "\r\nContent-Encoding: gzip\r\n\r\n", 1))
+        response, body = self.read_response()
+        self.assertEqual(json.loads(self.body), body["response"])
+        self.sock.sendall(self.post("garbage").replace(
+            "\r\n\r\n", "\r\nContent-Encoding: gzip\r\n\r\n", 1))
+        response, body = self.read_response()
+        self.assertEqual(api.BAD_REQUEST, body["code"])
+
+    def test_compressed_request_size_limit(self):
+        old_limit = api.MainHTTPHandler.max_decoded_size
+        api.MainHTTPHandler.max_decoded_size = 1000
+        self.addCleanup(setattr, api.MainHTTPHandler, "max_decoded_size", old_limit)
+        data = zlib.compress(json.dumps({"login": "x" * 100000}))
+        self.sock.sendall(self.post(data).replace(
+            "\r\n\r\n", "\r\nContent-Encoding: deflate\r\n\r\n", 1))
+        response, body = self.read_response()
+        self.assertEqual(api.BAD_REQUEST, body["code"])
+
+    def test_profile(self):
+        def slow(request, ctx, store):
+            time.sleep(0.1)
+            return {}, api.OK
+
+        self.addCleanup(setattr, api.MainHTTPHandler, "router",
+                        api.MainHTTPHandler.router)
+        api.MainHTTPHandler.router = {"profile": api.profile_handler, "slow": slow}
+        profile = {"login": "admin", "token": api.admin_token(), "seconds": 5,
+                   "requests": 2, "interval": 0.01}
+        for request, code in [(dict(profile, login="h&f"), api.FORBIDDEN),
+                              (dict(profile, token="bad"), api.FORBIDDEN),
+                              (dict(profile, seconds=-1), api.INVALID_REQUEST)]:
+            self.sock.sendall(self.post(json.dumps(request)).replace("/method", "/profile"))
+            self.assertEqual(code, self.read_response()[1]["code"])
+
+        def send_slow():
+            time.sleep(0.1)
+            sock = socket.create_connection(self.server.server_address)
+            for _ in range(2):
+                sock.sendall(self.post(self.body).replace("/method", "/slow"))
+                httplib.HTTPResponse(sock).begin()
+            sock.close()
+
+        thread = threading.Thread(target=send_slow)
+        thread.start()
+        started = time.time()
+        self.sock.sendall(self.post(json.dumps(profile)).replace("/method", "/profile"))
+        _, body = self.read_response()
+        thread.join()
+        self.assertLess(time.time() - started, 4)
+        report = body["response"]
+        self.assertGreater(report["samples"], 0)
+        self.assertTrue(all(s.startswith("api.py") for s in report["stacks"]))
+        self.assertTrue(any(":slow " in s for s in report["stacks"]))
+        self.assertTrue(any(f["function"].endswith(":slow") for f in report["functions"]))
+
+    def test_msgpack(self):
+        self.echo_router()
+        payload = {u"client_ids": range(100), u"login": u"h&f"}
+        data = msgpackcodec.packb(payload)
+        request = self.post(data).replace(
+            "\r\n\r\n", "\r\nContent-Type: application/msgpack\r\n\r\n", 1)
+        self.sock.sendall(request)
+        response = httplib.HTTPResponse(self.sock)
+        response.begin()
+        self.assertEqual("application/msgpack", response.getheader("Content-Type"))
+        body = msgpackcodec.unpackb(response.read())
+        self.assertEqual({u"response": payload, u"code": 200}, body)
+        # Accept wins over the request's own format
+        self.sock.sendall(request.replace("\r\n\r\n",
+                                          "\r\nAccept: application/json\r\n\r\n", 1))
+        response, body = self.read_response()
+        self.assertEqual("application/json", response.getheader("Content-Type"))
+        self.assertEqual(payload, body["response"])
+        self.sock.sendall(self.post(self.body).replace(
+            "\r\n\r\n", "\r\nAccept: application/x-msgpack, */*;q=0.1\r\n\r\n", 1))
+        response = httplib.HTTPResponse(self.sock)
+        response.begin()
+        self.assertEqual(200, msgpackcodec.unpackb(response.read())["code"])
+        self.sock.sendall(request.replace(data, "\xc1" + data[1:]))
+        response = httplib.HTTPResponse(self.sock)
+        response.begin()
+        self.assertEqual(api.BAD_REQUEST, msgpackcodec.unpackb(response.read())["code"])
+
+    def test_error_response_has_length(self):
+        self.sock.sendall("PUT /method HTTP/1.1\r\nHost: localhost\r\n\r\n")
+        response, body = self.read_response()
+        self.assertEqual(501, body["code"])
+        self.assertTrue(response.getheader("Content-Length"))
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,107 @@
+import json
+import time
+import random
+import logging
+import threading
+
+local = threading.local()
+
+
+class Span(object):
+    __slots__ = ("trace", "name", "attrs", "started", "finished", "children")
+
+    def __init__(self, trace, name, attrs):
+        self.trace = trace
+        self.name = name
+        self.attrs = attrs
+        self.started = self.finished = None
+        self.children = []
+
+    def __enter__(self):
+        self.trace.stack[-1].children.append(self)
+        self.trace.stack.append(self)
+        self.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.finished = time.time()
+        self.trace.stack.pop()
+        if exc_type is not None:
+            self.attrs["error"] = exc_type.__name__
+
+    def tree(self, origin):
+        finished = self.finished or time.time()
+        node = {"name": self.name,
+                "start_ms": round((self.started - origin) * 1000, 3),
+                "duration_ms": round((finished - self.started) * 1000, 3)}
+        if self.attrs:
+            node.update(self.attrs)
+        if self.children:
+            node["children"] = [c.tree(origin) for c in self.children]
+        return node
+
+
+class NoSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+
+NO_SPAN = NoSpan()
+
+
+class Trace(object):
+    __slots__ = ("request_id", "root", "stack")
+
+    def __init__(self, request_id):
+        self.request_id = request_id
+        self.root = Span(self, "request", {})
+        self.root.started = time.time()
+        self.stack = [self.root]
+
+
+def span(name, **attrs):
+    # a span of the request traced by this thread, a no-op if there is none
+    trace = getattr(local, "trace", None)
+    if trace is None:
+        return NO_SPAN
+    return Span(trace, name, attrs)
+
+
+class Tracer(object):
+    # Records spans for a `sample_rate` share of requests and writes the
+    # span tree of those that took at least `slow_threshold` seconds to the
+    # "trace" logger, one JSON line per request. Disabled while
+    # slow_threshold is 0: span() then costs a thread-local lookup.
+
+    def __init__(self, slow_threshold=0, sample_rate=1.0):
+        self.slow_threshold = slow_threshold
+        self.sample_rate = sample_rate
+        self.logger = logging.getLogger("trace")
+
+    def start(self, request_id):
+        if not self.slow_threshold:
+            return
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            local.trace = None
+        else:
+            local.trace = Trace(request_id)
+
+    def finish(self, **attrs):
+        trace = getattr(local, "trace", None)
+        if trace is None:
+            return None
+        local.trace = None
+        root = trace.root
+        root.finished = time.time()
+        if root.finished - root.started < self.slow_threshold:
+            return None
+        root.attrs.update(attrs)
+        record = root.tree(root.started)
+        record["request_id"] = trace.request_id
+        self.logger.warning(json.dumps(record, default=str))
+        return record